@@ -0,0 +1,116 @@
+import math
+import time
+import threading
+from typing import List, Optional
+
+from exceptions import TooManyRequestsException
+from metrics import REGISTRY, Counter
+
+# リクエストの受け付け制御
+# - uuidごと・IPごとのレート制限 (token bucket)
+# - 同時に処理する(RTDB/Firestoreを呼ぶ)リクエスト数の上限
+# どちらも待たせずに429とRetry-Afterを返す
+IN_FLIGHT_RETRY_AFTER = 1  # 秒
+# 制限しないルート (監視と定期実行)
+EXEMPT_ROUTES = ('/metrics', '/admin/gc')
+# レート制限だけをかけ、同時処理数には数えないルート (接続し続けるSSEと、プロセス内の状態を返すだけのもの)
+NO_SLOT_ROUTES = ('/room/<int:room_id>/events', '/room/<int:room_id>/warmup')
+
+admission_rejections_total = REGISTRY.register(Counter(
+    'admission_rejections_total', 'Requests rejected by admission control.', ('reason',)))
+
+
+class RateLimiter:
+    # token bucketと同じ判定をGCRAで行う。キーごとに「次のリクエストが理論上届く時刻」の1つの値だけを持つ
+    # rate: 1秒あたりに補充するトークン数, burst: バケットの大きさ
+    # 状態は2世代のdictに入れ、一定時間か一定数ごとに古い世代を捨てる (キーが何百万種類あってもmax_keys件まで)
+    # 捨てた世代の値は、時間で入れ替えた場合は必ず期限切れになっている
+    def __init__(self, rate: float, burst: int, max_keys: int = 100_000, clock=time.monotonic):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+        # 値が今より前になった(バケットが満タンに戻った)キーは持たなくてよい
+        self.ttl = self.tolerance + self.interval
+        self.max_keys = max_keys
+        self.clock = clock
+        self._current = {}
+        self._previous = {}
+        self._rotated_at = clock()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def _rotate(self, now: float):
+        self._previous, self._current = self._current, {}
+        self._rotated_at = now
+
+    def acquire(self, key) -> float:
+        # 通せるなら0、通せないなら何秒後に通せるかを返す
+        now = self.clock()
+        # 文字列のキーを残さないよう、ハッシュ値だけを持つ
+        slot = hash(key)
+        with self._lock:
+            if now - self._rotated_at >= self.ttl or len(self._current) >= self.max_keys // 2:
+                self._rotate(now)
+            tat = self._current.get(slot)
+            if tat is None:
+                tat = self._previous.get(slot, now)
+            tat = max(tat, now)
+            if tat - now > self.tolerance:
+                return tat - now - self.tolerance
+            self._current[slot] = tat + self.interval
+            return 0.0
+
+
+class ConcurrencyLimiter:
+    # limitが0なら制限しない
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit) if limit else None
+
+    def try_acquire(self):
+        return self._semaphore is None or self._semaphore.acquire(blocking=False)
+
+    def release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+
+class Admission:
+    # limiterがNoneならその制限はかけない
+    def __init__(self, uuid_limiter: Optional[RateLimiter], ip_limiter: Optional[RateLimiter],
+                 in_flight: ConcurrencyLimiter):
+        self.uuid_limiter = uuid_limiter
+        self.ip_limiter = ip_limiter
+        self.in_flight = in_flight
+
+    def admit(self, user_uuid: Optional[str], ip: Optional[str], hold_slot: bool = True):
+        # 通せなければTooManyRequestsExceptionを投げる
+        # hold_slotがTrueで通した場合は、処理が終わったらrelease()を呼ぶこと
+        for reason, limiter, key in (('uuid', self.uuid_limiter, user_uuid), ('ip', self.ip_limiter, ip)):
+            if limiter is None or key is None:
+                continue
+            retry_after = limiter.acquire(key)
+            if retry_after > 0:
+                admission_rejections_total.inc(reason)
+                raise TooManyRequestsException(max(1, math.ceil(retry_after)))
+        if hold_slot and not self.in_flight.try_acquire():
+            admission_rejections_total.inc('in_flight')
+            raise TooManyRequestsException(IN_FLIGHT_RETRY_AFTER)
+
+    def release(self):
+        self.in_flight.release()
+
+
+def create_admission(uuid_rate: float, uuid_burst: int, ip_rate: float, ip_burst: int, max_keys: int,
+                     max_in_flight: int):
+    return Admission(RateLimiter(uuid_rate, uuid_burst, max_keys) if uuid_rate > 0 else None,
+                     RateLimiter(ip_rate, ip_burst, max_keys) if ip_rate > 0 else None,
+                     ConcurrencyLimiter(max_in_flight))
+
+
+def client_ip(access_route: List[str], remote_addr: Optional[str], trusted_proxies: int):
+    # X-Forwarded-Forはクライアントが自由に書けるので、信頼できるプロキシが付けた分だけを後ろから数える
+    if trusted_proxies and len(access_route) >= trusted_proxies:
+        return access_route[-trusted_proxies]
+    return remote_addr
@@ -0,0 +1,117 @@
+import hashlib
+from typing import Dict
+
+from titles import canonical_url
+
+# game-resultsから作る集計。record_game_resultで1ゲームずつ加算し、バックフィルではまとめて作り直す
+# stats/global
+# {
+#     'games': int, 'players': int, 'finishedPlayers': int, 'surrenderedPlayers': int, 'clicks': int,
+#     'pathLengths': {'3': int, ...},  # ゴールしたプレイヤーのクリック数の分布 (PATH_LENGTH_MAX以上はまとめる)
+#     'surrenderRates': {'0': int, '10': int, ..., '100': int}  # ゲームごとの降参率(%)の分布
+# }
+# stats-pairs/{pair_id(start, goal)}
+# {'start': str, 'goal': str, 'bestClicks': int, 'shortestDistance': int, 上と同じカウンタ}
+# stats-articles/{article_id(url)}
+# {'url': str, 'visits': int}  # 経路の途中で開かれた回数 (1つの経路では1回と数える)
+# 結果のurlsはstartとgoalの間に開いた記事だけ (validation.validate_urlsと同じ)。クリック数はlen(urls) + 1
+GLOBAL_STATS_COLLECTION = 'stats'
+GLOBAL_STATS_DOCUMENT = 'global'
+PAIR_STATS_COLLECTION = 'stats-pairs'
+ARTICLE_STATS_COLLECTION = 'stats-articles'
+PATH_LENGTH_MAX = 20
+SURRENDER_RATE_STEP = 10  # %
+COUNTERS = ('games', 'players', 'finishedPlayers', 'surrenderedPlayers', 'clicks')
+
+
+def _key(url: str):
+    return canonical_url(url) or url
+
+
+def _hash(value: str):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def pair_id(start: str, goal: str):
+    return _hash(f'{_key(start)} {_key(goal)}')
+
+
+def article_id(url: str):
+    return _hash(_key(url))
+
+
+def summarize_game(data: Dict):
+    # デコード済みのgame-resultから、集計に加える値を作る
+    start, goal = data.get('start') or '', data.get('goal') or ''
+    summary = {'start': start, 'goal': goal, 'games': 1, 'players': 0, 'finishedPlayers': 0,
+               'surrenderedPlayers': 0, 'clicks': 0, 'bestClicks': None, 'pathLengths': {}, 'surrenderRates': {},
+               'shortestDistance': data.get('shortestDistance'), 'articles': {}}
+    for result in data.get('results') or []:
+        summary['players'] += 1
+        urls = result.get('urls') or []
+        if result.get('isSurrendered'):
+            summary['surrenderedPlayers'] += 1
+            continue
+        # 検証でゴールまで辿れないと分かった経路は数えない (urlsが空なのはstartから直接goalに行った経路)
+        if (result.get('validation') or {}).get('isValid') is False:
+            continue
+        clicks = len(urls) + 1
+        summary['finishedPlayers'] += 1
+        summary['clicks'] += clicks
+        if summary['bestClicks'] is None or clicks < summary['bestClicks']:
+            summary['bestClicks'] = clicks
+        bucket = str(min(clicks, PATH_LENGTH_MAX))
+        summary['pathLengths'][bucket] = summary['pathLengths'].get(bucket, 0) + 1
+        for key in {_key(url) for url in urls}:
+            summary['articles'][key] = summary['articles'].get(key, 0) + 1
+    if summary['players']:
+        rate = summary['surrenderedPlayers'] * 100 // summary['players']
+        summary['surrenderRates'][str(rate - rate % SURRENDER_RATE_STEP)] = 1
+    return summary
+
+
+def _add_counters(target: Dict, summary: Dict):
+    for counter in COUNTERS:
+        target[counter] = target.get(counter, 0) + summary[counter]
+    for histogram in ('pathLengths', 'surrenderRates'):
+        buckets = target.setdefault(histogram, {})
+        for bucket, value in summary[histogram].items():
+            buckets[bucket] = buckets.get(bucket, 0) + value
+
+
+class Aggregates:
+    # バックフィル用に、全ゲームの集計をメモリ上で作る
+    def __init__(self):
+        self.global_stats = {}
+        self.pairs = {}
+        self.articles = {}
+
+    def add(self, summary: Dict):
+        _add_counters(self.global_stats, summary)
+        pair = self.pairs.setdefault(pair_id(summary['start'], summary['goal']),
+                                     {'start': summary['start'], 'goal': summary['goal']})
+        _add_counters(pair, summary)
+        if summary['bestClicks'] is not None and summary['bestClicks'] < pair.get('bestClicks', float('inf')):
+            pair['bestClicks'] = summary['bestClicks']
+        if summary['shortestDistance'] is not None:
+            pair['shortestDistance'] = summary['shortestDistance']
+        for url, visits in summary['articles'].items():
+            article = self.articles.setdefault(article_id(url), {'url': url, 'visits': 0})
+            article['visits'] += visits
+
+    def documents(self):
+        # (コレクション, ドキュメントID, データ)
+        yield GLOBAL_STATS_COLLECTION, GLOBAL_STATS_DOCUMENT, self.global_stats
+        for doc_id, pair in self.pairs.items():
+            yield PAIR_STATS_COLLECTION, doc_id, pair
+        for doc_id, article in self.articles.items():
+            yield ARTICLE_STATS_COLLECTION, doc_id, article
+
+
+def with_rates(stats: Dict):
+    # 読み出し用に平均クリック数と降参率を付ける
+    stats = dict(stats)
+    finished, players = stats.get('finishedPlayers', 0), stats.get('players', 0)
+    stats['averageClicks'] = stats.get('clicks', 0) / finished if finished else None
+    stats['surrenderRate'] = stats.get('surrenderedPlayers', 0) / players if players else None
+    return stats
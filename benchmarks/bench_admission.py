@@ -0,0 +1,46 @@
+# レート制限のベンチマーク
+# 大量の異なるキー(uuid/IP)で呼んだときの判定の速さと、制限の状態が使うメモリを測る
+# python -m benchmarks.bench_admission --keys 1000000 --max-keys 100000
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+from admission import RateLimiter
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=1_000_000, help='異なるキーの数')
+    parser.add_argument('--max-keys', type=int, default=100_000)
+    parser.add_argument('--rate', type=float, default=5)
+    parser.add_argument('--burst', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    keys = [f'203.0.{idx >> 8 & 0xFF}.{idx & 0xFF}-{idx}' for idx in range(args.keys)]
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    limiter = RateLimiter(args.rate, args.burst, args.max_keys)
+    started = time.perf_counter()
+    rejected = 0
+    for key in keys:
+        rejected += limiter.acquire(key) > 0
+    elapsed = time.perf_counter() - started
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(json.dumps({
+        'config': vars(args),
+        'seconds': round(elapsed, 4),
+        'acquires_per_second': round(args.keys / elapsed, 2),
+        'rejected': rejected,
+        'stored_keys': len(limiter),
+        'memory_bytes': memory - baseline,
+        'peak_memory_bytes': peak - baseline,
+        'bytes_per_stored_key': round((memory - baseline) / max(len(limiter), 1), 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,172 @@
+# roomのライフサイクル全体の負荷ベンチマーク
+# RTDB / Firestore / Wikipediaはインメモリ実装に差し替え、それぞれに遅延を入れて実行する
+# python -m benchmarks.bench_lifecycle --rooms 50 --players 4 --rtdb-latency 0.02 --output result.json
+# python -m benchmarks.bench_lifecycle --baseline result.json  (p95/スループットが悪化したら終了コード1)
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from statistics import quantiles
+from concurrent.futures import ThreadPoolExecutor
+
+import inmemory
+
+WIKIPEDIA_GRAPH = {
+    'Start': ['Middle', 'Other'],
+    'Middle': ['Goal', 'Start'],
+    'Other': ['Start'],
+    'Goal': ['Start'],
+}
+FINALIZE_TIMEOUT = 10  # 秒
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+class LifecycleBenchmark:
+    def __init__(self, rtdb_latency: float, firestore_latency: float, wikipedia_latency: float):
+        # confはinstall()の中で読み込まれるので、環境変数はその前に設定する
+        os.environ.setdefault('LOG_SINK', os.devnull)
+        # 全員が同じIPから同時に呼ぶので、受け付け制御は外して測る
+        for name in ('RATE_LIMIT_UUID_RATE', 'RATE_LIMIT_IP_RATE', 'MAX_IN_FLIGHT'):
+            os.environ.setdefault(name, '0')
+        self.rtdb = inmemory.InMemoryRTDB(latency=rtdb_latency)
+        self.firestore = inmemory.InMemoryFirestore(latency=firestore_latency)
+        self.wikipedia = inmemory.FakeWikipedia(WIKIPEDIA_GRAPH, latency=wikipedia_latency)
+        inmemory.install(self.rtdb, self.firestore, self.wikipedia)
+        import main
+        self.app = main.app
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def call(self, client, method: str, path: str, body: dict):
+        self.rtdb.stats.thread_calls()
+        self.firestore.stats.thread_calls()
+        started = time.perf_counter()
+        res = client.open(path, method=method, json=body)
+        elapsed = time.perf_counter() - started
+        backend_calls = self.rtdb.stats.thread_calls() + self.firestore.stats.thread_calls()
+        with self._lock:
+            self.samples.append((f'{method} {path}', res.status_code, elapsed, backend_calls))
+        return res
+
+    def finish_player(self, room_id: int, player_uuid: str):
+        client = self.app.test_client()
+        self.call(client, 'POST', '/room/player-progress', {
+            'room_id': room_id, 'uuid': player_uuid, 'name': player_uuid, 'is_done': True, 'is_surrendered': False,
+            'urls': [self.wikipedia.url('Middle')]
+        })
+
+    def run_room(self, players: int):
+        client = self.app.test_client()
+        host = str(uuid.uuid4())
+        room_id = self.call(client, 'POST', '/room', {'uuid': host, 'name': host}).get_json().get('room_id')
+        if room_id is None:
+            return
+        player_uuids = [host] + [str(uuid.uuid4()) for _ in range(players - 1)]
+        for player_uuid in player_uuids[1:]:
+            self.call(client, 'POST', '/room/join', {'room_id': room_id, 'uuid': player_uuid, 'name': player_uuid})
+        self.call(client, 'POST', '/room/articles',
+                  {'room_id': room_id, 'target': 'start', 'url': self.wikipedia.url('Start')})
+        self.call(client, 'POST', '/room/articles',
+                  {'room_id': room_id, 'target': 'goal', 'url': self.wikipedia.url('Goal')})
+        self.call(client, 'POST', '/room/start', {'room_id': room_id, 'uuid': host})
+        # 全員がほぼ同時にゴールする
+        with ThreadPoolExecutor(max_workers=players) as executor:
+            for future in [executor.submit(self.finish_player, room_id, u) for u in player_uuids]:
+                future.result()
+        # クライアントと同じく、roomがENDEDになるのを待ってから削除する
+        deadline = time.monotonic() + FINALIZE_TIMEOUT
+        while self.rtdb.peek(f'{room_id}/status') != 'ENDED' and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.call(client, 'DELETE', '/room', {'room_id': room_id, 'uuid': host})
+
+    def run(self, rooms: int, players: int, concurrency: int):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(self.run_room, players) for _ in range(rooms)]:
+                future.result()
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float, config: dict):
+        routes = {}
+        for route, status, seconds, backend_calls in self.samples:
+            routes.setdefault(route, []).append((status, seconds, backend_calls))
+        return {
+            'config': config,
+            'requests': len(self.samples),
+            'seconds': round(elapsed, 4),
+            'throughput_rps': round(len(self.samples) / elapsed, 2),
+            'backend_calls': {
+                'rtdb': self.rtdb.stats.calls,
+                'firestore': self.firestore.stats.calls,
+                'wikipedia': self.wikipedia.stats.calls,
+                'per_request': round((self.rtdb.stats.calls + self.firestore.stats.calls) / len(self.samples), 3),
+            },
+            'routes': {
+                route: {
+                    'count': len(values),
+                    'errors': sum(status >= 400 for status, _, _ in values),
+                    'p50_ms': round(percentile([s for _, s, _ in values], 50) * 1000, 3),
+                    'p95_ms': round(percentile([s for _, s, _ in values], 95) * 1000, 3),
+                    'p99_ms': round(percentile([s for _, s, _ in values], 99) * 1000, 3),
+                    # リクエストを処理したスレッドでの呼び出し数 (並列のbatch commitなどは含まない)
+                    'backend_calls_mean': round(sum(c for _, _, c in values) / len(values), 3),
+                } for route, values in sorted(routes.items())
+            }
+        }
+
+
+def compare(result: dict, baseline: dict, tolerance: float):
+    regressions = []
+    if result['throughput_rps'] < baseline['throughput_rps'] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput_rps']} -> {result['throughput_rps']} rps")
+    for route, stats in result['routes'].items():
+        base = baseline['routes'].get(route)
+        if base and stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{route} p95 {base['p95_ms']} -> {stats['p95_ms']} ms")
+        if base and stats['backend_calls_mean'] > base['backend_calls_mean']:
+            regressions.append(f"{route} backend calls {base['backend_calls_mean']} -> {stats['backend_calls_mean']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=10, help='同時に進行するroomの数')
+    parser.add_argument('--rtdb-latency', type=float, default=0.01)
+    parser.add_argument('--firestore-latency', type=float, default=0.01)
+    parser.add_argument('--wikipedia-latency', type=float, default=0.05)
+    parser.add_argument('--output', help='結果のJSONを書き出すファイル')
+    parser.add_argument('--baseline', help='比較する過去の結果のJSON')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    bench = LifecycleBenchmark(args.rtdb_latency, args.firestore_latency, args.wikipedia_latency)
+    elapsed = bench.run(args.rooms, args.players, args.concurrency)
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+    result = bench.report(elapsed, config)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
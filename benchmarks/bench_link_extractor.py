@@ -0,0 +1,108 @@
+# 保存済みのWikipediaページに対して、BeautifulSoupでの全体パースとストリーミング抽出を比較する
+# python -m benchmarks.bench_link_extractor CORPUS_DIR [--download URL ...] [--repeat N]
+# BeautifulSoupはrequirements-bench.txtで入れる
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+import requests
+from bs4 import BeautifulSoup
+
+from link_extractor import extract_article_links, iter_article_links, contains_article_link
+
+CHUNK_SIZE = 16 * 1024
+
+
+def chunked(text: str, size: int = CHUNK_SIZE):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def bs4_find_all(html: str, href: str):
+    # 変更前のvalidate_urlと同じ処理
+    soup = BeautifulSoup(html, 'html.parser')
+    return bool(soup.find_all(href=[href]))
+
+
+def bs4_link_set(html: str, href: str):
+    soup = BeautifulSoup(html, 'html.parser')
+    return {a['href'] for a in soup.find_all(href=True) if a['href'].startswith('/wiki/')}
+
+
+def stream_link_set(html: str, href: str):
+    return extract_article_links(chunked(html))
+
+
+def stream_contains(html: str, href: str):
+    return contains_article_link(chunked(html), href)
+
+
+METHODS = {
+    'bs4_find_all': bs4_find_all,
+    'bs4_link_set': bs4_link_set,
+    'stream_link_set': stream_link_set,
+    'stream_contains': stream_contains,
+}
+
+
+def synthetic_page(n_links: int = 3000):
+    nav = ''.join(f'<li><a href="/wiki/Nav_{i}">nav</a></li>' for i in range(200))
+    body = ''.join(f'<p>text <a href="/wiki/Article_{i}" title="Article {i}">Article {i}</a> '
+                   f'<a href="#cite_note-{i}">[{i}]</a></p>' for i in range(n_links))
+    return (f'<html><body><div id="mw-navigation"><ul>{nav}</ul></div>'
+            f'<div id="mw-content-text"><div class="mw-parser-output">{body}</div></div>'
+            f'<div id="footer">{nav}</div></body></html>')
+
+
+def download(corpus: Path, urls):
+    corpus.mkdir(parents=True, exist_ok=True)
+    for url in urls:
+        name = unquote(urlsplit(url).path.rsplit('/', 1)[-1]) or 'index'
+        (corpus / f'{name}.html').write_text(requests.get(url, timeout=30).text, encoding='utf-8')
+        time.sleep(1)
+
+
+def measure(method, html: str, href: str, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        method(html, href)
+    elapsed = (time.perf_counter() - started) / repeat
+    tracemalloc.start()
+    method(html, href)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpus', nargs='?', help='保存済みページ(*.html)のディレクトリ')
+    parser.add_argument('--download', nargs='*', default=[], help='コーパスに保存するページのURL')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    pages = {}
+    if args.corpus:
+        corpus = Path(args.corpus)
+        if args.download:
+            download(corpus, args.download)
+        pages = {p.name: p.read_text(encoding='utf-8') for p in sorted(corpus.glob('*.html'))}
+    if not pages:
+        pages = {'synthetic': synthetic_page()}
+
+    for name, html in pages.items():
+        links = list(iter_article_links(chunked(html)))
+        # 早期終了の効果が見えるよう、本文の最初のほうにあるリンクを対象にする
+        href = links[len(links) // 10] if links else '/wiki/Missing'
+        for method_name, method in METHODS.items():
+            elapsed, peak = measure(method, html, href, args.repeat)
+            print(json.dumps({'page': name, 'bytes': len(html.encode('utf-8')), 'method': method_name,
+                              'ms': round(elapsed * 1000, 2), 'peak_kib': round(peak / 1024, 1)},
+                             ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
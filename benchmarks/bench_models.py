@@ -0,0 +1,95 @@
+# models.pyのベンチマーク
+# 大きなroomでの、RTDB/Firestoreの形との変換にかかる時間と確保するメモリ、1人の更新で書くパッチの大きさを測る
+# python -m benchmarks.bench_models --players 1000 --urls 30
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+from models import Room, Progress, GameResult
+
+BASE_URL = 'https://ja.wikipedia.org/wiki/'
+
+
+def make_room(players: int):
+    users = {f'uuid-{idx:06d}': {'name': f'player{idx}', 'isDone': idx % 2 == 0, 'isSurrendered': False}
+             for idx in range(players)}
+    return {'isReady': False, 'status': 'ONGOING', 'host': 'uuid-000000', 'users': users,
+            'start': BASE_URL + 'Start', 'goal': BASE_URL + 'Goal', 'startedAt': 1700000000000}
+
+
+def make_progresses(players: int, urls: int):
+    return [Progress(f'uuid-{idx:06d}', f'player{idx}',
+                     [f'{BASE_URL}Article_{(idx + step) % 500}' for step in range(urls)], False, None)
+            for idx in range(players)]
+
+
+def per_op_us(f, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return round((time.perf_counter() - started) / repeat * 1e6, 2)
+
+
+def retained_bytes(f):
+    # f()が返すオブジェクトが保持しているメモリと、作る途中のピーク
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = f()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del value
+    return current - before, peak - before
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--urls', type=int, default=30, help='1人あたりの経路の長さ')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    data = make_room(args.players)
+    room = Room.from_rtdb(data)
+    player_uuid = f'uuid-{args.players - 1:06d}'
+    # rooms.change_player_progressは1人の2項目だけをmulti-path updateで書く
+    player_patch = {f'users/{player_uuid}/isDone': True, f'users/{player_uuid}/isSurrendered': False}
+
+    progresses = make_progresses(args.players, args.urls)
+    result = GameResult(data['start'], data['goal'], progresses, None, 3, data['startedAt'])
+    encoded_result = result.to_firestore()
+    encoded_progress = progresses[0].to_firestore()
+
+    # RTDBから読んだ直後の形 (dict) のまま持つ場合と、Roomにして元のdictを捨てる場合
+    wire = json.dumps(data)
+    dict_bytes, _ = retained_bytes(lambda: json.loads(wire))
+    room_bytes, room_peak = retained_bytes(lambda: Room.from_rtdb(json.loads(wire)))
+    result_bytes, result_peak = retained_bytes(lambda: GameResult.from_firestore(encoded_result))
+
+    print(json.dumps({
+        'config': vars(args),
+        'room': {
+            'from_rtdb_us': per_op_us(lambda: Room.from_rtdb(data), args.repeat),
+            'to_rtdb_us': per_op_us(room.to_rtdb, args.repeat),
+            'bytes': room_bytes,
+            'peak_bytes': room_peak,
+            'dict_bytes': dict_bytes,
+            'player_patch_json_bytes': len(json.dumps(player_patch)),
+            'whole_node_json_bytes': len(json.dumps(data)),
+        },
+        'progress': {
+            'to_firestore_us': per_op_us(progresses[0].to_firestore, args.repeat * 10),
+            'from_firestore_us': per_op_us(lambda: Progress.from_firestore('uuid', encoded_progress), args.repeat * 10),
+        },
+        'game_result': {
+            'to_firestore_us': per_op_us(result.to_firestore, max(1, args.repeat // 5)),
+            'from_firestore_us': per_op_us(lambda: GameResult.from_firestore(encoded_result), max(1, args.repeat // 5)),
+            'bytes': result_bytes,
+            'peak_bytes': result_peak,
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
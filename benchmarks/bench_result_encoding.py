@@ -0,0 +1,75 @@
+# game-results / progressのドキュメントサイズを、URLのまま保存する形式と圧縮形式で比較する
+# python -m benchmarks.bench_result_encoding [--players 2 4 8 16] [--hops 6] [--rooms 200]
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+from urllib.parse import quote
+
+from path_codec import encode_game_result, decode_game_result, encode_progress, document_size
+
+BASE_URL = 'https://ja.wikipedia.org/wiki/'
+# 経路によく出てくる記事
+HUB_TITLES = ['日本', 'アメリカ合衆国', '東京都', '第二次世界大戦', 'イギリス', 'フランス', '中華人民共和国', 'ドイツ',
+              '英語', '日本語', '地球', '太陽系', '人間', '生物', '物理学', '化学', '数学', '哲学', '歴史', '文化',
+              'インターネット', 'コンピュータ', '20世紀', '21世紀', '国際連合', 'ヨーロッパ', 'アジア', '経済',
+              'テレビ', '音楽', '映画', 'スポーツ', 'サッカー', '野球', '宗教', '言語', '科学', '技術', '政治', '法律']
+KANJI = '山川田中本木林森石金水火土日月人口目耳手足空海島国語学者文化史電気光音楽道'
+
+
+def random_title(rng: random.Random):
+    title = ''.join(rng.choice(KANJI) for _ in range(rng.randint(2, 7)))
+    return title if rng.random() < 0.8 else f'{title}_({rng.choice(HUB_TITLES)})'
+
+
+def random_path(rng: random.Random, hops: int):
+    # 半分くらいは主要な記事を経由する
+    return [BASE_URL + quote(rng.choice(HUB_TITLES) if rng.random() < 0.5 else random_title(rng))
+            for _ in range(rng.randint(max(1, hops - 3), hops + 3))]
+
+
+def game_result(rng: random.Random, players: int, hops: int):
+    return {
+        'createAt': datetime.now(),
+        'start': BASE_URL + quote(random_title(rng)),
+        'goal': BASE_URL + quote(random_title(rng)),
+        'results': [{'uuid': f'{i:08d}-0000-4000-8000-000000000000', 'name': f'player{i}',
+                     'urls': random_path(rng, hops), 'isSurrendered': False,
+                     'validation': {'isValid': True, 'message': None}} for i in range(players)]
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, nargs='*', default=[2, 4, 8, 16])
+    parser.add_argument('--hops', type=int, default=6)
+    parser.add_argument('--rooms', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    for players in args.players:
+        results = [game_result(rng, players, args.hops) for _ in range(args.rooms)]
+        started = time.perf_counter()
+        encoded = [encode_game_result(result) for result in results]
+        encode_ms = (time.perf_counter() - started) * 1000 / len(results)
+        started = time.perf_counter()
+        assert [decode_game_result(e) for e in encoded] == results
+        decode_ms = (time.perf_counter() - started) * 1000 / len(results)
+        before = sum(document_size(r) for r in results) / len(results)
+        after = sum(document_size(e) for e in encoded) / len(encoded)
+        progress_before = sum(document_size(p) for r in results for p in r['results'])
+        progress_after = sum(document_size(encode_progress(p)) for r in results for p in r['results'])
+        print(json.dumps({
+            'players': players,
+            'result_bytes': round(before), 'result_compact_bytes': round(after),
+            'result_reduction': round(1 - after / before, 3),
+            'progress_reduction': round(1 - progress_after / progress_before, 3),
+            'encode_ms': round(encode_ms, 3), 'decode_ms': round(decode_ms, 3),
+        }))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+# roomのイベント配信(SSE)のベンチマーク
+# 1インスタンスにN人の購読者をつなぎ、roomへの書き込みから全員に届くまでの時間とメモリを測る
+# RTDBはインメモリ実装に差し替える (リスナーの通知は書き込んだスレッドから届く)
+# main.pyと同じく、購読者ごとにスレッドを1つ使う
+# python -m benchmarks.bench_room_events --subscribers 1000 --rooms 10 --events 50
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import tracemalloc
+from statistics import quantiles
+
+import inmemory
+
+ROOM_ID_BASE = 50000
+WRITE_INTERVAL = 0.005  # 秒
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+def _version(message: str):
+    if not message.startswith('id: '):
+        return None
+    return int(message.split('\n', 1)[0].rsplit('.', 1)[1])
+
+
+class RoomEventsBenchmark:
+    def __init__(self, rooms: int, events: int):
+        self.rtdb = inmemory.InMemoryRTDB()
+        inmemory.install(self.rtdb)
+        os.environ.setdefault('LOG_SINK', os.devnull)
+        import rooms as rooms_module
+        import room_events
+        self.rooms_module = rooms_module
+        self.room_events = room_events
+        self.room_ids = [ROOM_ID_BASE + idx for idx in range(rooms)]
+        self.events = events
+        # (room id, バージョン) -> 書き込んだ時刻
+        self.written = {}
+        # 受け取った時刻 - 書き込んだ時刻
+        self.latencies = []
+        self.delivered = 0
+        self._lock = threading.Lock()
+        for room_id in self.room_ids:
+            rooms_module.init_room(room_id, 'host', 'host')
+
+    def receive(self, room_id: int, message: str):
+        version = _version(message)
+        written = self.written.get((room_id, version))
+        if written is not None:
+            latency = time.perf_counter() - written
+            with self._lock:
+                self.latencies.append(latency)
+                self.delivered += 1
+
+    def write(self):
+        # 各roomに1人ずつ参加させる (1回の書き込みで1イベント)
+        for idx in range(self.events):
+            for version_room in self.room_ids:
+                self.written[(version_room, idx + 1)] = time.perf_counter()
+                self.rooms_module._join_room(version_room, f'player{idx}', f'player{idx}')
+            time.sleep(WRITE_INTERVAL)
+        for room_id in self.room_ids:
+            self.rooms_module._destroy_room(room_id)
+
+    def run_threads(self, subscribers: int):
+        def subscriber(room_id: int):
+            feed = self.room_events.subscribe(room_id)
+            for message in self.room_events.stream(feed):
+                self.receive(room_id, message)
+
+        threads = [threading.Thread(target=subscriber, args=(self.room_ids[idx % len(self.room_ids)],))
+                   for idx in range(subscribers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        started = time.perf_counter()
+        self.write()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started, memory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--events', type=int, default=50, help='roomごとの書き込み回数')
+    args = parser.parse_args(argv)
+
+    tracemalloc.start()
+    bench = RoomEventsBenchmark(args.rooms, args.events)
+    baseline_memory = tracemalloc.get_traced_memory()[0]
+    rtdb_calls_before = bench.rtdb.stats.calls
+    elapsed, memory = bench.run_threads(args.subscribers)
+
+    expected = args.subscribers * args.events
+    print(json.dumps({
+        'config': vars(args),
+        'seconds': round(elapsed, 4),
+        'delivered': bench.delivered,
+        'expected': expected,
+        'events_per_second': round(bench.delivered / elapsed, 2),
+        'latency_ms': {
+            'p50': round(percentile(bench.latencies, 50) * 1000, 3),
+            'p95': round(percentile(bench.latencies, 95) * 1000, 3),
+            'p99': round(percentile(bench.latencies, 99) * 1000, 3),
+        },
+        # 購読者をつないだ後の増加分 (フィードとストリームの状態)
+        'memory_per_subscriber_bytes': round((memory - baseline_memory) / args.subscribers),
+        # 書き込み・roomの存在確認と、roomごとのリスナー1つだけ (購読者数によらない)
+        'rtdb_calls': bench.rtdb.stats.calls - rtdb_calls_before,
+        'listeners': args.rooms,
+    }, indent=2))
+    if bench.delivered != expected:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
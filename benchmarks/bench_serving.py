@@ -0,0 +1,85 @@
+# サーバーの負荷試験。roomの作成・参加・削除を並列に繰り返す
+# gunicornの設定(ワーカーの種類・WSGI_THREADS)ごとにサーバーを起動し、同じ引数で実行して結果を比べる
+# python -m benchmarks.bench_serving http://localhost:8000 --concurrency 100 --rooms 200
+#
+# 結果の例 (1 vCPU、inmemoryのRTDB/Firestoreで各呼び出しに20msの遅延、--concurrency 50 --rooms 100 --players 3)
+#   gthread (WSGI_THREADS=48, 既定)   332 req/s  p50 100-121ms  p95 211-236ms
+import sys
+import json
+import time
+import uuid
+import argparse
+from statistics import quantiles
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(latencies, p):
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0
+    return quantiles(latencies, n=100)[p - 1]
+
+
+def run_room(session: requests.Session, base_url: str, players: int):
+    # roomを作成し、playerを参加させて削除する
+    latencies = []
+
+    def post(method, path, body):
+        started = time.perf_counter()
+        res = session.request(method, base_url + path, json=body, timeout=60)
+        latencies.append((path, method, res.status_code, time.perf_counter() - started))
+        return res
+
+    host = str(uuid.uuid4())
+    room_id = post('POST', '/room', {'uuid': host, 'name': 'host'}).json().get('room_id')
+    if room_id is None:
+        return latencies
+    for idx in range(players):
+        post('POST', '/room/join', {'room_id': room_id, 'uuid': str(uuid.uuid4()), 'name': f'player{idx}'})
+    post('DELETE', '/room', {'room_id': room_id, 'uuid': host})
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base_url')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--players', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    session = requests.Session()
+    session.mount('http', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_room, session, args.base_url.rstrip('/'), args.players)
+                   for _ in range(args.rooms)]
+        results = [latency for future in futures for latency in future.result()]
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for path, method, status, latency in results:
+        route = routes.setdefault(f'{method} {path}', {'latencies': [], 'errors': 0})
+        route['latencies'].append(latency)
+        route['errors'] += status >= 400
+    print(json.dumps({
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'requests': len(results),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(results) / elapsed, 1),
+        'routes': {
+            name: {
+                'count': len(route['latencies']),
+                'errors': route['errors'],
+                'p50_ms': round(percentile(route['latencies'], 50) * 1000, 1),
+                'p95_ms': round(percentile(route['latencies'], 95) * 1000, 1),
+                'p99_ms': round(percentile(route['latencies'], 99) * 1000, 1),
+            } for name, route in routes.items()
+        }
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+# 6クリック離れたstart/goalの組で、片方向BFSと双方向BFSの時間・メモリを比較する
+# python -m benchmarks.bench_shortest_path [--index links.idx] [--titles 200000] [--degree 6] [--pairs 5]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from collections import deque
+
+from link_index import LinkIndex, write_index
+from shortest_path import IndexLinkGraph, bidirectional_search
+
+DISTANCE = 6
+
+
+def synthetic_graph(n_titles: int, degree: int, seed: int):
+    rng = random.Random(seed)
+    titles = [f'Article_{i}' for i in range(n_titles)]
+    return {title: {titles[rng.randrange(n_titles)] for _ in range(degree)} for title in titles}
+
+
+def forward_search(graph: IndexLinkGraph, start: str, goal: str):
+    # 比較用の片方向BFS
+    source, target = graph.node(start), graph.node(goal)
+    parents = {source: None}
+    queue = deque([source])
+    while queue:
+        node = queue.popleft()
+        for _, neighbors in graph.expand([node], True):
+            for neighbor in neighbors:
+                if neighbor in parents:
+                    continue
+                parents[neighbor] = node
+                if neighbor == target:
+                    path = [neighbor]
+                    while parents[path[-1]] is not None:
+                        path.append(parents[path[-1]])
+                    return {'distance': len(path) - 1, 'visited': len(parents)}
+                queue.append(neighbor)
+    return {'distance': None, 'visited': len(parents)}
+
+
+def find_pairs(index: LinkIndex, n_pairs: int, seed: int):
+    # startからちょうどDISTANCEクリックのgoalを選ぶ
+    rng = random.Random(seed)
+    pairs = []
+    while len(pairs) < n_pairs:
+        source = rng.randrange(index.n_titles)
+        depths = {source: 0}
+        frontier = [source]
+        for depth in range(1, DISTANCE + 1):
+            next_frontier = []
+            for node in frontier:
+                for neighbor in index.links(node):
+                    if neighbor not in depths:
+                        depths[neighbor] = depth
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        if frontier:
+            pairs.append((index.title(source), index.title(rng.choice(frontier))))
+    return pairs
+
+
+def measure(search, *args):
+    started = time.perf_counter()
+    search(*args)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    result = search(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', help='リンクインデックス (指定しなければ合成グラフを作る)')
+    parser.add_argument('--titles', type=int, default=200000)
+    parser.add_argument('--degree', type=int, default=6)
+    parser.add_argument('--pairs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    path = args.index
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.idx')
+        os.close(fd)
+        write_index(path, synthetic_graph(args.titles, args.degree, args.seed))
+    index = LinkIndex.open(path)
+    try:
+        graph = IndexLinkGraph(index)
+        for start, goal in find_pairs(index, args.pairs, args.seed):
+            for method, search in (('forward', forward_search), ('bidirectional', bidirectional_search)):
+                result, elapsed, peak = measure(search, graph, start, goal)
+                print(json.dumps({'start': start, 'goal': goal, 'method': method, 'distance': result['distance'],
+                                  'visited': result['visited'], 'ms': round(elapsed * 1000, 2),
+                                  'peak_kib': round(peak / 1024, 1)}, ensure_ascii=False))
+    finally:
+        index.close()
+        if args.index is None:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,22 +1,67 @@
 import os
+import threading
 
-import firebase_admin
-from firebase_admin import credentials, firestore
-from google.cloud import logging_v2
-
-logging_client = logging_v2.Client()
+# firebase_adminとgoogle.cloudは読み込むだけで時間がかかるので、このモジュールでは読み込まない
+# クライアントは最初に使うときに作る (コールドスタートで最初のリクエストを待たせない)
 labels = {
     "configuration_name": "wikipedia-game",
     "service_name": "wikipedia-game"
 }
-resource = logging_v2.resource.Resource(type="cloud_run_revision", labels=labels)
-
-logger = logging_client.logger(__name__)
+# Cloud Loggingのリソース。google.cloud.logging_v2のResourceへは書き込むときに変換する
+resource = {'type': 'cloud_run_revision', 'labels': labels}
 
 MIN_ROOM_ID = 10000
 MAX_ROOM_ID = 99999
+# 1インスタンスがまとめて確保するroom idの数
+ROOM_ID_BLOCK_SIZE = int(os.getenv('ROOM_ID_BLOCK_SIZE', 20))
 FIREBASE_CRED_PATH = os.getenv('FIREBASE_CRED_PATH')
 RTDB_URL = os.getenv('RTDB_URL')
+# roomを振り分けるRTDBのURL (カンマ区切り)。未設定ならRTDB_URLだけを使う
+# 先頭はRTDB_URLと同じにし、増やすときは末尾に追加して manage.py rebalance-shards でroomを移す
+RTDB_SHARD_URLS = [url for url in os.getenv('RTDB_SHARD_URLS', '').split(',') if url] or [RTDB_URL]
+LINK_INDEX_PATH = os.getenv('LINK_INDEX_PATH')
+# 記事が設定されたときに先読みする、startのページからのリンク先の数
+PREFETCH_LINK_LIMIT = int(os.getenv('PREFETCH_LINK_LIMIT', 50))
+# 先読みがWikipediaに送るリクエスト数の制限 (ホストごと、1秒あたりの数とバースト)。検証とは別に数える
+WARMUP_RATE_LIMIT = float(os.getenv('WARMUP_RATE_LIMIT', 2))
+WARMUP_RATE_BURST = int(os.getenv('WARMUP_RATE_BURST', 5))
+# プロセス内で整数IDに変換して持つWikipediaのタイトルの数の上限 (1タイトル200バイトほど)。
+# 超えたら表とリンクのキャッシュを作り直す
+TITLE_TABLE_MAX_SIZE = int(os.getenv('TITLE_TABLE_MAX_SIZE', 200_000))
+# 最短経路の探索で両側から訪問するノード数の上限。1ノードあたり100バイトほど使うので、
+# メモリ128Miのインスタンスでは20万以下にしておく
+SEARCH_MAX_VISITED = int(os.getenv('SEARCH_MAX_VISITED', 150_000))
+# 最短経路の探索がWikipediaに送るリクエスト数の制限 (ホストごと、1秒あたりの数とバースト)。検証・先読みとは別に数える
+SEARCH_RATE_LIMIT = float(os.getenv('SEARCH_RATE_LIMIT', 2))
+SEARCH_RATE_BURST = int(os.getenv('SEARCH_RATE_BURST', 2))
+# 1回の探索でWikipediaから読むページ数の上限。SEARCH_RATE_LIMITで探索の制限時間(30秒)に読める数ほどにする
+SEARCH_MAX_FETCHES = int(os.getenv('SEARCH_MAX_FETCHES', 60))
+# 最短経路の探索で読んだページのリンク先を持っておく数 (検証・先読みのリンクのキャッシュとは別)
+SEARCH_LINK_CACHE_MAX_SIZE = int(os.getenv('SEARCH_LINK_CACHE_MAX_SIZE', 512))
+# 最後の書き込みからROOM_TTL秒経ったroomと、ENDEDになってからENDED_ROOM_TTL秒経ったroomを削除する
+ROOM_TTL = int(os.getenv('ROOM_TTL', 24 * 60 * 60))
+ENDED_ROOM_TTL = int(os.getenv('ENDED_ROOM_TTL', 60 * 60))
+GC_BATCH_SIZE = int(os.getenv('GC_BATCH_SIZE', 100))
+# 定期実行のエンドポイント(/admin/gc)に必要なトークン。未設定ならエンドポイントは使えない
+GC_TOKEN = os.getenv('GC_TOKEN')
+# uuidごと・IPごとのレート制限 (1秒あたりのリクエスト数と、続けて受け付ける数)。RATEが0なら制限しない
+RATE_LIMIT_UUID_RATE = float(os.getenv('RATE_LIMIT_UUID_RATE', 5))
+RATE_LIMIT_UUID_BURST = int(os.getenv('RATE_LIMIT_UUID_BURST', 20))
+RATE_LIMIT_IP_RATE = float(os.getenv('RATE_LIMIT_IP_RATE', 20))
+RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', 100))
+# レート制限のために覚えておくキーの数の上限 (制限ごと)
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100_000))
+# 同時に処理するリクエストの上限。0なら制限しない
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', 32))
+# gunicornのスレッド数 (DockerfileもこのENVを使う)
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', 48))
+# 同時に開いておくイベント配信(SSE)の接続の上限。接続ごとにスレッドを1つ使うので、
+# 他のリクエストのためにWSGI_THREADSより少なくしておく。0なら制限しない
+MAX_EVENT_STREAMS = int(os.getenv('MAX_EVENT_STREAMS', WSGI_THREADS * 2 // 3))
+# X-Forwarded-Forを付ける信頼できるプロキシの数 (Cloud Runでは1)
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 1))
+# ログの出力先: cloud(Cloud Logging), stdout, またはファイルパス
+LOG_SINK = os.getenv('LOG_SINK', 'cloud')
 
 DEV_FRONTEND_REGEX = r'https:\/\/wikipedia-game-16fc7(--pr.*\.web\.app|\.(web|firebaseapp)\.(app|com))'
 CORS_WHITELIST = [
@@ -25,15 +70,40 @@ CORS_WHITELIST = [
     'https://wikipediagame.net'
 ]
 
-if FIREBASE_CRED_PATH:
-    cred = credentials.Certificate(FIREBASE_CRED_PATH)
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': RTDB_URL
-    })
-else:
-    firebase_admin.initialize_app(options={'databaseURL': RTDB_URL})
+_init_lock = threading.Lock()
+_firebase_initialized = False
+_fs = None
+
+
+def init_firebase():
+    # 何度呼んでもよい。複数のスレッドから同時に呼ばれても初期化は1回だけ
+    global _firebase_initialized
+    if _firebase_initialized:
+        return
+    with _init_lock:
+        if _firebase_initialized:
+            return
+        import firebase_admin
+        if FIREBASE_CRED_PATH:
+            from firebase_admin import credentials
+            cred = credentials.Certificate(FIREBASE_CRED_PATH)
+            firebase_admin.initialize_app(cred, {
+                'databaseURL': RTDB_URL
+            })
+        else:
+            firebase_admin.initialize_app(options={'databaseURL': RTDB_URL})
+        _firebase_initialized = True
+
 
-fs = firestore.client()
+def get_firestore():
+    global _fs
+    if _fs is None:
+        init_firebase()
+        with _init_lock:
+            if _fs is None:
+                from firebase_admin import firestore
+                _fs = firestore.client()
+    return _fs
 
 
 class RoomStatuses:
@@ -29,3 +29,11 @@ class NotInRoomUserException(Exception):
 class NotHostException(Exception):
     status_code = 403
     message = 'ルームホスト以外にこの操作は許可されていません'
+
+
+class TooManyRequestsException(Exception):
+    status_code = 429
+    message = 'too many requests.'
+
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
@@ -1,19 +1,27 @@
 from typing import List
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from firebase_admin import firestore
+from rooms import get_room, count_backend_read
+from models import Progress, GameResult
+from path_codec import encode_game_result, decode_game_result, is_compact, document_size
+from aggregates import (GLOBAL_STATS_COLLECTION, GLOBAL_STATS_DOCUMENT, PAIR_STATS_COLLECTION, ARTICLE_STATS_COLLECTION,
+                        COUNTERS, Aggregates, summarize_game, pair_id, article_id, with_rates)
+from metrics import firestore_call
+from conf import get_firestore
 
-from rooms import get_room_data
-from conf import fs
 
+# firebase_adminとgoogle.api_coreは読み込みが重いので、使う関数の中で読み込む
 
-# データ構造
+# データ構造 (経路はpath_codecの圧縮形式で保存し、読み出すときに下の形に戻す。models.GameResult・models.Progressで読み書きする)
 # room_result: game-results/{room-id}
 # {
 #     'createdAt': datetime,
 #     'endAt': datetime,
 #     'start': str,
 #     'end': str,
+#     'shortestDistance': int,  # start/goalの最短クリック数 (求められなかった場合は無し)
+#     'startedAt': int,  # roomがONGOINGになった時刻。同じゲームを集計に2回加えないために使う
 #     'results': [
 #         {'uuid': str, 'name': str, 'urls': ['url1', 'url2']},
 #         {'uuid': str, 'name': str, 'urls': ['url1', 'url2']}
@@ -25,59 +33,308 @@ from conf import fs
 #     'urls': [
 #         'url1',
 #         'url2'
-#     ]
+#     ],
+#     'validation': {'isValid': bool, 'message': str}  # 経路の検証が終わったら書き込まれる
+# }
+# 集計が1回のbatched writeに収まらないときの途中経過: game-result-batches/{room-id}
+# {
+#     'startedAt': int,  # どのゲームの集計か
+#     'applied': int  # 書き込み済みのbatchの数。結果を書く最後のbatchで削除する
 # }
 
-def delete_all_document_in_collection(collection_ref):
-    docs = collection_ref.get()
-    for doc in docs:
-        doc.reference.delete()
+# 集計 (stats/*) の形式はaggregates.pyを参照
+
+# 1回のbatched writeに含められる書き込みの上限
+FIRESTORE_BATCH_LIMIT = 500
+GAME_RESULT_BATCHES_COLLECTION = 'game-result-batches'
+DELETE_MAX_WORKERS = 4
+TOP_ARTICLES_LIMIT = 10
+TOP_ARTICLES_MAX = 100
+
+
+def _commit_batch(batch, caller: str):
+    with firestore_call(caller):
+        return batch.commit()
+
+
+def delete_all_document_in_collection(collection_ref, page_size=FIRESTORE_BATCH_LIMIT, max_workers=DELETE_MAX_WORKERS):
+    # ドキュメントIDのカーソルでページングしながら、ページごとに1回のbatched writeで削除する
+    # commitは並列に実行し、次のページの取得を待たせない
+    page_size = min(page_size, FIRESTORE_BATCH_LIMIT)
+    deleted, round_trips = 0, 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        commits = []
+        last_doc = None
+        while True:
+            query = collection_ref.order_by('__name__').limit(page_size)
+            if last_doc is not None:
+                query = query.start_after(last_doc)
+            with firestore_call('firestore.delete_all_document_in_collection'):
+                docs = query.get()
+            round_trips += 1
+            if not docs:
+                break
+            batch = get_firestore().batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            commits.append(executor.submit(_commit_batch, batch, 'firestore.delete_all_document_in_collection'))
+            round_trips += 1
+            deleted += len(docs)
+            if len(docs) < page_size:
+                break
+            last_doc = docs[-1]
+        for commit in commits:
+            commit.result()
+    return {'deleted': deleted, 'round_trips': round_trips}
+
+
+def delete_progress_of_rooms(room_ids, caller='firestore.delete_progress_of_rooms'):
+    # 複数のroomのprogressをまとめて、1回のbatched writeあたり最大FIRESTORE_BATCH_LIMIT件ずつ削除する
+    fs = get_firestore()
+    deleted = 0
+    batch, writes = fs.batch(), 0
+    for room_id in room_ids:
+        collection_ref = fs.collection('progress').document(str(room_id)).collection('users')
+        last_doc = None
+        while True:
+            query = collection_ref.order_by('__name__').limit(FIRESTORE_BATCH_LIMIT)
+            if last_doc is not None:
+                query = query.start_after(last_doc)
+            with firestore_call(caller):
+                docs = query.get()
+            for doc in docs:
+                batch.delete(doc.reference)
+                writes += 1
+                if writes == FIRESTORE_BATCH_LIMIT:
+                    _commit_batch(batch, caller)
+                    deleted += writes
+                    batch, writes = fs.batch(), 0
+            if len(docs) < FIRESTORE_BATCH_LIMIT:
+                break
+            last_doc = docs[-1]
+    if writes:
+        _commit_batch(batch, caller)
+        deleted += writes
+    return deleted
 
 
 def record_player_progress(room_id: int, uuid: str, name: str, urls: List[str], is_surrendered: bool):
-    _urls = urls if not is_surrendered else []
-    ref = fs.collection('progress').document(str(room_id)).collection('users').document(uuid)
-    ref.set({
-        'name': name,
-        'urls': _urls,
-        'isSurrendered': is_surrendered
-    })
+    ref = get_firestore().collection('progress').document(str(room_id)).collection('users').document(uuid)
+    with firestore_call('firestore.record_player_progress'):
+        ref.set(Progress(uuid, name, urls, is_surrendered, None).to_firestore())
 
 
 def cancel_player_progress(room_id: int, uuid: str):
-    ref = fs.collection('progress').document(str(room_id)).collection('users').document(uuid)
-    ref.delete()
+    ref = get_firestore().collection('progress').document(str(room_id)).collection('users').document(uuid)
+    with firestore_call('firestore.cancel_player_progress'):
+        ref.delete()
 
 
-def get_all_player_progresses(room_id: int):
-    ref = fs.collection('progress').document(str(room_id)).collection('users')
+def read_player_progresses(room_id: int) -> List[Progress]:
+    ref = get_firestore().collection('progress').document(str(room_id)).collection('users')
     docs = ref.stream()
-    progresses = []
-    for doc in docs:
-        data = doc.to_dict()
-        progresses.append({'uuid': doc.id,
-                           'name': data['name'],
-                           'urls': data['urls'],
-                           'isSurrendered': data['isSurrendered']
-                           })
-    return progresses
+    count_backend_read()
+    with firestore_call('firestore.get_all_player_progresses'):
+        return [Progress.from_firestore(doc.id, doc.to_dict()) for doc in docs]
 
 
-def record_game_result(room_id: int):
-    room_data = get_room_data(room_id)
-    start, goal, rtdb_users = room_data.get('start'), room_data.get('goal'), room_data.get('users')
-    in_room_user_uuids = [uuid for uuid in rtdb_users.keys()]
+def get_all_player_progresses(room_id: int):
+    return [progress.to_dict() for progress in read_player_progresses(room_id)]
 
-    # firestoreのplayer progressを全て取得
-    player_progresses = get_all_player_progresses(room_id)
-    in_room_player_progresses = [progress for progress in player_progresses if progress['uuid'] in in_room_user_uuids]
+
+def record_path_verdict(room_id: int, uuid: str, verdict: dict):
+    # progressが既に消されていたら(検証を待たずに集計した後なら)何もしない
+    from google.api_core.exceptions import NotFound
+    ref = get_firestore().collection('progress').document(str(room_id)).collection('users').document(uuid)
+    try:
+        with firestore_call('firestore.record_path_verdict'):
+            ref.update({'validation': verdict})
+        return True
+    except NotFound:
+        return False
+
+
+def record_game_result(room_id: int):
+    fs = get_firestore()
+    room = get_room(room_id)
+    # firestoreのplayer progressのうち、roomに残っているプレイヤーのものを結果にする
+    result = GameResult.from_room(room, read_player_progresses(room_id), datetime.now())
+    data = result.to_dict()
+    started_at = result.started_at
 
     # resultを書き込み
     doc_ref = fs.collection('game-results').document(str(room_id))
-    data = {
-        'createAt': datetime.now(),
-        'start': start,
-        'goal': goal,
-        'results': in_room_player_progresses
-    }
-    doc_ref.set(data)
+    # 再実行で同じゲームの結果を書き直すときは、集計には加えない
+    with firestore_call('firestore.record_game_result'):
+        existing = doc_ref.get()
+    increments = []
+    if not (existing.exists and (existing.to_dict() or {}).get('startedAt') == started_at):
+        increments = _aggregate_increments(summarize_game(data))
+    # 結果と集計は同じbatched writeで書く。上限を超える分の集計は先に別のbatchで書き、結果は最後のbatchで書く
+    # (結果があれば集計は書き終わっている)。途中で失敗しても再実行で同じ集計を2回加えないよう、
+    # 書き込み済みのbatchの数を同じbatchで記録しておく
+    if len(increments) < FIRESTORE_BATCH_LIMIT:
+        batches = [increments]
+    else:
+        size = FIRESTORE_BATCH_LIMIT - 2
+        batches = [increments[idx:idx + size] for idx in range(0, len(increments), size)]
+    progress_ref = fs.collection(GAME_RESULT_BATCHES_COLLECTION).document(str(room_id))
+    applied = 0
+    if len(batches) > 1:
+        with firestore_call('firestore.record_game_result'):
+            progress = progress_ref.get()
+        progress = (progress.to_dict() or {}) if progress.exists else {}
+        if progress.get('startedAt') == started_at:
+            applied = progress.get('applied', 0)
+    for idx, writes in enumerate(batches):
+        if idx < applied:
+            continue
+        batch = fs.batch()
+        for ref, values in writes:
+            batch.set(ref, values, merge=True)
+        if idx < len(batches) - 1:
+            batch.set(progress_ref, {'startedAt': started_at, 'applied': idx + 1})
+        else:
+            batch.set(doc_ref, encode_game_result(data))
+            if len(batches) > 1:
+                batch.delete(progress_ref)
+        _commit_batch(batch, 'firestore.record_game_result')
+
+
+def _aggregate_increments(summary: dict):
+    # 1ゲーム分の集計をIncrementで加える書き込みのリスト
+    from firebase_admin import firestore
+    fs = get_firestore()
+    counters = {counter: firestore.Increment(summary[counter]) for counter in COUNTERS}
+    for histogram in ('pathLengths', 'surrenderRates'):
+        # 空のmapをmergeするとフィールドが空で上書きされるので入れない
+        if summary[histogram]:
+            counters[histogram] = {bucket: firestore.Increment(value) for bucket, value in summary[histogram].items()}
+    writes = [(fs.collection(GLOBAL_STATS_COLLECTION).document(GLOBAL_STATS_DOCUMENT), counters)]
+
+    pair = dict(counters, start=summary['start'], goal=summary['goal'])
+    if summary['bestClicks'] is not None:
+        pair['bestClicks'] = firestore.Minimum(summary['bestClicks'])
+    if summary['shortestDistance'] is not None:
+        pair['shortestDistance'] = summary['shortestDistance']
+    writes.append((fs.collection(PAIR_STATS_COLLECTION).document(pair_id(summary['start'], summary['goal'])), pair))
+
+    for url, visits in summary['articles'].items():
+        writes.append((fs.collection(ARTICLE_STATS_COLLECTION).document(article_id(url)),
+                       {'url': url, 'visits': firestore.Increment(visits)}))
+    return writes
+
+
+def get_game_result(room_id: int):
+    doc_ref = get_firestore().collection('game-results').document(str(room_id))
+    with firestore_call('firestore.get_game_result'):
+        doc = doc_ref.get()
+    if not doc.exists:
+        return None
+    return decode_game_result(doc.to_dict())
+
+
+def migrate_game_results(page_size=FIRESTORE_BATCH_LIMIT, dry_run=False):
+    # 圧縮前の形式で保存されたgame-resultsを圧縮形式に書き換える
+    fs = get_firestore()
+    page_size = min(page_size, FIRESTORE_BATCH_LIMIT)
+    collection_ref = fs.collection('game-results')
+    stats = {'scanned': 0, 'migrated': 0, 'bytes_before': 0, 'bytes_after': 0}
+    last_doc = None
+    while True:
+        query = collection_ref.order_by('__name__').limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        with firestore_call('firestore.migrate_game_results'):
+            docs = query.get()
+        if not docs:
+            break
+        batch = fs.batch()
+        writes = 0
+        for doc in docs:
+            data = doc.to_dict()
+            stats['scanned'] += 1
+            if is_compact(data):
+                continue
+            encoded = encode_game_result(data)
+            stats['bytes_before'] += document_size(data)
+            stats['bytes_after'] += document_size(encoded)
+            batch.set(doc.reference, encoded)
+            writes += 1
+        stats['migrated'] += writes
+        if writes and not dry_run:
+            _commit_batch(batch, 'firestore.migrate_game_results')
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+    return stats
+
+
+def get_stats(top_articles: int = TOP_ARTICLES_LIMIT):
+    # ドキュメント1件と、visitsのインデックスを使った上位top_articles件の読み込みだけで返す
+    with firestore_call('firestore.get_stats'):
+        doc = get_firestore().collection(GLOBAL_STATS_COLLECTION).document(GLOBAL_STATS_DOCUMENT).get()
+    stats = with_rates(doc.to_dict() if doc.exists else {})
+    stats['topArticles'] = get_top_articles(top_articles)
+    return stats
+
+
+def get_top_articles(limit: int = TOP_ARTICLES_LIMIT):
+    if limit <= 0:
+        return []
+    from firebase_admin import firestore
+    query = (get_firestore().collection(ARTICLE_STATS_COLLECTION)
+             .order_by('visits', direction=firestore.Query.DESCENDING)
+             .limit(min(limit, TOP_ARTICLES_MAX)))
+    with firestore_call('firestore.get_top_articles'):
+        docs = query.get()
+    return [{'url': doc.get('url'), 'visits': doc.get('visits')} for doc in docs]
+
+
+def get_pair_stats(start: str, goal: str):
+    with firestore_call('firestore.get_pair_stats'):
+        doc = get_firestore().collection(PAIR_STATS_COLLECTION).document(pair_id(start, goal)).get()
+    if not doc.exists:
+        return None
+    return with_rates(doc.to_dict())
+
+
+def rebuild_aggregates(page_size=FIRESTORE_BATCH_LIMIT, dry_run=False):
+    # game-resultsをページごとに読んで集計を作り直す (一度だけのバックフィル用)
+    # 実行中に終わったゲームは数えられないことがあるので、アクセスの少ない時間に実行する
+    fs = get_firestore()
+    page_size = min(page_size, FIRESTORE_BATCH_LIMIT)
+    collection_ref = fs.collection('game-results')
+    aggregates = Aggregates()
+    stats = {'games': 0, 'written': 0}
+    last_doc = None
+    while True:
+        query = collection_ref.order_by('__name__').limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        with firestore_call('firestore.rebuild_aggregates'):
+            docs = query.get()
+        for doc in docs:
+            aggregates.add(summarize_game(decode_game_result(doc.to_dict())))
+            stats['games'] += 1
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+    stats.update(pairs=len(aggregates.pairs), articles=len(aggregates.articles))
+    if dry_run:
+        return stats
+
+    for collection in (PAIR_STATS_COLLECTION, ARTICLE_STATS_COLLECTION):
+        delete_all_document_in_collection(fs.collection(collection))
+    batch, writes = fs.batch(), 0
+    for collection, doc_id, data in aggregates.documents():
+        batch.set(fs.collection(collection).document(doc_id), data)
+        writes += 1
+        if writes == page_size:
+            _commit_batch(batch, 'firestore.rebuild_aggregates')
+            stats['written'] += writes
+            batch, writes = fs.batch(), 0
+    if writes:
+        _commit_batch(batch, 'firestore.rebuild_aggregates')
+        stats['written'] += writes
+    return stats
@@ -0,0 +1,112 @@
+import threading
+from typing import List
+
+from rooms import (change_room_status, claim_game_finalization, release_game_finalization, get_room_data,
+                   fetch_room_data, record_shortest_path)
+from firestore import record_game_result, delete_all_document_in_collection, record_path_verdict, read_player_progresses
+from validation import get_path_verdict, track_link_cache
+from warmup import warm_article, get_room_warmup
+from shortest_path import get_shortest_path
+from jobs import JobQueue, job_queue
+from conf import get_firestore, PREFETCH_LINK_LIMIT, RoomStatuses
+
+VALIDATION_WORKERS = 4
+# 集計は経路の検証が終わってから行う (集計でprogressを消すと、後から届いた検証結果を書き込めないので)
+# 最後の検証結果を書いたジョブが集計を始める。検証は別のインスタンスで動いていることもあるので、
+# 検証結果が届かなくてもVALIDATION_WAIT後には集計する (待つ間ワーカーは使わない)
+VALIDATION_WAIT = 30  # 秒
+
+# 経路の検証はWikipediaの取得を待つので、集計のジョブとは別のワーカーで行う
+validation_queue = JobQueue(workers=VALIDATION_WORKERS)
+# 最短経路の探索は重いので1つずつ行う (後から設定された記事の結果が必ず後に書き込まれる)
+search_queue = JobQueue(workers=1, max_attempts=2)
+# 記事の先読み。取得に失敗しても検証のときに読み直すので再実行はしない
+warmup_queue = JobQueue(workers=2, max_attempts=1)
+
+
+def pending_path_verdicts(room_id: int, users: dict):
+    # 検証結果がまだ無いプレイヤーのuuid
+    return [progress.uuid for progress in read_player_progresses(room_id)
+            if progress.uuid in users and not progress.is_surrendered and progress.validation is None]
+
+
+def finalize_game(room_id: int):
+    # 全員がゴールした後の処理。途中で失敗しても最初からやり直せるよう、
+    # 結果を記録してからステータスを変え、最後にprogressを消す
+    record_game_result(room_id)
+    change_room_status(room_id, None, start=False, force_change=True)
+    delete_all_document_in_collection(get_firestore().collection('progress').document(str(room_id)).collection('users'))
+
+
+def finalize_game_if_verified(room_id: int, force: bool = False):
+    # 集計が確保されていて、全員の検証結果が揃っていれば(forceなら揃っていなくても)集計のジョブを追加する
+    # 集計が終わった後や確保が外れた後に呼ばれたら何もしない
+    room_data = fetch_room_data(room_id)
+    if not room_data or room_data.get('status') == RoomStatuses.ENDED:
+        return False
+    lease = room_data.get('isFinalizing')
+    if not isinstance(lease, dict):
+        return False
+    if not force and pending_path_verdicts(room_id, room_data.get('users') or {}):
+        return False
+    # 最後まで失敗したら確保を外し、次にゴールを送ったときにやり直せるようにする
+    lease_id = lease.get('by')
+    return job_queue.submit(('finalize_game', str(room_id)), finalize_game, room_id,
+                            on_failed=lambda room_id: release_game_finalization(room_id, lease_id))
+
+
+def enqueue_finalization_check(room_id: int, force: bool = False):
+    key = ('finalize_game_if_verified', str(room_id), force)
+    return job_queue.submit(key, finalize_game_if_verified, room_id, force)
+
+
+def enqueue_game_finalization(room_id: int):
+    # 同時にゴールしたプレイヤーが複数いても、RTDB上で確保できた1人だけがジョブを追加する
+    if claim_game_finalization(room_id) is None:
+        return False
+    enqueue_finalization_check(room_id)
+    timer = threading.Timer(VALIDATION_WAIT, enqueue_finalization_check, [room_id, True])
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def validate_player_path(room_id: int, uuid: str, start: str, urls: List[str], goal: str):
+    with track_link_cache() as tracker:
+        verdict = get_path_verdict(start, urls, goal)
+    warmup = get_room_warmup(room_id)
+    if warmup is not None:
+        warmup.record_validation(tracker.hits, tracker.misses)
+    if record_path_verdict(room_id, uuid, verdict):
+        # 最後の検証結果なら集計を始める
+        enqueue_finalization_check(room_id)
+
+
+def enqueue_path_validation(room_id: int, uuid: str, urls: List[str]):
+    # リクエスト中に読んだroomのスナップショットからstart/goalを取るので、追加の読み込みは発生しない
+    room_data = get_room_data(room_id)
+    start, goal = room_data.get('start'), room_data.get('goal')
+    if not start or not goal:
+        return False
+    key = ('validate_player_path', str(room_id), uuid, tuple(urls))
+    return validation_queue.submit(key, validate_player_path, room_id, uuid, start, urls, goal)
+
+
+def compute_shortest_path(room_id: int):
+    room_data = fetch_room_data(room_id)
+    if not room_data:
+        return
+    start, goal = room_data.get('start'), room_data.get('goal')
+    if not start or not goal:
+        return
+    record_shortest_path(room_id, start, goal, get_shortest_path(start, goal))
+
+
+def enqueue_shortest_path(room_id: int, url: str):
+    # start/goalが揃っているかはジョブの中で読んで確かめるので、リクエスト中の読み込みは増えない
+    return search_queue.submit(('compute_shortest_path', str(room_id), url), compute_shortest_path, room_id)
+
+
+def enqueue_warmup(room_id: int, url: str, is_start: bool):
+    key = ('warm_article', str(room_id), url, is_start)
+    return warmup_queue.submit(key, warm_article, room_id, url, is_start, PREFETCH_LINK_LIMIT)
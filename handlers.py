@@ -0,0 +1,172 @@
+# main.pyのルートの処理
+# リクエストから取り出した値を受け取り、(レスポンスのJSON, ステータスコード) を返す。Flaskには依存しない
+from typing import Optional
+
+from rooms import (create_new_room, _join_room, setting_article, change_room_status, change_player_progress,
+                   get_room_users, is_all_room_users_done, _destroy_room)
+from firestore import (record_player_progress, cancel_player_progress, record_game_result, get_game_result,
+                       get_stats, get_pair_stats)
+from exceptions import (RoomNotExistException, RoomIdDuplicateException, URLValidationException, NotInRoomUserException,
+                        NotHostException)
+from game import enqueue_game_finalization, enqueue_path_validation, enqueue_shortest_path, enqueue_warmup
+from warmup import get_warmup_status
+from sweeper import sweep
+from structured_log import get_logger
+from conf import GC_TOKEN, LOG_SINK, resource
+
+logger = get_logger(__name__, LOG_SINK)
+
+
+def log_error(e: Exception):
+    logger.log_struct({'error': str(e)}, resource=resource, severity='ERROR')
+
+
+def collect_garbage(token: Optional[str], data: Optional[dict]):
+    # Cloud Schedulerなどから定期的に呼ぶ。GC_TOKENが設定されていなければ使えない
+    if not GC_TOKEN or token != GC_TOKEN:
+        return {'message': 'forbidden.'}, 403
+    try:
+        data = data or {}
+        return sweep(dry_run=bool(data.get('dry_run')), max_rooms=data.get('max_rooms')), 200
+    except Exception as e:
+        log_error(e)
+        return {'message': 'gc failed.'}, 500
+
+
+def create_room(data: dict):
+    try:
+        user_uuid, user_name = data['uuid'], data['name']
+        return {'room_id': create_new_room(user_uuid, user_name)}, 201
+    except RoomIdDuplicateException as e:
+        return {'message': e.message}, e.status_code
+    except Exception as e:
+        log_error(e)
+        return {'message': 'create_room failed.'}, 400
+
+
+def start_room(data: dict):
+    try:
+        user_uuid, room_id = data['uuid'], data['room_id']
+        change_room_status(room_id, user_uuid, start=True)
+        return {'message': 'game started.'}, 200
+    except RoomNotExistException as e:
+        return {'message': e.message}, e.status_code
+    except NotInRoomUserException as e:
+        return {'message': e.message}, e.status_code
+    except Exception as e:
+        log_error(e)
+        return {'message': 'game start failed.'}, 400
+
+
+def end_room(data: dict):
+    try:
+        user_uuid, room_id = data['uuid'], data['room_id']
+        change_room_status(room_id, user_uuid, start=False)
+        record_game_result(room_id)
+        return {'message': 'game ended.'}, 200
+    except NotHostException as e:
+        return {'message': e.message}, e.status_code
+    except Exception as e:
+        log_error(e)
+        return {'message': 'end room failed.'}, 400
+
+
+def destroy_room(data: dict):
+    try:
+        room_id, user_uuid = data.get('room_id'), data.get('uuid')
+        _destroy_room(room_id, user_uuid=user_uuid)
+        return {'message': 'room deleted.'}, 204
+    except RoomNotExistException as e:
+        return {'message': e.message}, e.status_code
+    except NotHostException as e:
+        return {'message': e.message}, e.status_code
+    except Exception:
+        return {'message': 'error destroy room.'}, 400
+
+
+def join_room(data: dict):
+    try:
+        room_id, user_name, user_uuid = data['room_id'], data['name'], data['uuid']
+        _join_room(room_id, user_uuid, user_name)
+        return {'room_id': room_id}, 201
+    except RoomNotExistException as e:
+        return {'message': e.message}, e.status_code
+    except Exception as e:
+        log_error(e)
+        return {'message': 'join room failed.'}, 400
+
+
+def set_article(data: dict):
+    try:
+        room_id, target, url = data['room_id'], data['target'], data['url']
+        is_start = True if target == 'start' else False
+        setting_article(room_id, url, is_start)
+        enqueue_warmup(room_id, url, is_start)
+        enqueue_shortest_path(room_id, url)
+        return None, 201
+    except RoomNotExistException as e:
+        return {'message': e.message}, e.status_code
+    except Exception as e:
+        log_error(e)
+        return {'message': 'set_article failed.'}, 400
+
+
+def game_result(room_id: int):
+    # 圧縮形式で保存された結果をURLの形に戻して返す
+    result = get_game_result(room_id)
+    if result is None:
+        return {'message': 'game result not found.'}, 404
+    return result, 200
+
+
+def stats(limit: int):
+    # 集計済みのドキュメントを読むだけなので、game-resultsの件数によらない
+    return get_stats(limit), 200
+
+
+def pair_stats(start: Optional[str], goal: Optional[str]):
+    if not start or not goal:
+        return {'message': 'start and goal are required.'}, 400
+    result = get_pair_stats(start, goal)
+    if result is None:
+        return {'message': 'stats not found.'}, 404
+    return result, 200
+
+
+def warmup_status(room_id: int):
+    status = get_warmup_status(room_id)
+    if status is None:
+        return {'message': 'warmup status not found.'}, 404
+    return status, 200
+
+
+# TODO: too big!!!
+def player_progress(data: dict):
+    # required request params: room_id, user_uuid, is_done
+    try:
+        room_id, urls, user_uuid, name, is_done, is_surrendered \
+            = data.get('room_id'), data.get('urls'), data.get('uuid'), \
+              data.get('name'), data.get('is_done'), data.get('is_surrendered')
+        change_player_progress(room_id, user_uuid, is_done, is_surrendered)
+        if is_done:
+            if not room_id or urls is None or not user_uuid or not name or is_surrendered is None:
+                raise
+            record_player_progress(room_id, user_uuid, name, urls, is_surrendered)
+            room_users = get_room_users(room_id)
+            if not is_surrendered:
+                enqueue_path_validation(room_id, user_uuid, urls)
+            if is_all_room_users_done(room_users):
+                # 結果の記録などはバックグラウンドで行い、最後のプレイヤーを待たせない
+                enqueue_game_finalization(room_id)
+        else:
+            cancel_player_progress(room_id, user_uuid)
+        return {'message': 'urls is valid.'}, 200
+    except RoomNotExistException as e:
+        return {'message': e.message}, e.status_code
+    except NotInRoomUserException as e:
+        return {'message': e.message}, e.status_code
+    except URLValidationException as e:
+        return {'message': e.message}, e.status_code
+    except Exception as e:
+        log_error(e)
+        return {'message': 'failed done.'}, 400
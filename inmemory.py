@@ -0,0 +1,519 @@
+# RTDB / Firestore / Wikipediaのインメモリ実装 (ベンチマーク・テスト用)
+# 各操作の前にlatency秒だけ待つことで、ネットワーク越しの呼び出しを模擬する
+import copy
+import time
+import threading
+from itertools import count
+from collections import defaultdict, OrderedDict
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.transforms import Increment, Maximum, Minimum
+
+
+def _split(path: str):
+    return [part for part in str(path).split('/') if part]
+
+
+SERVER_TIMESTAMP = {'.sv': 'timestamp'}
+
+
+def _normalize(value, now_ms: int):
+    # RTDBは空のノードを保持せず、キーはすべて文字列になる。{'.sv': 'timestamp'}は書き込み時刻になる
+    if value == SERVER_TIMESTAMP:
+        return now_ms
+    if isinstance(value, dict):
+        normalized = {str(k): _normalize(v, now_ms) for k, v in value.items()}
+        normalized = {k: v for k, v in normalized.items() if v is not None}
+        return normalized or None
+    return value
+
+
+class BackendStats:
+    def __init__(self):
+        self.calls = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def record(self):
+        with self._lock:
+            self.calls += 1
+        self._local.calls = getattr(self._local, 'calls', 0) + 1
+
+    def thread_calls(self):
+        # 呼び出し元のスレッドで行われた呼び出し数を返してリセットする
+        calls = getattr(self._local, 'calls', 0)
+        self._local.calls = 0
+        return calls
+
+
+class InMemoryRTDB:
+    def __init__(self, latency: float = 0.0, clock=time.time):
+        self.latency = latency
+        self.clock = clock
+        self.stats = BackendStats()
+        self._root = None
+        self._lock = threading.RLock()
+        self._listeners = []
+
+    def _call(self):
+        self.stats.record()
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reference(self, path: str = '/'):
+        return InMemoryReference(self, _split(path))
+
+    def _listen(self, parts, callback):
+        registration = InMemoryListenerRegistration(self, parts, callback)
+        with self._lock:
+            self._listeners.append(registration)
+            data = self._get(parts)
+        callback(InMemoryEvent('put', '/', data))
+        return registration
+
+    def _notify(self, written):
+        # 書き込んだパスと上下関係にあるリスナーに、リスナーの位置の値全体をputとして送る
+        # (実際のRTDBは別スレッドから差分を送ってくるが、ここでは書き込んだスレッドで送る)
+        with self._lock:
+            events = []
+            for registration in self._listeners:
+                parts = registration.parts
+                if any(w[:len(parts)] == parts or parts[:len(w)] == w for w in written):
+                    events.append((registration, self._get(parts)))
+        for registration, data in events:
+            registration.callback(InMemoryEvent('put', '/', data))
+
+    def _get(self, parts):
+        node = self._root
+        for part in parts:
+            if not isinstance(node, dict):
+                return None
+            node = node.get(part)
+        return copy.deepcopy(node)
+
+    def _set(self, parts, value):
+        value = _normalize(copy.deepcopy(value), int(self.clock() * 1000))
+        if not parts:
+            self._root = value
+            return
+        if not isinstance(self._root, dict):
+            self._root = {}
+        nodes = [self._root]
+        for part in parts[:-1]:
+            child = nodes[-1].get(part)
+            if not isinstance(child, dict):
+                child = nodes[-1][part] = {}
+            nodes.append(child)
+        if value is None:
+            nodes[-1].pop(parts[-1], None)
+        else:
+            nodes[-1][parts[-1]] = value
+        # 空になった親ノードを消す
+        for idx in range(len(nodes) - 1, 0, -1):
+            if nodes[idx]:
+                break
+            del nodes[idx - 1][parts[idx - 1]]
+        if not self._root:
+            self._root = None
+
+    @property
+    def data(self):
+        with self._lock:
+            return copy.deepcopy(self._root)
+
+    def peek(self, path: str):
+        # 呼び出し数にも遅延にも含めずに読む
+        with self._lock:
+            return self._get(_split(path))
+
+
+class TransactionAbortedError(Exception):
+    pass
+
+
+class InMemoryEvent:
+    def __init__(self, event_type: str, path: str, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class InMemoryListenerRegistration:
+    def __init__(self, rtdb: InMemoryRTDB, parts, callback):
+        self._rtdb = rtdb
+        self.parts = tuple(parts)
+        self.callback = callback
+
+    def close(self):
+        with self._rtdb._lock:
+            if self in self._rtdb._listeners:
+                self._rtdb._listeners.remove(self)
+
+
+class InMemoryReference:
+    def __init__(self, rtdb: InMemoryRTDB, parts):
+        self._rtdb = rtdb
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return '/' + '/'.join(self._parts)
+
+    def child(self, path: str):
+        return InMemoryReference(self._rtdb, self._parts + _split(path))
+
+    def order_by_value(self):
+        return InMemoryQuery(self, lambda item: item[1])
+
+    def order_by_key(self):
+        return InMemoryQuery(self, lambda item: item[0])
+
+    def get(self, shallow=False):
+        self._rtdb._call()
+        with self._rtdb._lock:
+            value = self._rtdb._get(self._parts)
+        if shallow and isinstance(value, dict):
+            return {k: True for k in value}
+        return value
+
+    def listen(self, callback):
+        return self._rtdb._listen(tuple(self._parts), callback)
+
+    def set(self, value):
+        self._rtdb._call()
+        with self._rtdb._lock:
+            self._rtdb._set(self._parts, value)
+        self._rtdb._notify([tuple(self._parts)])
+
+    def update(self, value: dict):
+        self._rtdb._call()
+        with self._rtdb._lock:
+            for path, child in value.items():
+                self._rtdb._set(self._parts + _split(path), child)
+        self._rtdb._notify([tuple(self._parts + _split(path)) for path in value])
+
+    def delete(self):
+        self._rtdb._call()
+        with self._rtdb._lock:
+            self._rtdb._set(self._parts, None)
+        self._rtdb._notify([tuple(self._parts)])
+
+    def transaction(self, transaction_update):
+        # 実際のRTDBはGETと条件付きPUTの2往復
+        self._rtdb._call()
+        self._rtdb._call()
+        with self._rtdb._lock:
+            value = transaction_update(self._rtdb._get(self._parts))
+            self._rtdb._set(self._parts, value)
+        self._rtdb._notify([tuple(self._parts)])
+        return copy.deepcopy(value)
+
+
+class InMemoryQuery:
+    def __init__(self, reference: InMemoryReference, key):
+        self._reference = reference
+        self._key = key
+        self._start = None
+        self._end = None
+        self._limit_first = None
+        self._limit_last = None
+
+    def start_at(self, value):
+        self._start = value
+        return self
+
+    def end_at(self, value):
+        self._end = value
+        return self
+
+    def limit_to_first(self, n: int):
+        self._limit_first = n
+        return self
+
+    def limit_to_last(self, n: int):
+        self._limit_last = n
+        return self
+
+    def get(self):
+        value = self._reference.get()
+        if not isinstance(value, dict):
+            return OrderedDict()
+        items = sorted(value.items(), key=lambda item: (self._key(item), item[0]))
+        items = [item for item in items if (self._start is None or self._key(item) >= self._start)
+                 and (self._end is None or self._key(item) <= self._end)]
+        if self._limit_first is not None:
+            items = items[:self._limit_first]
+        if self._limit_last is not None:
+            items = items[-self._limit_last:]
+        return OrderedDict(items)
+
+
+class InMemoryFirestore:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.stats = BackendStats()
+        # コレクションのパス -> {ドキュメントID: データ}
+        self._collections = defaultdict(dict)
+        self._lock = threading.RLock()
+
+    def _call(self):
+        self.stats.record()
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, name: str):
+        return InMemoryCollection(self, (name,))
+
+    def document(self, path: str):
+        parts = tuple(_split(path))
+        return InMemoryDocument(self, parts[:-1], parts[-1])
+
+    def batch(self):
+        return InMemoryWriteBatch(self)
+
+    def collection_paths(self):
+        with self._lock:
+            return {path for path, docs in self._collections.items() if docs}
+
+
+def _apply_transforms(current, data, merge: bool, deep: bool = True):
+    # set(merge=True)は入れ子のmapも含めて書き込んだフィールドだけを更新する。Increment等はここで計算する
+    result = dict(current) if merge and isinstance(current, dict) else {}
+    for key, value in data.items():
+        previous = result.get(key)
+        if isinstance(value, Increment):
+            value = (previous if isinstance(previous, (int, float)) else 0) + value.value
+        elif isinstance(value, Minimum):
+            value = value.value if not isinstance(previous, (int, float)) else min(previous, value.value)
+        elif isinstance(value, Maximum):
+            value = value.value if not isinstance(previous, (int, float)) else max(previous, value.value)
+        elif isinstance(value, dict):
+            value = _apply_transforms(previous, value, merge and deep)
+        else:
+            value = copy.deepcopy(value)
+        result[key] = value
+    return result
+
+
+class InMemorySnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str):
+        return (self._data or {}).get(field)
+
+
+class InMemoryDocument:
+    def __init__(self, client: InMemoryFirestore, collection_path, doc_id: str):
+        self._client = client
+        self._collection_path = tuple(collection_path)
+        self.id = str(doc_id)
+
+    @property
+    def path(self):
+        return '/'.join(self._collection_path + (self.id,))
+
+    def collection(self, name: str):
+        return InMemoryCollection(self._client, self._collection_path + (self.id, name))
+
+    def get(self):
+        self._client._call()
+        with self._client._lock:
+            data = self._client._collections[self._collection_path].get(self.id)
+            return InMemorySnapshot(self, copy.deepcopy(data))
+
+    def _write(self, data, merge=False):
+        with self._client._lock:
+            docs = self._client._collections[self._collection_path]
+            docs[self.id] = _apply_transforms(docs.get(self.id), data, merge)
+
+    def _delete(self):
+        with self._client._lock:
+            self._client._collections[self._collection_path].pop(self.id, None)
+
+    def set(self, data, merge=False):
+        self._client._call()
+        self._write(data, merge)
+
+    def update(self, data):
+        self._client._call()
+        with self._client._lock:
+            if self.id not in self._client._collections[self._collection_path]:
+                raise NotFound(f'No document to update: {self.path}')
+            self._update(data)
+
+    def _update(self, data):
+        # update()は指定したフィールドを丸ごと置き換える
+        with self._client._lock:
+            docs = self._client._collections[self._collection_path]
+            docs[self.id] = _apply_transforms(docs[self.id], data, merge=True, deep=False)
+
+    def delete(self):
+        self._client._call()
+        self._delete()
+
+
+class InMemoryCollection:
+    def __init__(self, client: InMemoryFirestore, path, limit=None, start_after=None, order=None):
+        self._client = client
+        self._path = tuple(path)
+        self._limit = limit
+        self._start_after = start_after
+        # (フィールド, 降順か)。Noneならドキュメント ID順
+        self._order = order
+
+    @property
+    def id(self):
+        return self._path[-1]
+
+    def document(self, doc_id: str = None):
+        return InMemoryDocument(self._client, self._path, doc_id or f'auto-{next(_auto_ids)}')
+
+    def order_by(self, field: str, direction: str = 'ASCENDING'):
+        # 1つのフィールドでの並び替えのみ対応。start_afterはドキュメントID順のときだけ使える
+        if field == '__name__':
+            return self
+        return InMemoryCollection(self._client, self._path, self._limit, self._start_after,
+                                  (field, direction == 'DESCENDING'))
+
+    def select(self, field_paths):
+        return self
+
+    def limit(self, n: int):
+        return InMemoryCollection(self._client, self._path, n, self._start_after, self._order)
+
+    def start_after(self, snapshot):
+        return InMemoryCollection(self._client, self._path, self._limit, snapshot.id, self._order)
+
+    def _snapshots(self):
+        with self._client._lock:
+            docs = sorted(self._client._collections[self._path].items())
+        if self._order is not None:
+            # フィールドが無いドキュメントは結果に含まれない
+            field, descending = self._order
+            docs = sorted([(doc_id, data) for doc_id, data in docs if field in data],
+                          key=lambda item: item[1][field], reverse=descending)
+        if self._start_after is not None:
+            docs = [(doc_id, data) for doc_id, data in docs if doc_id > self._start_after]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return [InMemorySnapshot(InMemoryDocument(self._client, self._path, doc_id), copy.deepcopy(data))
+                for doc_id, data in docs]
+
+    def get(self):
+        self._client._call()
+        return self._snapshots()
+
+    def stream(self):
+        self._client._call()
+        return iter(self._snapshots())
+
+
+class InMemoryWriteBatch:
+    MAX_WRITES = 500
+
+    def __init__(self, client: InMemoryFirestore):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference._write(data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(lambda: reference._update(data))
+
+    def delete(self, reference):
+        self._writes.append(reference._delete)
+
+    def commit(self):
+        if len(self._writes) > self.MAX_WRITES:
+            raise ValueError('maximum 500 writes allowed per request.')
+        self._client._call()
+        with self._client._lock:
+            for write in self._writes:
+                write()
+        self._writes = []
+
+
+_auto_ids = count()
+
+
+class FakeWikipedia:
+    # タイトル -> リンク先タイトルのグラフから記事のHTMLを返す
+    # redirects: リダイレクト元のタイトル -> リダイレクト先のタイトル
+    def __init__(self, graph=None, latency: float = 0.0, base_url: str = 'https://ja.wikipedia.org', redirects=None):
+        self.graph = graph or {}
+        self.redirects = redirects or {}
+        self.latency = latency
+        self.base_url = base_url
+        self.stats = BackendStats()
+
+    def url(self, title: str):
+        return f'{self.base_url}/wiki/{title}'
+
+    def iter_page(self, url: str):
+        self.stats.record()
+        if self.latency:
+            time.sleep(self.latency)
+        title = url.rsplit('/wiki/', 1)[-1]
+        title = self.redirects.get(title, title)
+        links = ''.join(f'<p><a href="/wiki/{link}">{link}</a></p>' for link in self.graph.get(title, ()))
+        yield (f'<html><head><link rel="canonical" href="{self.url(title)}"></head><body>'
+               f'<div id="mw-content-text"><div class="mw-parser-output">{links}</div></div></body></html>')
+
+    def backlinks(self, base_url: str, title: str):
+        self.stats.record()
+        if self.latency:
+            time.sleep(self.latency)
+        return [source for source, links in self.graph.items() if title in links]
+
+    def resolve_redirects(self, url: str):
+        self.stats.record()
+        if self.latency:
+            time.sleep(self.latency)
+        title = url.rsplit('/wiki/', 1)[-1]
+        title = self.redirects.get(title, title)
+        return self.url(title), [self.url(source) for source, target in self.redirects.items() if target == title]
+
+
+def reference_router(rtdb: InMemoryRTDB, shards: dict = None):
+    # db.reference(path, url=...)と同じ引数で、URLごとのインメモリ実装を返す (URLが無ければrtdb)
+    def reference(path: str = '/', app=None, url: str = None):
+        return (shards[url] if url is not None else rtdb).reference(path)
+    return reference
+
+
+def install(rtdb: InMemoryRTDB = None, firestore_client: InMemoryFirestore = None, wikipedia: FakeWikipedia = None,
+            rtdb_shards: dict = None):
+    # firebase_adminとWikipediaへのアクセスをインメモリ実装に差し替える
+    # rtdb_shardsは {RTDBのURL: InMemoryRTDB}。シャードのURLを指定した読み書きはそれぞれに振り分ける
+    # RTDB・Firestoreを最初に使う前に呼ぶこと
+    import firebase_admin
+    from firebase_admin import db, firestore
+
+    rtdb = rtdb or InMemoryRTDB()
+    firestore_client = firestore_client or InMemoryFirestore()
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: firestore_client
+    db.reference = reference_router(rtdb, rtdb_shards)
+    db.TransactionAbortedError = TransactionAbortedError
+    if wikipedia is not None:
+        import validation
+        validation.iter_wikipedia_page = wikipedia.iter_page
+        validation.fetch_redirects = wikipedia.resolve_redirects
+        import shortest_path
+        shortest_path.fetch_backlinks = wikipedia.backlinks
+    return rtdb, firestore_client
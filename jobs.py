@@ -0,0 +1,81 @@
+import sys
+import threading
+from queue import Queue
+from typing import Callable
+
+from metrics import REGISTRY, Counter
+
+# リクエストの処理から切り離して実行するジョブのキュー
+# 同じkeyのジョブが待機中・実行中なら追加しない。失敗したら間隔を空けて再実行する
+JOB_WORKERS = 2
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 0.5  # 秒 (再実行のたびに2倍にする)
+
+jobs_total = REGISTRY.register(Counter('jobs_total', 'Background jobs by name and outcome.', ('job', 'outcome')))
+
+
+class JobQueue:
+    def __init__(self, workers: int = JOB_WORKERS, max_attempts: int = JOB_MAX_ATTEMPTS,
+                 retry_delay: float = JOB_RETRY_DELAY):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = Queue()
+        self._keys = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, key, f: Callable, *args, on_failed: Callable = None, **kwargs):
+        # on_failedは最後まで失敗したときに呼ぶ (引数はfと同じ)
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            self._ensure_started()
+        self._queue.put((key, f, args, kwargs, on_failed, 1))
+        return True
+
+    def _ensure_started(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name=f'job-worker-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            key, f, args, kwargs, on_failed, attempt = self._queue.get()
+            name = getattr(f, '__name__', 'job')
+            try:
+                f(*args, **kwargs)
+                jobs_total.inc(name, 'ok')
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    jobs_total.inc(name, 'retry')
+                    timer = threading.Timer(self.retry_delay * 2 ** (attempt - 1), self._queue.put,
+                                            [(key, f, args, kwargs, on_failed, attempt + 1)])
+                    timer.daemon = True
+                    timer.start()
+                    continue
+                jobs_total.inc(name, 'failed')
+                sys.stderr.write(f'job {name}({key}) failed after {attempt} attempts: {e}\n')
+                if on_failed is not None:
+                    try:
+                        on_failed(*args, **kwargs)
+                    except Exception as e:
+                        sys.stderr.write(f'job {name}({key}) on_failed failed: {e}\n')
+            self._done(key)
+
+    def _done(self, key):
+        with self._lock:
+            self._keys.discard(key)
+            self._idle.notify_all()
+
+    def join(self, timeout: float = None):
+        # 待機中・実行中のジョブがなくなるまで待つ
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._keys, timeout)
+
+
+job_queue = JobQueue()
+
@@ -0,0 +1,85 @@
+from html.parser import HTMLParser
+from typing import Iterable, Iterator, Optional
+
+# 本文領域。ここより外(ナビゲーション、フッターなど)のリンクは数えない
+CONTENT_AREA_ID = 'mw-content-text'
+ARTICLE_PATH_PREFIX = '/wiki/'
+
+
+class ArticleLinkParser(HTMLParser):
+    # 受け取った部分から順に本文中の /wiki/ リンクを取り出す
+    # content_idがNoneならページ全体を対象にする
+    def __init__(self, content_id: Optional[str] = CONTENT_AREA_ID):
+        super().__init__(convert_charrefs=True)
+        self.content_id = content_id
+        self.finished = False
+        self._div_depth = 0
+        self._in_content = content_id is None
+        self._links = []
+        # <link rel="canonical">。リダイレクト経由で開いたページならリダイレクト先のURLになる
+        self.canonical = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'link' and self.canonical is None and ('rel', 'canonical') in attrs:
+            self.canonical = dict(attrs).get('href')
+            return
+        if not self._in_content:
+            if tag == 'div' and ('id', self.content_id) in attrs:
+                self._in_content = True
+                self._div_depth = 1
+            return
+        if tag == 'div':
+            self._div_depth += 1
+        elif tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value and value.startswith(ARTICLE_PATH_PREFIX):
+                    self._links.append(value)
+
+    def handle_endtag(self, tag):
+        if self._in_content and self.content_id is not None and tag == 'div':
+            self._div_depth -= 1
+            if self._div_depth == 0:
+                self._in_content = False
+                self.finished = True
+
+    def pop_links(self):
+        links, self._links = self._links, []
+        return links
+
+
+def iter_article_links(chunks: Iterable[str], content_id: Optional[str] = CONTENT_AREA_ID) -> Iterator[str]:
+    parser = ArticleLinkParser(content_id)
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.pop_links()
+        if parser.finished:
+            return
+    parser.close()
+    yield from parser.pop_links()
+
+
+def extract_article_page(chunks: Iterable[str], content_id: Optional[str] = CONTENT_AREA_ID):
+    # (canonicalのURL, 出現順のリンク) を返す
+    parser = ArticleLinkParser(content_id)
+    links = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        links.extend(parser.pop_links())
+        if parser.finished:
+            return parser.canonical, links
+    parser.close()
+    links.extend(parser.pop_links())
+    return parser.canonical, links
+
+
+def extract_article_links(chunks: Iterable[str], content_id: Optional[str] = CONTENT_AREA_ID):
+    return set(iter_article_links(chunks, content_id))
+
+
+def contains_article_link(chunks: Iterable[str], href: str, content_id: Optional[str] = CONTENT_AREA_ID):
+    # 見つかった時点で読むのをやめる
+    links = iter_article_links(chunks, content_id)
+    try:
+        return any(link == href for link in links)
+    finally:
+        links.close()
@@ -0,0 +1,373 @@
+import os
+import re
+import sys
+import gzip
+import heapq
+import mmap
+import struct
+import argparse
+import tempfile
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+from titles import ARTICLE_PATH, normalize_title, normalize_plain_title
+
+# Wikipediaのリンクグラフをオフラインで引くためのCSR形式インデックス
+# ファイル構造 (数値はすべてネイティブ(リトルエンディアン)、各セクションは8byte境界に揃える)
+# header: magic(8s), タイトル数(Q), リンク数(Q), タイトル文字列の総byte数(Q)
+# title_offsets: uint64 * (タイトル数 + 1)  タイトルIDごとのtitle_data上の位置
+# offsets:       uint64 * (タイトル数 + 1)  タイトルIDごとのtargets上の位置
+# targets:       uint32 * リンク数          リンク先のタイトルID(タイトルごとに昇順)
+# in_offsets:    uint64 * (タイトル数 + 1)  タイトルIDごとのin_targets上の位置
+# in_targets:    uint32 * リンク数          リンク元のタイトルID(タイトルごとに昇順)
+# canonical:     uint32 * タイトル数        リダイレクトならリダイレクト先のID、そうでなければ自身のID
+# title_data:    utf-8のタイトルをbyte順にソートして連結したもの (ID = ソート順)
+# タイトルは正規化した形 (titles.normalize_plain_title) で持つ。リンクはリダイレクトを解決した先へのリンクとして持ち、
+# リダイレクトのページ自体にはリンクを持たせない
+MAGIC = b'WGLINKS3'
+HEADER = struct.Struct('<8sQQQ')
+
+MAIN_NAMESPACE = 0
+# インデックスを作るときに、一度にメモリ上でソートするリンクの数 (超えたら一時ファイルに書き出して最後にマージする)
+SORT_RUN_SIZE = 2_000_000
+# 一時ファイルから一度に読み込む数
+MERGE_CHUNK_SIZE = 65_536
+REDIRECT_MAX_HOPS = 5
+
+
+def _align(n: int):
+    return (n + 7) & ~7
+
+
+def title_from_url(url: str):
+    path = urlsplit(url).path
+    if not path.startswith(ARTICLE_PATH):
+        return None
+    return normalize_title(path[len(ARTICLE_PATH):]) or None
+
+
+class LinkIndex:
+    def __init__(self, buffer):
+        self._buffer = buffer
+        view = memoryview(buffer)
+        magic, n_titles, n_links, title_data_len = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError('not a link index file.')
+        pos = _align(HEADER.size)
+        self._title_offsets = view[pos:pos + 8 * (n_titles + 1)].cast('Q')
+        pos = _align(pos + 8 * (n_titles + 1))
+        self._offsets = view[pos:pos + 8 * (n_titles + 1)].cast('Q')
+        pos = _align(pos + 8 * (n_titles + 1))
+        self._targets = view[pos:pos + 4 * n_links].cast('I')
+        pos = _align(pos + 4 * n_links)
+        self._in_offsets = view[pos:pos + 8 * (n_titles + 1)].cast('Q')
+        pos = _align(pos + 8 * (n_titles + 1))
+        self._in_targets = view[pos:pos + 4 * n_links].cast('I')
+        pos = _align(pos + 4 * n_links)
+        self._canonical = view[pos:pos + 4 * n_titles].cast('I')
+        pos = _align(pos + 4 * n_titles)
+        self._title_data = view[pos:pos + title_data_len]
+        self.n_titles = n_titles
+        self.n_links = n_links
+
+    @classmethod
+    def open(cls, path: str):
+        # 読み取り専用でmmapするので、同じファイルを開いたワーカー同士でページキャッシュが共有される
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mm)
+
+    def title(self, title_id: int):
+        start, end = self._title_offsets[title_id], self._title_offsets[title_id + 1]
+        return bytes(self._title_data[start:end]).decode('utf-8')
+
+    def title_id(self, title: str) -> Optional[int]:
+        # 正規化して引き、リダイレクトならリダイレクト先のIDを返す
+        title = normalize_plain_title(title)
+        key = title.encode('utf-8')
+        lo, hi = 0, self.n_titles
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end = self._title_offsets[mid], self._title_offsets[mid + 1]
+            if bytes(self._title_data[start:end]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_titles and self.title(lo) == title:
+            return self._canonical[lo]
+        return None
+
+    def __contains__(self, title: str):
+        return self.title_id(title) is not None
+
+    def links(self, title_id: int):
+        return self._targets[self._offsets[title_id]:self._offsets[title_id + 1]]
+
+    def backlinks(self, title_id: int):
+        return self._in_targets[self._in_offsets[title_id]:self._in_offsets[title_id + 1]]
+
+    def has_link_id(self, source_id: int, target_id: int):
+        start, end = self._offsets[source_id], self._offsets[source_id + 1]
+        idx = bisect_left(self._targets, target_id, start, end)
+        return idx < end and self._targets[idx] == target_id
+
+    def has_link(self, source: str, target: str):
+        source_id, target_id = self.title_id(source), self.title_id(target)
+        if source_id is None or target_id is None:
+            return False
+        return self.has_link_id(source_id, target_id)
+
+    def close(self):
+        for view in (self._title_offsets, self._offsets, self._targets, self._in_offsets, self._in_targets,
+                     self._canonical, self._title_data):
+            view.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+
+def _write_run(directory: str, keys: array):
+    keys = array('Q', sorted(keys))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        keys.tofile(f)
+    return f.name
+
+
+def _iter_run(path: str):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = array('Q')
+            try:
+                chunk.fromfile(f, MERGE_CHUNK_SIZE)
+            except EOFError:
+                # 最後の半端な分もchunkに読み込まれている
+                pass
+            if not chunk:
+                return
+            yield from chunk
+
+
+def _write_links(f, runs: List[str], offsets_pos: int, n_titles: int):
+    # ソート済みのrunをマージし、(タイトルID << 32 | リンク先ID) の順にtargetsを書く。重複は1つにする
+    # offsetsはtargetsを書き終えてから、空けておいた位置に書く
+    counts = array('Q', bytes(8 * (n_titles + 1)))
+    targets = array('I')
+    previous = None
+    for key in heapq.merge(*(_iter_run(run) for run in runs)):
+        if key == previous:
+            continue
+        previous = key
+        counts[(key >> 32) + 1] += 1
+        targets.append(key & 0xFFFFFFFF)
+        if len(targets) >= MERGE_CHUNK_SIZE:
+            targets.tofile(f)
+            targets = array('I')
+    targets.tofile(f)
+    end = f.tell()
+    for idx in range(n_titles):
+        counts[idx + 1] += counts[idx]
+    f.seek(offsets_pos)
+    counts.tofile(f)
+    f.seek(end)
+    return counts[n_titles]
+
+
+def build_index(path: str, titles: Iterable[str], edges: Iterable[Tuple[str, str]],
+                redirects: Iterable[Tuple[str, str]] = (), run_size: int = SORT_RUN_SIZE):
+    # titles: 正規化したタイトル、edges: (リンク元, リンク先)、redirects: (リダイレクト元, リダイレクト先)
+    # メモリに持つのはタイトルの表だけで、リンクはrun_size件ずつソートして一時ファイルに書き出し、最後にマージする
+    encoded = sorted({title.encode('utf-8') for title in titles})
+    ids = {title.decode('utf-8'): idx for idx, title in enumerate(encoded)}
+    n_titles = len(encoded)
+    canonical = array('I', range(n_titles))
+    for source, target in redirects:
+        source_id, target_id = ids.get(source), ids.get(target)
+        if source_id is not None and target_id is not None:
+            canonical[source_id] = target_id
+    # 二重リダイレクトは最後まで辿る (循環していたら途中で止める)
+    for title_id in range(n_titles):
+        target_id = canonical[title_id]
+        for _ in range(REDIRECT_MAX_HOPS):
+            if canonical[target_id] == target_id:
+                break
+            target_id = canonical[target_id]
+        canonical[title_id] = target_id
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as directory:
+        forward_runs, backward_runs = [], []
+        keys = array('Q')
+
+        def flush():
+            forward_runs.append(_write_run(directory, keys))
+            backward_runs.append(_write_run(directory, ((key & 0xFFFFFFFF) << 32 | key >> 32 for key in keys)))
+            del keys[:]
+
+        for source, target in edges:
+            source_id, target_id = ids.get(source), ids.get(target)
+            # リダイレクトのページにあるリンク (リダイレクト先へのリンク) は使わない
+            if source_id is None or target_id is None or canonical[source_id] != source_id:
+                continue
+            keys.append(source_id << 32 | canonical[target_id])
+            if len(keys) >= run_size:
+                flush()
+        flush()
+
+        title_offsets = array('Q', [0])
+        for title in encoded:
+            title_offsets.append(title_offsets[-1] + len(title))
+        title_data = b''.join(encoded)
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, n_titles, 0, len(title_data)))
+            f.seek(_align(f.tell()))
+            title_offsets.tofile(f)
+            offsets_pos = _align(f.tell())
+            f.seek(_align(offsets_pos + 8 * (n_titles + 1)))
+            n_links = _write_links(f, forward_runs, offsets_pos, n_titles)
+            in_offsets_pos = _align(f.tell())
+            f.seek(_align(in_offsets_pos + 8 * (n_titles + 1)))
+            _write_links(f, backward_runs, in_offsets_pos, n_titles)
+            for section in (canonical.tobytes(), title_data):
+                f.write(b'\0' * (_align(f.tell()) - f.tell()))
+                f.write(section)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, n_titles, n_links, len(title_data)))
+    return n_titles, n_links
+
+
+def write_index(path: str, graph: Dict[str, Set[str]], redirects: Dict[str, str] = None):
+    # メモリ上のグラフから作る (テスト・ベンチマーク用)
+    titles = {normalize_plain_title(title) for title in graph}
+    for links in graph.values():
+        titles.update(normalize_plain_title(link) for link in links)
+    edges = ((normalize_plain_title(source), normalize_plain_title(target))
+             for source, links in graph.items() for target in links)
+    redirects = ((normalize_plain_title(source), normalize_plain_title(target))
+                 for source, target in (redirects or {}).items())
+    return build_index(path, titles, edges, redirects)
+
+
+def _open_text(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+def _iter_tsv(path: str) -> Iterator[List[str]]:
+    with _open_text(path) as f:
+        for line in f:
+            columns = [normalize_plain_title(column) for column in line.rstrip('\n').split('\t')]
+            if columns[0]:
+                yield [column for column in columns if column]
+
+
+def read_tsv(path: str) -> Tuple[Set[str], Iterator[Tuple[str, str]]]:
+    # 1行: タイトル<TAB>リンク先1<TAB>リンク先2 ...  (同じタイトルが複数行にあってもよい)
+    # タイトルの一覧を読んだ後、リンクはファイルをもう一度読みながら返す
+    titles = set()
+    for columns in _iter_tsv(path):
+        titles.update(columns)
+    edges = ((columns[0], target) for columns in _iter_tsv(path) for target in columns[1:])
+    return titles, edges
+
+
+_SQL_VALUE = re.compile(r"'((?:[^'\\]|\\.)*)'|(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)|(NULL)")
+_SQL_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '0': '\0', 'Z': '\x1a'}
+
+
+def _unescape(value: str):
+    return re.sub(r'\\(.)', lambda m: _SQL_ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def _parse_sql_values(line: str, pos: int) -> Iterator[Tuple]:
+    row = []
+    length = len(line)
+    while pos < length:
+        char = line[pos]
+        if char in '(, \n':
+            pos += 1
+            continue
+        if char == ')':
+            yield tuple(row)
+            row = []
+            pos += 1
+            continue
+        if char == ';':
+            return
+        m = _SQL_VALUE.match(line, pos)
+        if m is None:
+            raise ValueError(f'unexpected sql value at {pos}.')
+        if m.group(1) is not None:
+            row.append(_unescape(m.group(1)))
+        elif m.group(2) is not None:
+            row.append(int(m.group(2)) if m.group(2).lstrip('-').isdigit() else float(m.group(2)))
+        else:
+            row.append(None)
+        pos = m.end()
+
+
+def iter_sql_rows(path: str, table: str) -> Iterator[Tuple]:
+    prefix = f'INSERT INTO `{table}` VALUES '
+    with _open_text(path) as f:
+        for line in f:
+            if line.startswith(prefix):
+                yield from _parse_sql_values(line, len(prefix))
+
+
+def read_sql_dump(page_path: str, pagelinks_path: str, linktarget_path: str = None, redirect_path: str = None) \
+        -> Tuple[Set[str], Iterator[Tuple[str, str]], List[Tuple[str, str]]]:
+    # page: (page_id, page_namespace, page_title, ...)
+    # pagelinks: 旧形式 (pl_from, pl_namespace, pl_title, pl_from_namespace)
+    #            新形式 (pl_from, pl_from_namespace, pl_target_id) + linktarget: (lt_id, lt_namespace, lt_title)
+    # redirect: (rd_from, rd_namespace, rd_title, ...)
+    # メモリに読むのはタイトルの表だけで、pagelinksは返したリンクを読み進めながら1行ずつ読む
+    # ダンプのタイトルはMediaWikiが正規化した形なので、そのまま使う
+    page_titles = {row[0]: row[2] for row in iter_sql_rows(page_path, 'page') if row[1] == MAIN_NAMESPACE}
+    link_targets = {}
+    if linktarget_path:
+        link_targets = {row[0]: row[2] for row in iter_sql_rows(linktarget_path, 'linktarget')
+                        if row[1] == MAIN_NAMESPACE}
+    redirects = []
+    if redirect_path:
+        redirects = [(page_titles[row[0]], row[2]) for row in iter_sql_rows(redirect_path, 'redirect')
+                     if row[0] in page_titles and row[1] == MAIN_NAMESPACE]
+
+    def edges():
+        for row in iter_sql_rows(pagelinks_path, 'pagelinks'):
+            source = page_titles.get(row[0])
+            if source is None:
+                continue
+            if len(row) == 3:
+                target = link_targets.get(row[2])
+            else:
+                target = row[2] if row[1] == MAIN_NAMESPACE else None
+            if target is not None:
+                yield source, target
+
+    return set(page_titles.values()), edges(), redirects
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Wikipediaのリンクダンプからリンクグラフのインデックスを作成する')
+    parser.add_argument('output', help='出力するインデックスファイル')
+    parser.add_argument('--tsv', help='タイトル<TAB>リンク先... 形式のファイル')
+    parser.add_argument('--page', help='page テーブルのSQLダンプ')
+    parser.add_argument('--pagelinks', help='pagelinks テーブルのSQLダンプ')
+    parser.add_argument('--linktarget', help='linktarget テーブルのSQLダンプ (新形式のpagelinksの場合)')
+    parser.add_argument('--redirect', help='redirect テーブルのSQLダンプ')
+    parser.add_argument('--run-size', type=int, default=SORT_RUN_SIZE, help='一度にメモリ上でソートするリンクの数')
+    args = parser.parse_args(argv)
+
+    if args.tsv:
+        titles, edges = read_tsv(args.tsv)
+        redirects = []
+    elif args.page and args.pagelinks:
+        titles, edges, redirects = read_sql_dump(args.page, args.pagelinks, args.linktarget, args.redirect)
+    else:
+        parser.error('--tsv か --page/--pagelinks を指定してください')
+    n_titles, n_links = build_index(args.output, titles, edges, redirects, args.run_size)
+    print(f'{n_titles} titles, {n_links} links -> {args.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
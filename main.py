@@ -1,161 +1,165 @@
-from flask import Flask, jsonify, request
+import time
+
+from flask import Flask, Response, jsonify, request, g
 from flask_cors import CORS
 
-from rooms import (create_room_id, init_room, _join_room, setting_article, change_room_status, change_player_progress,
-                   get_room_users, is_all_room_users_done, _destroy_room)
-from firestore import (record_player_progress, cancel_player_progress, record_game_result,
-                       delete_all_document_in_collection)
-from exceptions import (RoomNotExistException, RoomIdDuplicateException, URLValidationException, NotInRoomUserException,
-                        NotHostException)
-from conf import CORS_WHITELIST, fs, logging_client, resource
+import handlers
+from rooms import enter_room_context, exit_room_context, current_room_context
+from firestore import TOP_ARTICLES_LIMIT
+from exceptions import TooManyRequestsException
+from validation import use_link_index
+from room_events import subscribe, unsubscribe, stream
+from admission import create_admission, client_ip, ConcurrencyLimiter, EXEMPT_ROUTES, NO_SLOT_ROUTES
+from shards import use_shards
+from link_index import LinkIndex
+from metrics import observe_request, render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from conf import (CORS_WHITELIST, RTDB_SHARD_URLS, LINK_INDEX_PATH, RATE_LIMIT_UUID_RATE, RATE_LIMIT_UUID_BURST,
+                  RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, RATE_LIMIT_MAX_KEYS, MAX_IN_FLIGHT, TRUSTED_PROXY_COUNT,
+                  MAX_EVENT_STREAMS)
 
 app = Flask(__name__)
 CORS(app, origins=CORS_WHITELIST)
-logger = logging_client.logger(__name__)
+
+use_shards(RTDB_SHARD_URLS)
+admission = create_admission(RATE_LIMIT_UUID_RATE, RATE_LIMIT_UUID_BURST, RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST,
+                             RATE_LIMIT_MAX_KEYS, MAX_IN_FLIGHT)
+event_streams = ConcurrencyLimiter(MAX_EVENT_STREAMS)
+if LINK_INDEX_PATH:
+    use_link_index(LinkIndex.open(LINK_INDEX_PATH))
+
+
+# ルートの処理はhandlers.py。ここではリクエストから値を取り出してJSONにするだけ
+def respond(result):
+    body, status = result
+    return jsonify(body), status
+
+
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    # リクエスト中はroomのスナップショットを使い回す
+    g.room_context_token = enter_room_context()
+    return admit_request()
+
+
+def admit_request():
+    # 混んでいたら処理せずにすぐ429を返す (待たせない)
+    route = request.url_rule.rule if request.url_rule else None
+    if route is None or route in EXEMPT_ROUTES or request.method == 'OPTIONS':
+        return None
+    data = request.get_json(silent=True) if request.is_json else None
+    user_uuid = data.get('uuid') if isinstance(data, dict) else None
+    hold_slot = route not in NO_SLOT_ROUTES
+    try:
+        admission.admit(None if user_uuid is None else str(user_uuid),
+                        client_ip(request.access_route, request.remote_addr, TRUSTED_PROXY_COUNT), hold_slot)
+    except TooManyRequestsException as e:
+        return jsonify({'message': e.message}), e.status_code, {'Retry-After': str(e.retry_after)}
+    g.holds_slot = hold_slot
+    return None
+
+
+@app.after_request
+def finish_request(response):
+    ctx = current_room_context()
+    if ctx is not None:
+        response.headers['X-Backend-Reads'] = str(ctx.reads)
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe_request(route, request.method, response.status_code, time.perf_counter() - g.request_started)
+    return response
+
+
+@app.teardown_request
+def close_room_context(exc):
+    if 'room_context_token' in g:
+        exit_room_context(g.room_context_token)
+    if g.get('holds_slot'):
+        admission.release()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return render_metrics(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
+
+@app.route('/admin/gc', methods=['POST'])
+def collect_garbage():
+    return respond(handlers.collect_garbage(request.headers.get('X-GC-Token'), request.get_json(silent=True)))
 
 
 @app.route('/room', methods=['POST'])
 def create_room():
-    try:
-        room_id = create_room_id()
-        data = request.get_json()
-        user_uuid, user_name = data['uuid'], data['name']
-        init_room(room_id, user_uuid, user_name)
-        return jsonify({'room_id': room_id}), 201
-    except RoomIdDuplicateException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except Exception as e:
-        logger.log_struct(
-            {'error': str(e)},
-            resource=resource,
-            severity='ERROR'
-        )
-        return jsonify({'message': 'create_room failed.'}), 400
+    return respond(handlers.create_room(request.get_json()))
 
 
 @app.route('/room/start', methods=['POST'])
 def start_room():
-    try:
-        data = request.get_json()
-        user_uuid, room_id = data['uuid'], data['room_id']
-        change_room_status(room_id, user_uuid, start=True)
-        return jsonify({'message': 'game started.'}), 200
-    except RoomNotExistException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except NotInRoomUserException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except Exception as e:
-        logger.log_struct(
-            {'error': str(e)},
-            resource=resource,
-            severity='ERROR'
-        )
-        return jsonify({'message': 'game start failed.'}), 400
+    return respond(handlers.start_room(request.get_json()))
 
 
 @app.route('/room/end', methods=['POST'])
 def end_room():
-    try:
-        data = request.get_json()
-        user_uuid, room_id = data['uuid'], data['room_id']
-        change_room_status(room_id, user_uuid, start=False)
-        record_game_result(room_id)
-    except NotHostException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except Exception as e:
-        logger.log_struct(
-            {'error': str(e)},
-            resource=resource,
-            severity='ERROR'
-        )
-        return jsonify({'message': 'end room failed.'}), 400
+    return respond(handlers.end_room(request.get_json()))
 
 
 @app.route('/room', methods=['DELETE'])
 def destroy_room():
-    try:
-        data = request.get_json()
-        room_id, user_uuid = data.get('room_id'), data.get('uuid')
-        _destroy_room(room_id, user_uuid=user_uuid)
-        return jsonify({'message': 'room deleted.'}), 204
-    except RoomNotExistException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except NotHostException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except Exception as e:
-        return jsonify({'message': 'error destroy room.'}), 400
+    return respond(handlers.destroy_room(request.get_json()))
 
 
 @app.route('/room/join', methods=['POST'])
 def join_room():
-    try:
-        data = request.get_json()
-        room_id, user_name, user_uuid = data['room_id'], data['name'], data['uuid']
-        _join_room(room_id, user_uuid, user_name)
-        return jsonify({'room_id': room_id}), 201
-    except RoomNotExistException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except Exception as e:
-        logger.log_struct(
-            {'error': str(e)},
-            resource=resource,
-            severity='ERROR'
-        )
-        return jsonify({'message': 'join room failed.'}), 400
+    return respond(handlers.join_room(request.get_json()))
 
 
 @app.route('/room/articles', methods=['POST'])
 def set_article():
-    try:
-        data = request.get_json()
-        room_id, target, url = data['room_id'], data['target'], data['url']
-        is_start = True if target == 'start' else False
-        setting_article(room_id, url, is_start)
-        return jsonify(), 201
-    except RoomNotExistException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except Exception as e:
-        logger.log_struct(
-            {'error': str(e)},
-            resource=resource,
-            severity='ERROR'
-        )
-        return jsonify({'message': 'set_article failed.'}), 400
-
-
-# TODO: too big!!!
+    return respond(handlers.set_article(request.get_json()))
+
+
+@app.route('/room/<int:room_id>/result', methods=['GET'])
+def game_result(room_id):
+    return respond(handlers.game_result(room_id))
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return respond(handlers.stats(request.args.get('top', TOP_ARTICLES_LIMIT, type=int)))
+
+
+@app.route('/stats/pair', methods=['GET'])
+def pair_stats():
+    return respond(handlers.pair_stats(request.args.get('start'), request.args.get('goal')))
+
+
+@app.route('/room/<int:room_id>/events', methods=['GET'])
+def room_events(room_id):
+    # roomの変化をServer-Sent Eventsで送る。再接続したときはLast-Event-IDの続きから送る
+    # 接続している間はgunicornのスレッドを1つ使う (Dockerfileのgthreadワーカー)。
+    # 他のリクエストを処理するスレッドが残るよう、同時に開く接続はMAX_EVENT_STREAMSまでにする
+    if not event_streams.try_acquire():
+        return jsonify({'message': 'too many event streams.'}), 503, {'Retry-After': '5'}
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    feed = subscribe(room_id)
+    if not feed.wait_loaded() or feed.data is None:
+        unsubscribe(feed)
+        event_streams.release()
+        return jsonify({'message': 'room not found.'}), 404
+    response = Response(stream(feed, last_event_id), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(event_streams.release)
+    return response
+
+
+@app.route('/room/<int:room_id>/warmup', methods=['GET'])
+def warmup_status(room_id):
+    return respond(handlers.warmup_status(room_id))
+
+
 @app.route('/room/player-progress', methods=['POST'])
 def done():
-    # required request params: room_id, user_uuid, is_done
-    try:
-        data = request.get_json()
-        room_id, urls, user_uuid, name, is_done, is_surrendered \
-            = data.get('room_id'), data.get('urls'), data.get('uuid'), \
-              data.get('name'), data.get('is_done'), data.get('is_surrendered')
-        change_player_progress(room_id, user_uuid, is_done, is_surrendered)
-        if is_done:
-            if not room_id or urls is None or not user_uuid or not name or is_surrendered is None:
-                raise
-            record_player_progress(room_id, user_uuid, name, urls, is_surrendered)
-            room_users = get_room_users(room_id)
-            if is_all_room_users_done(room_users):
-                record_game_result(room_id)
-                change_room_status(room_id, user_uuid, start=False, force_change=True)
-                delete_all_document_in_collection(fs.collection('progress').document(str(room_id)).collection('users'))
-        else:
-            cancel_player_progress(room_id, user_uuid)
-        return jsonify({'message': 'urls is valid.'}), 200
-    except RoomNotExistException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except URLValidationException as e:
-        return jsonify({'message': e.message}), e.status_code
-    except Exception as e:
-        logger.log_struct(
-            {'error': str(e)},
-            resource=resource,
-            severity='ERROR'
-        )
-        return jsonify({'message': 'failed done.'}), 400
+    return respond(handlers.player_progress(request.get_json()))
 
 
 if __name__ == '__main__':
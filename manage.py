@@ -0,0 +1,101 @@
+# 運用のためのコマンド
+# python manage.py migrate-results [--dry-run]
+# python manage.py rebuild-stats [--dry-run]
+# python manage.py rebalance-shards --to-urls URL1,URL2,URL3 [--from-urls URL1,URL2] [--dry-run]
+# python manage.py gc [--dry-run] [--room-ttl 86400] [--ended-room-ttl 3600] [--backfill-index]
+# python manage.py startup-report [--module main] [--init] [--top 15]
+import sys
+import json
+import argparse
+
+
+def migrate_results(args):
+    from firestore import migrate_game_results
+    return migrate_game_results(page_size=args.page_size, dry_run=args.dry_run)
+
+
+def rebuild_stats(args):
+    from firestore import rebuild_aggregates
+    return rebuild_aggregates(page_size=args.page_size, dry_run=args.dry_run)
+
+
+def _use_shards():
+    from shards import use_shards
+    from conf import RTDB_SHARD_URLS
+    use_shards(RTDB_SHARD_URLS)
+
+
+def rebalance_shards(args):
+    from shards import ShardRouter, rebalance, shard_room_counts
+    from rooms import ROOM_ACTIVITY_PATH, ENDED_ROOMS_PATH
+    from conf import RTDB_SHARD_URLS
+    source = ShardRouter(args.from_urls.split(',') if args.from_urls else RTDB_SHARD_URLS)
+    target = ShardRouter(args.to_urls.split(','))
+    result = {'before': shard_room_counts(source),
+              'rebalance': rebalance(source, target, (ROOM_ACTIVITY_PATH, ENDED_ROOMS_PATH),
+                                     batch_size=args.batch_size, dry_run=args.dry_run)}
+    if not args.dry_run:
+        result['after'] = shard_room_counts(target)
+    return result
+
+
+def gc(args):
+    from sweeper import sweep, backfill_activity_index
+    _use_shards()
+    result = {}
+    if args.backfill_index:
+        result['backfill'] = backfill_activity_index()
+    kwargs = {key: value for key, value in (('room_ttl', args.room_ttl), ('ended_room_ttl', args.ended_room_ttl),
+                                           ('batch_size', args.batch_size)) if value is not None}
+    result['sweep'] = sweep(max_rooms=args.max_rooms, dry_run=args.dry_run, **kwargs)
+    return result
+
+
+def startup_report(args):
+    from startup_report import run
+    return run(module=args.module, init=args.init, top=args.top)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='wikipedia-gameの運用コマンド')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate = commands.add_parser('migrate-results', help='圧縮前の形式のgame-resultsを圧縮形式に書き換える')
+    migrate.add_argument('--page-size', type=int, default=500)
+    migrate.add_argument('--dry-run', action='store_true', help='書き込まずに件数とサイズだけを表示する')
+    migrate.set_defaults(handler=migrate_results)
+
+    rebuild = commands.add_parser('rebuild-stats', help='game-resultsから集計(stats)を作り直す')
+    rebuild.add_argument('--page-size', type=int, default=500)
+    rebuild.add_argument('--dry-run', action='store_true', help='書き込まずに件数だけを表示する')
+    rebuild.set_defaults(handler=rebuild_stats)
+
+    rebalance = commands.add_parser('rebalance-shards', help='シャードの数を変えたときに、roomを新しいシャードへ移す')
+    rebalance.add_argument('--to-urls', required=True, help='変更後のRTDB_SHARD_URLS')
+    rebalance.add_argument('--from-urls', help='変更前のRTDB_SHARD_URLS (デフォルトは今の設定)')
+    rebalance.add_argument('--batch-size', type=int, default=100)
+    rebalance.add_argument('--dry-run', action='store_true', help='移さずにシャードごとのroom数と移動数を表示する')
+    rebalance.set_defaults(handler=rebalance_shards)
+
+    sweeper = commands.add_parser('gc', help='期限切れ・終了済みのroomとprogressを削除する')
+    sweeper.add_argument('--room-ttl', type=int, help='最後の書き込みからの秒数 (デフォルトはROOM_TTL)')
+    sweeper.add_argument('--ended-room-ttl', type=int, help='ENDEDになってからの秒数 (デフォルトはENDED_ROOM_TTL)')
+    sweeper.add_argument('--batch-size', type=int)
+    sweeper.add_argument('--max-rooms', type=int)
+    sweeper.add_argument('--dry-run', action='store_true', help='削除せずに対象のroomを表示する')
+    sweeper.add_argument('--backfill-index', action='store_true', help='インデックスに無いroomを今の時刻で登録する')
+    sweeper.set_defaults(handler=gc)
+
+    startup = commands.add_parser('startup-report', help='起動時のimportにかかる時間の内訳を表示する')
+    startup.add_argument('--module', default='main', help='読み込むモジュール')
+    startup.add_argument('--init', action='store_true',
+                         help='Firebase・Firestore・Wikipediaのクライアントを最初に使うまでの時間も測る')
+    startup.add_argument('--top', type=int, default=15)
+    startup.set_defaults(handler=startup_report)
+
+    args = parser.parse_args(argv)
+    print(json.dumps(args.handler(args), ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+import time
+from threading import Lock
+from contextlib import contextmanager
+from typing import Sequence, Tuple
+
+# Prometheusのテキスト形式で出力する最小限のメトリクス
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: Tuple = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value: float):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # ラベルごとに [各bucketの件数..., 合計値, 件数]
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[idx] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, *labels):
+        state = self._values.get(labels)
+        return state[-1] if state else 0
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = ('le', _format_value(bound))
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, (le,))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(state[-2])}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {state[-1]}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+http_requests_total = REGISTRY.register(Counter(
+    'http_requests_total', 'HTTP requests by route and status.', ('route', 'method', 'status')))
+http_request_duration_seconds = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route.', ('route', 'method')))
+backend_calls_total = REGISTRY.register(Counter(
+    'backend_calls_total', 'RTDB/Firestore calls by calling function.', ('backend', 'caller', 'outcome')))
+backend_call_duration_seconds = REGISTRY.register(Histogram(
+    'backend_call_duration_seconds', 'RTDB/Firestore call latency by calling function.', ('backend', 'caller')))
+wikipedia_seconds = REGISTRY.register(Histogram(
+    'wikipedia_seconds', 'Wikipedia page fetch and link parse time.', ('phase',)))
+
+
+@contextmanager
+def backend_call(backend: str, caller: str):
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        backend_call_duration_seconds.observe(time.perf_counter() - started, backend, caller)
+        backend_calls_total.inc(backend, caller, outcome)
+
+
+def rtdb_call(caller: str):
+    return backend_call('rtdb', caller)
+
+
+def firestore_call(caller: str):
+    return backend_call('firestore', caller)
+
+
+def observe_request(route: str, method: str, status: int, seconds: float):
+    http_request_duration_seconds.observe(seconds, route, method)
+    http_requests_total.inc(route, method, str(status))
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,141 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from path_codec import encode_progress, decode_progress, encode_game_result, decode_game_result
+
+# room・プレイヤー・progress・ゲーム結果の型と、RTDB/Firestoreに保存する形との変換
+# 大きなroomでもメモリと生成の時間を抑えるため、インスタンスの__dict__を持たない(__slots__)
+# 本番はPython 3.9なので dataclass(slots=True) は使えず、__slots__を書く (そのためフィールドにデフォルト値は付けられない)
+# 保存する形はrooms.py・firestore.pyの先頭のコメントを参照
+
+
+@dataclass
+class Player:
+    __slots__ = ('name', 'is_done', 'is_surrendered')
+    name: Optional[str]
+    is_done: bool
+    is_surrendered: bool
+
+    @classmethod
+    def joined(cls, name: str):
+        return cls(name, False, False)
+
+    @classmethod
+    def from_rtdb(cls, data: Optional[dict]):
+        if data is None:
+            return None
+        return cls(data.get('name'), data.get('isDone', False), data.get('isSurrendered', False))
+
+    def to_rtdb(self):
+        return {'name': self.name, 'isDone': self.is_done, 'isSurrendered': self.is_surrendered}
+
+
+@dataclass
+class Room:
+    __slots__ = ('status', 'host', 'users', 'start', 'goal', 'is_ready', 'finalizing', 'shortest_path',
+                 'started_at')
+    status: Optional[str]
+    host: Optional[str]
+    users: Dict[str, Player]
+    start: Optional[str]
+    goal: Optional[str]
+    is_ready: bool
+    finalizing: Optional[dict]  # 集計処理の確保 {'by': str, 'at': int}
+    shortest_path: Optional[dict]  # {'status': str, 'distance': int, 'path': [str]}
+    started_at: Optional[int]
+
+    @classmethod
+    def new(cls, status: str, host_uuid: str, host_name: str):
+        return cls(status, host_uuid, {host_uuid: Player.joined(host_name)}, None, None, False, None, None, None)
+
+    @classmethod
+    def from_rtdb(cls, data: Optional[dict]):
+        if data is None:
+            return None
+        users = data.get('users') or {}
+        return cls(data.get('status'), data.get('host'),
+                   {user_uuid: Player.from_rtdb(user) for user_uuid, user in users.items()},
+                   data.get('start'), data.get('goal'), data.get('isReady', False), data.get('isFinalizing'),
+                   data.get('shortestPath'), data.get('startedAt'))
+
+    def to_rtdb(self):
+        # 値の無い項目は書かない (RTDBでは書かないのとNoneは同じ)
+        data = {'isReady': self.is_ready,
+                'users': {user_uuid: player.to_rtdb() for user_uuid, player in self.users.items()}}
+        for key, value in (('status', self.status), ('host', self.host), ('start', self.start), ('goal', self.goal),
+                           ('isFinalizing', self.finalizing), ('shortestPath', self.shortest_path),
+                           ('startedAt', self.started_at)):
+            if value is not None:
+                data[key] = value
+        return data
+
+
+@dataclass
+class Progress:
+    __slots__ = ('uuid', 'name', 'urls', 'is_surrendered', 'validation')
+    uuid: str
+    name: Optional[str]
+    urls: List[str]
+    is_surrendered: bool
+    validation: Optional[dict]  # {'isValid': bool, 'message': str}
+
+    @classmethod
+    def from_firestore(cls, uuid: str, data: dict):
+        data = decode_progress(data)
+        return cls(uuid, data.get('name'), data.get('urls') or [], data.get('isSurrendered', False),
+                   data.get('validation'))
+
+    def to_firestore(self):
+        # ドキュメントIDがuuidなので、uuidは入れない
+        data = {'name': self.name, 'urls': self.urls if not self.is_surrendered else [],
+                'isSurrendered': self.is_surrendered}
+        if self.validation is not None:
+            data['validation'] = self.validation
+        return encode_progress(data)
+
+    def to_dict(self):
+        # APIとgame-resultsのresultsの形
+        data = {'uuid': self.uuid, 'name': self.name, 'urls': self.urls, 'isSurrendered': self.is_surrendered}
+        if self.validation is not None:
+            data['validation'] = self.validation
+        return data
+
+
+@dataclass
+class GameResult:
+    __slots__ = ('start', 'goal', 'results', 'created_at', 'shortest_distance', 'started_at')
+    start: Optional[str]
+    goal: Optional[str]
+    results: List[Progress]
+    created_at: Optional[datetime]
+    shortest_distance: Optional[int]
+    started_at: Optional[int]
+
+    @classmethod
+    def from_room(cls, room: Room, progresses: List[Progress], created_at: datetime):
+        # roomに残っているプレイヤーのprogressだけを結果にする
+        shortest_path = room.shortest_path or {}
+        return cls(room.start, room.goal, [progress for progress in progresses if progress.uuid in room.users],
+                   created_at, shortest_path.get('distance'), room.started_at)
+
+    @classmethod
+    def from_firestore(cls, data: dict):
+        data = decode_game_result(data)
+        results = [Progress(result.get('uuid'), result.get('name'), result.get('urls') or [],
+                            result.get('isSurrendered', False), result.get('validation'))
+                   for result in data.get('results') or []]
+        return cls(data.get('start'), data.get('goal'), results, data.get('createAt'), data.get('shortestDistance'),
+                   data.get('startedAt'))
+
+    def to_dict(self):
+        data = {'start': self.start, 'goal': self.goal, 'results': [result.to_dict() for result in self.results]}
+        # 以前からcreateAtという名前で保存している
+        for key, value in (('createAt', self.created_at), ('shortestDistance', self.shortest_distance),
+                           ('startedAt', self.started_at)):
+            if value is not None:
+                data[key] = value
+        return data
+
+    def to_firestore(self):
+        return encode_game_result(self.to_dict())
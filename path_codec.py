@@ -0,0 +1,167 @@
+from typing import Dict, List, Optional
+from urllib.parse import quote, unquote, urlsplit
+
+from titles import ARTICLE_PATH, TITLE_SAFE
+
+# Firestoreに保存する経路の圧縮形式
+# URLは https://{host}/wiki/ を除いてデコードしたタイトルにし、ドキュメントごとの辞書(titles)に1度だけ入れる
+# 経路は辞書の位置をカンマ区切りにした文字列で持つ
+# {
+#     'format': 2,
+#     'base': 'https://ja.wikipedia.org',
+#     'titles': ['タイトル1', 'タイトル2', '#https://example.com/'],  # 元に戻せないURLは#を付けてそのまま入れる
+#     'path': '0,1,2'
+# }
+FORMAT_VERSION = 2
+PATH_SEPARATOR = ','
+# タイトルに使えない文字なので、タイトルと区別できる
+RAW_URL_PREFIX = '#'
+
+
+def _split_article_url(url: str):
+    # (ホストまでのURL, タイトル) に分ける。元のURLに正確に戻せない場合はNone
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.path.startswith(ARTICLE_PATH) or parts.query or parts.fragment:
+        return None
+    title = unquote(parts.path[len(ARTICLE_PATH):])
+    base_url = f'{parts.scheme}://{parts.netloc}'
+    if not title or title.startswith(RAW_URL_PREFIX) or f'{base_url}{ARTICLE_PATH}{quote(title, safe=TITLE_SAFE)}' != url:
+        return None
+    return base_url, title
+
+
+def _split_article_urls(paths: List[List[str]]):
+    # 同じURLは1度だけ分ける (大きなroomでは全員の経路に同じページが何度も出てくる)
+    splits = {}
+    for urls in paths:
+        for url in urls:
+            if url not in splits:
+                splits[url] = _split_article_url(url)
+    return splits
+
+
+def _detect_base_url(splits: Dict[str, Optional[tuple]], paths: List[List[str]]):
+    counts = {}
+    for urls in paths:
+        for url in urls:
+            split = splits[url]
+            if split is not None:
+                counts[split[0]] = counts.get(split[0], 0) + 1
+    return max(counts, key=counts.get) if counts else None
+
+
+class PathEncoder:
+    # 1ドキュメント分の辞書を作りながら経路を符号化する
+    def __init__(self, base_url: Optional[str], splits: Dict[str, Optional[tuple]] = None):
+        self.base_url = base_url
+        self.titles = []
+        self._tokens = {}
+        # URL -> 辞書の位置
+        self._url_tokens = {}
+        self._splits = splits or {}
+
+    def _token(self, url: str):
+        token = self._url_tokens.get(url)
+        if token is not None:
+            return token
+        split = self._splits[url] if url in self._splits else _split_article_url(url)
+        entry = split[1] if split is not None and split[0] == self.base_url else RAW_URL_PREFIX + url
+        token = self._tokens.get(entry)
+        if token is None:
+            token = self._tokens[entry] = len(self.titles)
+            self.titles.append(entry)
+        self._url_tokens[url] = token
+        return token
+
+    def encode(self, urls: List[str]):
+        return PATH_SEPARATOR.join(str(self._token(url)) for url in urls)
+
+
+def _entry_url(base_url: Optional[str], entry: str):
+    if entry.startswith(RAW_URL_PREFIX):
+        return entry[len(RAW_URL_PREFIX):]
+    return f'{base_url}{ARTICLE_PATH}{quote(entry, safe=TITLE_SAFE)}'
+
+
+def _decode_tokens(entry_urls: List[str], path: Optional[str]):
+    if path is None:
+        # 省略されていれば辞書の順番どおり
+        return list(entry_urls)
+    if not path:
+        return []
+    return [entry_urls[int(token)] for token in path.split(PATH_SEPARATOR)]
+
+
+def decode_path(base_url: Optional[str], titles: List[str], path: Optional[str]):
+    return _decode_tokens([_entry_url(base_url, entry) for entry in titles], path)
+
+
+def is_compact(data: Dict):
+    return data.get('format') == FORMAT_VERSION
+
+
+def encode_progress(data: Dict):
+    # {'name', 'urls', 'isSurrendered', ...} -> 圧縮形式
+    urls = data.get('urls') or []
+    splits = _split_article_urls([urls])
+    encoder = PathEncoder(_detect_base_url(splits, [urls]), splits)
+    path = encoder.encode(urls)
+    encoded = {key: value for key, value in data.items() if key != 'urls'}
+    encoded.update({'format': FORMAT_VERSION, 'base': encoder.base_url, 'titles': encoder.titles})
+    # 同じページを2度通らなければ経路は辞書と同じ順番になるので省く
+    if path != PATH_SEPARATOR.join(str(token) for token in range(len(urls))):
+        encoded['path'] = path
+    return encoded
+
+
+def decode_progress(data: Dict):
+    # 圧縮前の形式のドキュメントはそのまま返す
+    if not is_compact(data):
+        return data
+    decoded = {key: value for key, value in data.items() if key not in ('format', 'base', 'titles', 'path')}
+    decoded['urls'] = decode_path(data.get('base'), data.get('titles', []), data.get('path'))
+    return decoded
+
+
+def encode_game_result(data: Dict):
+    # resultsの全員の経路で1つの辞書を共有する
+    results = data.get('results') or []
+    paths = [result.get('urls') or [] for result in results]
+    splits = _split_article_urls(paths)
+    encoder = PathEncoder(_detect_base_url(splits, paths), splits)
+    encoded_results = []
+    for result in results:
+        encoded_result = {key: value for key, value in result.items() if key != 'urls'}
+        encoded_result['path'] = encoder.encode(result.get('urls') or [])
+        encoded_results.append(encoded_result)
+    encoded = dict(data, results=encoded_results)
+    encoded.update({'format': FORMAT_VERSION, 'base': encoder.base_url, 'titles': encoder.titles})
+    return encoded
+
+
+def decode_game_result(data: Dict):
+    if not is_compact(data):
+        return data
+    base_url, titles = data.get('base'), data.get('titles', [])
+    # 辞書のURLは全員の経路で共通なので1度だけ作る
+    entry_urls = [_entry_url(base_url, entry) for entry in titles]
+    decoded = {key: value for key, value in data.items() if key not in ('format', 'base', 'titles')}
+    decoded['results'] = []
+    for result in data.get('results', []):
+        decoded_result = {key: value for key, value in result.items() if key != 'path'}
+        decoded_result['urls'] = _decode_tokens(entry_urls, result.get('path', ''))
+        decoded['results'].append(decoded_result)
+    return decoded
+
+
+def document_size(value):
+    # Firestoreの課金・上限で使われるサイズ (https://firebase.google.com/docs/firestore/storage-size)
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, dict):
+        return sum(document_size(key) + document_size(child) for key, child in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(document_size(child) for child in value)
+    if value is None or isinstance(value, bool):
+        return 1
+    return 8
@@ -0,0 +1,262 @@
+import copy
+import json
+import time
+import uuid
+import threading
+from collections import deque
+
+from metrics import REGISTRY, Counter
+from shards import room_shard
+
+# roomの状態をプロセス内にキャッシュし、変化をServer-Sent Eventsで配信する
+# 購読者がいるroomだけRTDBのリスナーを1つ張り、全ての購読者に配る
+# サーバー自身の書き込みはリスナーからの通知を待たずにキャッシュへ反映する
+# イベントIDは {フィードごとのID}.{バージョン}。フィードが変わっていたらLast-Event-IDからは再開せずsnapshotを送る
+EVENT_HISTORY = 256  # Last-Event-IDで再開できるイベントの数
+HEARTBEAT_INTERVAL = 15  # 秒
+INITIAL_LOAD_TIMEOUT = 10  # 秒
+# 購読者がいなくなったフィードを残しておく時間 (再接続したときに続きから送れるように)
+FEED_IDLE_TTL = 60  # 秒
+
+SNAPSHOT = 'snapshot'
+USER_JOINED = 'user_joined'
+USER_LEFT = 'user_left'
+PLAYER_DONE = 'player_done'
+ARTICLE_SET = 'article_set'
+STATUS_CHANGED = 'status_changed'
+SHORTEST_PATH = 'shortest_path'
+ROOM_DELETED = 'room_deleted'
+KEEPALIVE = ': keepalive\n\n'
+
+room_events_total = REGISTRY.register(Counter('room_events_total', 'Room events published by type.', ('type',)))
+room_event_subscriptions_total = REGISTRY.register(Counter(
+    'room_event_subscriptions_total', 'Subscriptions to room event streams.'))
+
+
+def _patched(data, path: str, value):
+    # dataのpathにvalueを書き込んだ結果を返す (dataは変更しない)
+    parts = [part for part in path.split('/') if part]
+    if not parts:
+        return copy.deepcopy(value)
+    data = copy.deepcopy(data) if isinstance(data, dict) else {}
+    node = data
+    for part in parts[:-1]:
+        child = node.get(part)
+        if not isinstance(child, dict):
+            child = node[part] = {}
+        node = child
+    if value is None:
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = copy.deepcopy(value)
+    return data or None
+
+
+def diff_room(old, new):
+    # roomの2つの状態の差分を (イベントの種類, データ) のリストにする
+    if new is None:
+        return [(ROOM_DELETED, {})] if old is not None else []
+    old = old or {}
+    events = []
+    old_users, new_users = old.get('users') or {}, new.get('users') or {}
+    for user_uuid, user in new_users.items():
+        before = old_users.get(user_uuid)
+        if before is None:
+            events.append((USER_JOINED, dict(user, uuid=user_uuid)))
+        elif (before.get('isDone'), before.get('isSurrendered')) != (user.get('isDone'), user.get('isSurrendered')):
+            events.append((PLAYER_DONE, {'uuid': user_uuid, 'isDone': user.get('isDone'),
+                                         'isSurrendered': user.get('isSurrendered')}))
+    for user_uuid in old_users:
+        if user_uuid not in new_users:
+            events.append((USER_LEFT, {'uuid': user_uuid}))
+    for target in ('start', 'goal'):
+        if old.get(target) != new.get(target):
+            events.append((ARTICLE_SET, {'target': target, 'url': new.get(target)}))
+    if old.get('status') != new.get('status'):
+        events.append((STATUS_CHANGED, {'status': new.get('status')}))
+    if old.get('shortestPath') != new.get('shortestPath'):
+        events.append((SHORTEST_PATH, {'shortestPath': new.get('shortestPath')}))
+    return events
+
+
+def format_event(event_id: str, kind: str, payload):
+    return f'id: {event_id}\nevent: {kind}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'
+
+
+class RoomFeed:
+    # 1つのroomのキャッシュ。変化するたびにバージョンを上げ、直近のイベントを残しておく
+    def __init__(self, room_id):
+        self.room_id = str(room_id)
+        self.feed_id = uuid.uuid4().hex[:8]
+        self.data = None
+        self.version = 0
+        self.events = deque(maxlen=EVENT_HISTORY)
+        self.loaded = threading.Event()
+        self.subscribers = 0
+        self.idle_since = None
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._snapshot = None
+        # リスナーを止めている間、dataは古い。再開して最初の通知が届くまで読ませない
+        self._stale = False
+
+    @property
+    def listening(self):
+        return self._listener is not None
+
+    def start(self):
+        with self._listener_lock:
+            if self._listener is None and self.subscribers > 0:
+                shard = room_shard(self.room_id)
+                with shard.call('room_events.listen'):
+                    self._listener = shard.reference(f'{self.room_id}/').listen(self.on_event)
+
+    def stop(self):
+        with self._listener_lock:
+            if self._listener is not None and self.subscribers == 0:
+                self._listener.close()
+                self._listener = None
+                with self._lock:
+                    self._stale = self.loaded.is_set()
+                    self.loaded.clear()
+                    self._snapshot = None
+
+    def _commit(self, mutate):
+        with self._lock:
+            data = mutate(self.data)
+            if data != self.data:
+                self._snapshot = None
+            # 最初の読み込みはイベントにしない。リスナーを止めていた間の変化は、古いdataとの差分をイベントにする
+            deltas = diff_room(self.data, data) if self.loaded.is_set() or self._stale else []
+            self.data = data
+            self._stale = False
+            if not self.loaded.is_set():
+                self.loaded.set()
+            elif not deltas:
+                return
+            # 購読者ごとに整形しないよう、送る形にしてから残す
+            for kind, payload in deltas:
+                self.version += 1
+                self.events.append((self.version, format_event(self.event_id(self.version), kind, payload)))
+            self._changed.notify_all()
+        for kind, _ in deltas:
+            room_events_total.inc(kind)
+
+    def on_event(self, event):
+        # RTDBのリスナーから呼ばれる。pathはroomからの相対パス
+        if event.event_type == 'put':
+            self._commit(lambda data: _patched(data, event.path, event.data))
+        elif event.event_type == 'patch':
+            def _patch(data):
+                for child, value in (event.data or {}).items():
+                    data = _patched(data, f'{event.path}/{child}', value)
+                return data
+            self._commit(_patch)
+
+    def apply_write(self, values: dict):
+        # サーバー自身の書き込み ({roomからの相対パス: 値})。値が決まらないサーバー側のタイムスタンプは飛ばす
+        def _apply(data):
+            for path, value in values.items():
+                if isinstance(value, dict) and '.sv' in value:
+                    continue
+                data = _patched(data, path, value)
+            return data
+        self._commit(_apply)
+
+    def wait_loaded(self, timeout: float = INITIAL_LOAD_TIMEOUT):
+        return self.loaded.wait(timeout)
+
+    def wait_for_change(self, version: int, timeout: float):
+        with self._changed:
+            return self._changed.wait_for(lambda: self.version != version, timeout)
+
+    def event_id(self, version: int):
+        return f'{self.feed_id}.{version}'
+
+    def parse_event_id(self, event_id):
+        # このフィードのイベントIDならバージョンを返す
+        feed_id, _, version = (event_id or '').partition('.')
+        if feed_id != self.feed_id or not version.isdigit():
+            return None
+        return int(version)
+
+    def read(self, version):
+        # versionより後のメッセージ、新しいバージョン、roomが消えたか を返す
+        # 続きのイベントが残っていなければ今の状態をsnapshotとして送る
+        with self._lock:
+            if version is not None and version == self.version:
+                messages = []
+            elif version is not None and self.events and self.events[0][0] <= version + 1 <= self.version:
+                # 新しいものから遡る (追いついている購読者は数件しか読まない)
+                messages = []
+                for v, message in reversed(self.events):
+                    if v <= version:
+                        break
+                    messages.append(message)
+                messages.reverse()
+            else:
+                if self._snapshot is None:
+                    self._snapshot = format_event(self.event_id(self.version), SNAPSHOT, self.data)
+                messages = [self._snapshot]
+            return messages, self.version, self.data is None
+
+
+# room id -> RoomFeed
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+def subscribe(room_id) -> RoomFeed:
+    key = str(room_id)
+    with _feeds_lock:
+        now = time.monotonic()
+        for idle_key in [k for k, feed in _feeds.items()
+                         if feed.subscribers == 0 and feed.idle_since is not None and now - feed.idle_since > FEED_IDLE_TTL]:
+            del _feeds[idle_key]
+        feed = _feeds.get(key)
+        if feed is None:
+            feed = _feeds[key] = RoomFeed(room_id)
+        feed.subscribers += 1
+        feed.idle_since = None
+    room_event_subscriptions_total.inc()
+    feed.start()
+    return feed
+
+
+def unsubscribe(feed: RoomFeed):
+    with _feeds_lock:
+        feed.subscribers -= 1
+        idle = feed.subscribers == 0
+        if idle:
+            feed.idle_since = time.monotonic()
+    if idle:
+        # 再開したときは最初の通知を待ち、止めていた間の変化をイベントにする
+        feed.stop()
+
+
+def get_feed(room_id):
+    return _feeds.get(str(room_id))
+
+
+def record_write(room_id, values: dict):
+    # rooms.pyの書き込みから呼ばれる。リスナーが動いているフィードだけを更新する
+    feed = _feeds.get(str(room_id))
+    if feed is not None and feed.listening and feed.loaded.is_set():
+        feed.apply_write(values)
+
+
+def stream(feed: RoomFeed, last_event_id: str = None, heartbeat: float = HEARTBEAT_INTERVAL):
+    # 購読を終えるときにunsubscribeする
+    try:
+        messages, version, ended = feed.read(feed.parse_event_id(last_event_id))
+        yield from messages
+        while not ended:
+            if not feed.wait_for_change(version, heartbeat):
+                yield KEEPALIVE
+                continue
+            messages, version, ended = feed.read(version)
+            yield from messages
+    finally:
+        unsubscribe(feed)
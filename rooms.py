@@ -1,19 +1,104 @@
-from random import randint
-
-from firebase_admin import db
-
-from exceptions import RoomIdDuplicateException, RoomNotExistException, NotHostException, RoomAlreadyClosedException
-from conf import MIN_ROOM_ID, MAX_ROOM_ID, RoomStatuses
-
-# roomのデータ構造
+import time
+import secrets
+from uuid import uuid4
+from contextlib import contextmanager
+from threading import Lock
+from contextvars import ContextVar
+
+from exceptions import (RoomIdDuplicateException, RoomNotExistException, NotHostException, RoomAlreadyClosedException,
+                        NotInRoomUserException)
+from room_events import record_write
+from shards import room_shard, group_by_shard
+from models import Room, Player
+from conf import MIN_ROOM_ID, MAX_ROOM_ID, ROOM_ID_BLOCK_SIZE, RoomStatuses
+
+# roomのデータ構造 (models.Roomで読み書きする)
 # {
 #     'isReady': bool,
 #     'status': str,
 #     'start': str,
 #     'goal': str,
 #     'users': [],
-#     'host': str
+#     'host': str,
+#     'isFinalizing': {'by': str, 'at': int},  # 全員ゴール後の集計処理の確保 (FINALIZATION_LEASE_MSで期限が切れる)
+#     'shortestPath': {'status': str, 'distance': int, 'path': ['url1', 'url2']}  # start/goalの最短経路
 # }
+# roomはroom idごとにshards.pyのシャード(RTDB)に置く。インデックスもroomと同じシャードに置く
+# 期限切れのroomを探すためのインデックス (値はサーバー側の書き込み時刻のミリ秒)
+# RTDBのルールで ".indexOn": ".value" を設定しておくこと
+# _meta/roomActivity/{room_id}: roomに最後に書き込んだ時刻
+# _meta/endedRooms/{room_id}:   roomがENDEDになった時刻
+ROOM_ACTIVITY_PATH = '_meta/roomActivity'
+ENDED_ROOMS_PATH = '_meta/endedRooms'
+SERVER_TIMESTAMP = {'.sv': 'timestamp'}
+# 集計処理の確保の期限。ジョブが失われても (インスタンスの停止など)、期限が切れたら別の呼び出しが確保し直せる
+FINALIZATION_LEASE_MS = 5 * 60 * 1000
+
+
+class RoomContext:
+    # 1リクエストの間、roomのスナップショットを共有する。書き込んだroomのスナップショットは破棄する
+    def __init__(self):
+        self.reads = 0
+        self._snapshots = {}
+
+    def fetch_room_data(self, room_id: int):
+        key = str(room_id)
+        if key not in self._snapshots:
+            self._snapshots[key] = _read_room_data(room_id)
+            self.reads += 1
+        return self._snapshots[key]
+
+    def invalidate(self, room_id: int):
+        self._snapshots.pop(str(room_id), None)
+
+
+_room_context: ContextVar = ContextVar('room_context', default=None)
+
+
+def enter_room_context():
+    return _room_context.set(RoomContext())
+
+
+def exit_room_context(token):
+    _room_context.reset(token)
+
+
+@contextmanager
+def room_context():
+    token = enter_room_context()
+    try:
+        yield _room_context.get()
+    finally:
+        exit_room_context(token)
+
+
+def current_room_context():
+    return _room_context.get()
+
+
+def count_backend_read(count: int = 1):
+    ctx = _room_context.get()
+    if ctx is not None:
+        ctx.reads += count
+
+
+def _read_room_data(room_id: int):
+    shard = room_shard(room_id)
+    with shard.call('rooms.fetch_room_data'):
+        return shard.reference(f'{room_id}/').get()
+
+
+def fetch_room_data(room_id: int):
+    ctx = _room_context.get()
+    if ctx is not None:
+        return ctx.fetch_room_data(room_id)
+    return _read_room_data(room_id)
+
+
+def invalidate_room_data(room_id: int):
+    ctx = _room_context.get()
+    if ctx is not None:
+        ctx.invalidate(room_id)
 
 
 class RoomValidator:
@@ -21,12 +106,13 @@ class RoomValidator:
     _room_data = None
 
     def __init__(self, room_id: int):
+        self.room_id = room_id
         room_path = f'{room_id}/'
-        self.room_ref = db.reference(room_path)
+        self.room_ref = room_shard(room_id).reference(room_path)
 
     def _fetch_room_data(self):
         if self._room_data is None:
-            self._room_data = self.room_ref.get()
+            self._room_data = fetch_room_data(self.room_id)
 
     def check_room_exists(self):
         self._fetch_room_data()
@@ -47,70 +133,141 @@ class RoomValidator:
         return self._room_data
 
 
-def create_room_id():
-    max_retry_count = 5
-    room_ids = [randint(MIN_ROOM_ID, MAX_ROOM_ID) for _ in range(max_retry_count)]
-    # forループの中でRoomValidatorをインスタンス化しているのは良くないが、ほとんど1度目の処理で終わるので良しとする
-    # (2週目、３週目に行くことはほぼ無い)
-    for room_id in room_ids:
-        try:
-            rv = RoomValidator(room_id)
-            rv.check_room_exists()
-            continue
-        except RoomNotExistException:
-            return room_id
-    raise RoomIdDuplicateException
+# room idは参加用のコードにもなるので、推測できないように乱数で選ぶ
+# インスタンスごとに、乱数で選んだROOM_ID_BLOCK_SIZE個の連続したidのブロックを確保し、空いているidをランダムな順に払い出す
+# ブロックは _meta/roomIdBlocks/{ブロックの番号} をトランザクションで確保し (期限が切れたら他のインスタンスが確保し直せる)、
+# 確保したときにブロックの範囲の_meta/roomActivityを読んで使用中のidを除く
+# roomの作成は、roomとインデックスを書く1回のmulti-path updateだけになる (ブロックの確保はROOM_ID_BLOCK_SIZE回に1回)
+ROOM_ID_BLOCKS_PATH = '_meta/roomIdBlocks'
+ROOM_ID_BLOCK_LEASE_MS = 10 * 60 * 1000
+ROOM_ID_MAX_RETRY = 5
+
+
+def _room_id_block_count():
+    return (MAX_ROOM_ID - MIN_ROOM_ID + 1) // ROOM_ID_BLOCK_SIZE
+
+
+def _random_room_id_block():
+    return secrets.randbelow(_room_id_block_count())
+
+
+def _claim_room_id_block(block: int, lease_id: str):
+    # ブロックを確保できたら、その中の使用中でないidのリストを返す (確保できなければNone)
+    first = MIN_ROOM_ID + block * ROOM_ID_BLOCK_SIZE
+    room_ids = range(first, first + ROOM_ID_BLOCK_SIZE)
+    claimed = []
+
+    def _claim(lease):
+        if _lease_is_held(lease, ROOM_ID_BLOCK_LEASE_MS):
+            claimed.append(False)
+            return lease
+        claimed.append(True)
+        return {'by': lease_id, 'at': SERVER_TIMESTAMP}
+
+    shard = room_shard(first)
+    with shard.call('rooms.claim_room_id_block'):
+        shard.reference(f'{ROOM_ID_BLOCKS_PATH}/{block}').transaction(_claim)
+    if not claimed[-1]:
+        return None
+    # idはすべて同じ桁数なので、キーの範囲で読める
+    in_use = set()
+    for shard, shard_room_ids in group_by_shard(room_ids).items():
+        with shard.call('rooms.claim_room_id_block'):
+            active = shard.reference(ROOM_ACTIVITY_PATH).order_by_key() \
+                .start_at(str(min(shard_room_ids))).end_at(str(max(shard_room_ids))).get()
+        in_use.update(int(room_id) for room_id in active or {})
+    return [room_id for room_id in room_ids if room_id not in in_use]
+
+
+class RoomIdAllocator:
+    # 確保したブロックのidを使い切るか、期限の半分が過ぎるまで、RTDBにアクセスせずに払い出す
+    def __init__(self):
+        self._lease_id = uuid4().hex
+        self._room_ids = []
+        self._expires_at = 0.0
+        self._lock = Lock()
+
+    def _claim_block(self):
+        for _ in range(ROOM_ID_MAX_RETRY):
+            room_ids = _claim_room_id_block(_random_room_id_block(), self._lease_id)
+            if room_ids:
+                self._room_ids = room_ids
+                self._expires_at = time.monotonic() + ROOM_ID_BLOCK_LEASE_MS / 1000 / 2
+                return
+        raise RoomIdDuplicateException
+
+    def allocate(self):
+        with self._lock:
+            if not self._room_ids or time.monotonic() >= self._expires_at:
+                self._claim_block()
+            return self._room_ids.pop(secrets.randbelow(len(self._room_ids)))
+
+
+room_id_allocator = RoomIdAllocator()
+
+
+def create_new_room(user_uuid: str, user_name: str):
+    room_id = room_id_allocator.allocate()
+    init_room(room_id, user_uuid, user_name)
+    return room_id
 
 
 def get_room_data(room_id: int):
-    db_path = f'{room_id}/'
-    ref = db.reference(db_path)
-    data = ref.get()
+    data = fetch_room_data(room_id)
     if data is None:
         raise RoomNotExistException
     return data
 
 
+def get_room(room_id: int) -> Room:
+    return Room.from_rtdb(get_room_data(room_id))
+
+
+def _update_room(room_id: int, values: dict, caller: str, index: dict = None):
+    # roomへの書き込みと同じ1回のmulti-path updateで、最終更新時刻のインデックスも更新する
+    update = {f'{room_id}/{path}' if path else str(room_id): value for path, value in values.items()}
+    update[f'{ROOM_ACTIVITY_PATH}/{room_id}'] = SERVER_TIMESTAMP
+    for path, value in (index or {}).items():
+        update[f'{path}/{room_id}'] = value
+    shard = room_shard(room_id)
+    with shard.call(caller):
+        shard.reference('/').update(update)
+    invalidate_room_data(room_id)
+    record_write(room_id, values)
+
+
 def init_room(room_id: int, user_uuid: str, user_name: str):
-    ref = db.reference(f'{room_id}/')
-    ref.set({
-        'isReady': False,
-        'status': RoomStatuses.PREPARATION,
-        'users': {
-            user_uuid: {
-                'name': user_name,
-                'isDone': False,
-                'isSurrendered': False
-            }
-        },
-        'host': user_uuid
-    })
+    room = Room.new(RoomStatuses.PREPARATION, user_uuid, user_name)
+    _update_room(room_id, {'': room.to_rtdb()}, 'rooms.init_room', index={ENDED_ROOMS_PATH: None})
 
 
 def _join_room(room_id: int, user_uuid: str, user_name: str):
     rv = RoomValidator(room_id)
     rv.check_room_exists()
     rv.check_room_closed()
-    room_users_ref = db.reference(f'{room_id}/users/')
-    current_users = room_users_ref.get()
-    room_users_ref.set(current_users | {user_uuid: {'name': user_name, 'isDone': False, 'isSurrendered': False}})
+    # users全体をset()すると同時に参加したユーザーを上書きしてしまうので、自分のノードだけを更新する
+    _update_room(room_id, {f'users/{user_uuid}': Player.joined(user_name).to_rtdb()}, 'rooms._join_room')
 
 
 def change_room_status(room_id: int, user_uuid: str, start=True, force_change=False):
     rv = RoomValidator(room_id)
     rv.check_room_exists()
-    room_ref = rv.room_ref
 
     if not force_change:
-        room_data = get_room_data(room_id)
+        room_data = rv.room_data
         is_host = user_uuid == room_data.get('host')
         if not is_host:
             raise NotHostException
 
     next_status = RoomStatuses.ONGOING if start else RoomStatuses.ENDED
-    room_ref.update({
-        'status': next_status
-    })
+    ended_at = SERVER_TIMESTAMP if next_status == RoomStatuses.ENDED else None
+    values = {'status': next_status}
+    if next_status == RoomStatuses.ONGOING:
+        # ゲームごとに変わる値として、結果の集計で同じゲームを2回数えないために使う
+        values['startedAt'] = SERVER_TIMESTAMP
+        # 前のゲームの集計処理の確保が残っていると、このゲームを集計できない
+        values['isFinalizing'] = None
+    _update_room(room_id, values, 'rooms.change_room_status', index={ENDED_ROOMS_PATH: ended_at})
 
 
 def _destroy_room(room_id: int, user_uuid: str = None, force_destroy=True):
@@ -126,31 +283,116 @@ def _destroy_room(room_id: int, user_uuid: str = None, force_destroy=True):
         if user_uuid != host:
             raise NotHostException
 
-    ref = rv.room_ref
-    ref.delete()
+    delete_rooms([room_id], 'rooms._destroy_room')
+
+
+def delete_rooms(room_ids, caller: str = 'rooms.delete_rooms'):
+    # roomとインデックスの項目を、シャードごとに1回のmulti-path updateで消す
+    for shard, shard_room_ids in group_by_shard(room_ids).items():
+        update = {}
+        for room_id in shard_room_ids:
+            update[str(room_id)] = None
+            update[f'{ROOM_ACTIVITY_PATH}/{room_id}'] = None
+            update[f'{ENDED_ROOMS_PATH}/{room_id}'] = None
+        with shard.call(caller):
+            shard.reference('/').update(update)
+    for room_id in room_ids:
+        invalidate_room_data(room_id)
+        record_write(room_id, {'': None})
 
 
 def setting_article(room_id: int, url: str, is_start: bool):
     rv = RoomValidator(room_id)
     rv.check_room_exists()
     target = 'start' if is_start else 'goal'
-    ref = db.reference(f'{room_id}/{target}/')
-    ref.set(url)
+    # 記事が変わったら以前の最短経路は使えないので、同じ書き込みで消す
+    _update_room(room_id, {target: url, 'shortestPath': None}, 'rooms.setting_article')
+
+
+def record_shortest_path(room_id: int, start: str, goal: str, result: dict):
+    # 探索中にroomが消えたり記事が変わったりしていたら書き込まない
+    recorded = []
+
+    def _record(room_data):
+        if not room_data or room_data.get('start') != start or room_data.get('goal') != goal:
+            return room_data
+        room_data['shortestPath'] = {'status': result['status'], 'distance': result['distance'],
+                                     'path': result['path']}
+        recorded.append(True)
+        return room_data
+
+    shard = room_shard(room_id)
+    with shard.call('rooms.record_shortest_path'):
+        shard.reference(f'{room_id}/').transaction(_record)
+    if recorded:
+        # トランザクションはroomのノードだけに書くので、最終更新時刻のインデックスは別に更新する
+        with shard.call('rooms.record_shortest_path'):
+            shard.reference(f'{ROOM_ACTIVITY_PATH}/{room_id}').set(SERVER_TIMESTAMP)
+    invalidate_room_data(room_id)
+    return bool(recorded)
 
 
 def change_player_progress(room_id: int, uuid: str, is_done: bool, is_surrendered: bool):
     rv = RoomValidator(room_id)
     rv.check_room_exists()
-    ref = db.reference(f'{room_id}/users/{uuid}/')
-    player_data = ref.get()
-    player_data['isDone'] = is_done
-    player_data['isSurrendered'] = is_surrendered
-    ref.set(player_data)
+    # 参加していないuuidで書き込むと、名前の無いユーザーができてしまう
+    if uuid not in (rv.room_data.get('users') or {}):
+        raise NotInRoomUserException
+    # 読み込んだ後に他のリクエストが変えているかもしれないので、読み込んだ値と比べずに両方の項目を書く
+    _update_room(room_id, {f'users/{uuid}/isDone': is_done, f'users/{uuid}/isSurrendered': is_surrendered},
+                 'rooms.change_player_progress')
+
+
+def _lease_is_held(lease, lease_ms: int = None):
+    # 以前の形式 (True) や時刻の無いものは期限切れとして扱う
+    if not isinstance(lease, dict) or not isinstance(lease.get('at'), (int, float)):
+        return False
+    lease_ms = FINALIZATION_LEASE_MS if lease_ms is None else lease_ms
+    return lease['at'] + lease_ms > time.time() * 1000
+
+
+def claim_game_finalization(room_id: int):
+    # トランザクションで最初に確保した呼び出しだけが確保のidを返す (確保できなければNone)
+    # 期限が切れた確保は取り直せる。roomが削除されていたら確保しない (isFinalizingだけのノードを作らない)
+    lease_id = uuid4().hex
+    claimed = []
+
+    def _claim(room_data):
+        if not room_data or _lease_is_held(room_data.get('isFinalizing')):
+            claimed.append(False)
+            return room_data
+        claimed.append(True)
+        room_data['isFinalizing'] = {'by': lease_id, 'at': SERVER_TIMESTAMP}
+        return room_data
+
+    shard = room_shard(room_id)
+    with shard.call('rooms.claim_game_finalization'):
+        shard.reference(f'{room_id}/').transaction(_claim)
+    invalidate_room_data(room_id)
+    return lease_id if claimed[-1] else None
+
+
+def release_game_finalization(room_id: int, lease_id: str):
+    # 集計処理が最後まで失敗したときに、自分の確保だけを外す (他の呼び出しが確保し直していれば何もしない)
+    def _release(room_data):
+        lease = room_data.get('isFinalizing') if room_data else None
+        if isinstance(lease, dict) and lease.get('by') == lease_id:
+            del room_data['isFinalizing']
+        return room_data
+
+    shard = room_shard(room_id)
+    with shard.call('rooms.release_game_finalization'):
+        shard.reference(f'{room_id}/').transaction(_release)
+    invalidate_room_data(room_id)
 
 
 def get_room_users(room_id: int):
-    ref = db.reference(f'{room_id}/users')
-    rtdb_users = ref.get()
+    if current_room_context() is not None:
+        room_data = fetch_room_data(room_id)
+        return room_data.get('users') if room_data else None
+    shard = room_shard(room_id)
+    with shard.call('rooms.get_room_users'):
+        rtdb_users = shard.reference(f'{room_id}/users').get()
     return rtdb_users
 
 
@@ -0,0 +1,133 @@
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from metrics import REGISTRY, Counter, Histogram, rtdb_call
+from conf import init_firebase
+
+# roomをroom idのハッシュで複数のRTDBに振り分ける
+# roomのデータと、そのroomのインデックス(_meta/roomActivity, _meta/endedRooms)は同じRTDBに置く
+# (1回のmulti-path updateでまとめて書けるのは同じRTDBの中だけなので)
+# シャードを増やすときはURLを末尾に追加する (jump consistent hashなので、移動するのは新しいシャードに入るroomだけ)
+rtdb_shard_calls_total = REGISTRY.register(Counter(
+    'rtdb_shard_calls_total', 'RTDB calls by shard.', ('shard', 'outcome')))
+rtdb_shard_call_duration_seconds = REGISTRY.register(Histogram(
+    'rtdb_shard_call_duration_seconds', 'RTDB call latency by shard.', ('shard',)))
+
+
+def rtdb_reference(path: str = '/', url: Optional[str] = None):
+    # firebase_adminは読み込みが重いので、最初にRTDBを使うときに読み込んで初期化する
+    init_firebase()
+    from firebase_admin import db
+    return db.reference(path, url=url)
+
+
+def jump_hash(key: int, buckets: int):
+    # Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+class Shard:
+    def __init__(self, index: int, url: Optional[str]):
+        self.index = index
+        # Noneならデフォルト(firebase_admin.initialize_appのdatabaseURL)のRTDB
+        self.url = url
+
+    def reference(self, path: str = '/'):
+        return rtdb_reference(path, self.url)
+
+    @contextmanager
+    def call(self, caller: str):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            with rtdb_call(caller):
+                yield
+            outcome = 'ok'
+        finally:
+            rtdb_shard_call_duration_seconds.observe(time.perf_counter() - started, str(self.index))
+            rtdb_shard_calls_total.inc(str(self.index), outcome)
+
+
+class ShardRouter:
+    def __init__(self, urls: List[Optional[str]]):
+        # 同じRTDBを別のURLとして扱わないよう、末尾の/をそろえる
+        self.shards = [Shard(index, url.rstrip('/') if url else None) for index, url in enumerate(urls or [None])]
+
+    def shard_of(self, room_id) -> Shard:
+        return self.shards[jump_hash(int(room_id), len(self.shards))]
+
+    def group(self, room_ids):
+        # シャード -> そのシャードのroom idのリスト
+        groups = {}
+        for room_id in room_ids:
+            groups.setdefault(self.shard_of(room_id), []).append(room_id)
+        return groups
+
+
+router = ShardRouter([None])
+
+
+def use_shards(urls: List[Optional[str]]):
+    global router
+    router = ShardRouter(urls)
+
+
+def room_shard(room_id) -> Shard:
+    return router.shard_of(room_id)
+
+
+def group_by_shard(room_ids):
+    return router.group(room_ids)
+
+
+def _room_ids(shard: Shard):
+    with shard.call('shards.room_ids'):
+        keys = shard.reference('/').get(shallow=True) or {}
+    return sorted(key for key in keys if str(key).isdigit())
+
+
+def shard_room_counts(shard_router: ShardRouter = None):
+    shard_router = shard_router or router
+    return {str(shard.index): len(_room_ids(shard)) for shard in shard_router.shards}
+
+
+def rebalance(source: ShardRouter, target: ShardRouter, index_paths=(), batch_size: int = 100, dry_run: bool = False):
+    # sourceのシャードにあるroomのうち、targetでは別のシャードになるものを、index_paths/{room_id}の項目と一緒に移す
+    # 移動先に書いてから移動元から消す (途中で止まっても再実行すれば続きから移せる)
+    # 移動中のroomへの書き込みは失われることがあるので、アクセスの少ない時間に実行し、終わってからRTDB_SHARD_URLSを切り替える
+    stats = {'scanned': 0, 'moved': 0, 'moves': {}}
+    for shard in source.shards:
+        room_ids = _room_ids(shard)
+        stats['scanned'] += len(room_ids)
+        moving = [room_id for room_id in room_ids if target.shard_of(room_id).url != shard.url]
+        if not moving:
+            continue
+        with shard.call('shards.rebalance'):
+            indexes = {path: shard.reference(path).get() or {} for path in index_paths}
+        for idx in range(0, len(moving), batch_size):
+            for destination, room_ids in target.group(moving[idx:idx + batch_size]).items():
+                key = f'{shard.index}->{destination.index}'
+                stats['moves'][key] = stats['moves'].get(key, 0) + len(room_ids)
+                if dry_run:
+                    continue
+                update, delete = {}, {}
+                for room_id in room_ids:
+                    with shard.call('shards.rebalance'):
+                        update[room_id] = shard.reference(room_id).get()
+                    delete[room_id] = None
+                    for path, index in indexes.items():
+                        if room_id in index:
+                            update[f'{path}/{room_id}'] = index[room_id]
+                        delete[f'{path}/{room_id}'] = None
+                with destination.call('shards.rebalance'):
+                    destination.reference('/').update(update)
+                with shard.call('shards.rebalance'):
+                    shard.reference('/').update(delete)
+                stats['moved'] += len(room_ids)
+    return stats
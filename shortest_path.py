@@ -0,0 +1,240 @@
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import validation
+from link_index import LinkIndex
+from titles import title_table, link_set
+from validation import (LRUCache, LinkCache, get_host_bucket, get_outgoing_links, resolve_title, get_session, fetch_pool,
+                        FETCH_MAX_WORKERS, FETCH_TIMEOUT, LINK_CACHE_TTL)
+from conf import (SEARCH_MAX_VISITED, SEARCH_RATE_LIMIT, SEARCH_RATE_BURST, SEARCH_LINK_CACHE_MAX_SIZE,
+                  SEARCH_MAX_FETCHES)
+
+# start/goalの最短クリック数を双方向BFSで求める
+PATH_CACHE_MAX_SIZE = 1024
+PATH_CACHE_TTL = 24 * 60 * 60  # 秒
+SEARCH_TIME_BUDGET = 30  # 秒
+# 両側で訪問したノード数の上限(SEARCH_MAX_VISITED)を超えたら探索を打ち切る
+# Wikipediaへのリクエストは検証・先読みとは別のプール(SEARCH_RATE_LIMIT)で数え、
+# 読んだページはvalidation.link_cacheではなくsearch_link_cacheに入れる (探索で検証の分を使い切らないように)
+SEARCH_FETCH_POOL = 'search'
+# Wikipediaから取得する場合の、1ページあたりのリンク元の取得数の上限
+BACKLINKS_MAX = 5000
+
+FOUND = 'found'
+NOT_FOUND = 'not_found'
+# 以下は経路が無いのではなく、制限の中で見つからなかった
+TIMEOUT = 'timeout'
+TOO_LARGE = 'too_large'
+OVER_BUDGET = 'over_budget'
+
+
+class FetchBudgetExceeded(Exception):
+    # Wikipediaから読むページ数がmax_fetchesに達した
+    pass
+
+# (startのタイトルID, goalのタイトルID) -> 探索結果(経路はタイトルIDの配列)。打ち切った結果はキャッシュしない
+path_cache = LRUCache(PATH_CACHE_MAX_SIZE, PATH_CACHE_TTL)
+# タイトルID -> リンク元のタイトルID
+backlink_cache = LRUCache(PATH_CACHE_MAX_SIZE, PATH_CACHE_TTL)
+# タイトルID -> リンク先のタイトルID (探索で読んだページ)
+search_link_cache = LinkCache(SEARCH_LINK_CACHE_MAX_SIZE, LINK_CACHE_TTL)
+
+
+@title_table.on_reset
+def _clear_title_caches():
+    for cache in (path_cache, backlink_cache, search_link_cache):
+        cache.clear()
+
+
+class IndexLinkGraph:
+    # オフラインのリンクインデックス上のグラフ。ノードはタイトルID
+    def __init__(self, index: LinkIndex):
+        self.index = index
+
+    def node(self, title: str):
+        return self.index.title_id(title)
+
+    def title(self, node: int):
+        return self.index.title(node)
+
+    def expand(self, nodes, forward: bool):
+        neighbors = self.index.links if forward else self.index.backlinks
+        for node in nodes:
+            yield node, neighbors(node)
+
+
+def fetch_backlinks(base_url: str, title: str):
+    api_url = f'{base_url}/w/api.php'
+    params = {'action': 'query', 'list': 'backlinks', 'bltitle': title, 'blnamespace': 0,
+              'bllimit': 'max', 'format': 'json'}
+    titles = []
+    while len(titles) < BACKLINKS_MAX:
+        get_host_bucket(api_url).acquire()
+        res = get_session().get(api_url, params=params, timeout=FETCH_TIMEOUT)
+        res.raise_for_status()
+        data = res.json()
+        titles.extend(link['title'].replace(' ', '_') for link in data['query']['backlinks'])
+        if 'continue' not in data:
+            break
+        params.update(data['continue'])
+    return titles[:BACKLINKS_MAX]
+
+
+class WikipediaLinkGraph:
+    # Wikipediaを取得しながら辿るグラフ。ノードはtitles.title_tableのタイトルID
+    # リンク先は記事のリンク、リンク元はAPIのbacklinksから取得する (どちらもキャッシュ付き)
+    # 探索ごとに作る。Wikipediaから読んだページ数をfetchesに数え、max_fetchesを超えては読まない
+    def __init__(self, base_url: str, max_workers: int = FETCH_MAX_WORKERS, max_fetches: int = SEARCH_MAX_FETCHES):
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.max_fetches = max_fetches
+        self.fetches = 0
+
+    def node(self, title: str):
+        return resolve_title(self.url(title))
+
+    def title(self, node: int):
+        return title_table.title(node)
+
+    def url(self, title: str):
+        return f'{self.base_url}/wiki/{quote(title)}'
+
+    def successors(self, node: int):
+        return get_outgoing_links(title_table.url(node), search_link_cache)
+
+    def cached_successors(self, node: int):
+        links = validation.link_cache.get(node)
+        return links if links is not None else search_link_cache.get(node)
+
+    def predecessors(self, node: int):
+        links = backlink_cache.get(node)
+        if links is None:
+            sources = (resolve_title(self.url(title)) for title in fetch_backlinks(self.base_url, self.title(node)))
+            links = link_set(source for source in sources if source is not None)
+            backlink_cache.set(node, links)
+        return links
+
+    def expand(self, nodes, forward: bool):
+        # キャッシュにあるノードはすぐ返し、読むページはmax_workers件ずつ送る
+        # 探索が時間切れなどでやめたら、まだ送っていないページは読まない
+        neighbors = self.successors if forward else self.predecessors
+        cached = self.cached_successors if forward else backlink_cache.get
+
+        def fetch(node: int):
+            with fetch_pool(SEARCH_FETCH_POOL, SEARCH_RATE_LIMIT, SEARCH_RATE_BURST):
+                return neighbors(node)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        pending = deque()
+        try:
+            for node in nodes:
+                links = cached(node)
+                if links is not None:
+                    yield node, links
+                    continue
+                if self.fetches >= self.max_fetches:
+                    raise FetchBudgetExceeded()
+                self.fetches += 1
+                pending.append((node, executor.submit(fetch, node)))
+                if len(pending) >= self.max_workers:
+                    node, future = pending.popleft()
+                    yield node, future.result()
+            while pending:
+                node, future = pending.popleft()
+                yield node, future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _result(status: str, path=None, visited: int = 0):
+    return {'status': status, 'distance': len(path) - 1 if path else None, 'path': path, 'visited': visited}
+
+
+def _chain(parents: dict, node):
+    chain = []
+    while node is not None:
+        chain.append(node)
+        node = parents[node]
+    return chain
+
+
+def bidirectional_search(graph, start: str, goal: str, time_budget: float = SEARCH_TIME_BUDGET,
+                         max_visited: int = SEARCH_MAX_VISITED):
+    deadline = time.monotonic() + time_budget
+    source, target = graph.node(start), graph.node(goal)
+    if source is None or target is None:
+        return _result(NOT_FOUND)
+    if source == target:
+        return _result(FOUND, [start], 1)
+
+    # ノード -> 探索元に向かって1つ戻ったノード
+    forward, backward = {source: None}, {target: None}
+    forward_frontier, backward_frontier = [source], [target]
+    while forward_frontier and backward_frontier:
+        # 小さい方の frontier を1階層ぶん広げる
+        is_forward = len(forward_frontier) <= len(backward_frontier)
+        if is_forward:
+            frontier, visited, other = forward_frontier, forward, backward
+        else:
+            frontier, visited, other = backward_frontier, backward, forward
+        next_frontier = []
+        meetings = []
+        try:
+            for node, neighbors in graph.expand(frontier, is_forward):
+                if time.monotonic() > deadline:
+                    return _result(TIMEOUT, visited=len(forward) + len(backward))
+                for neighbor in neighbors:
+                    if neighbor in visited:
+                        continue
+                    visited[neighbor] = node
+                    next_frontier.append(neighbor)
+                    if neighbor in other:
+                        meetings.append(neighbor)
+                if len(forward) + len(backward) > max_visited:
+                    return _result(TOO_LARGE, visited=len(forward) + len(backward))
+        except FetchBudgetExceeded:
+            return _result(OVER_BUDGET, visited=len(forward) + len(backward))
+        if meetings:
+            # 同じ階層で出会ったノードのうち、反対側からの距離が最も短いものを使う
+            meeting = min(meetings, key=lambda n: len(_chain(other, n)))
+            path = _chain(forward, meeting)[::-1] + _chain(backward, meeting)[1:]
+            return _result(FOUND, [graph.title(n) for n in path], len(forward) + len(backward))
+        if is_forward:
+            forward_frontier = next_frontier
+        else:
+            backward_frontier = next_frontier
+    return _result(NOT_FOUND, visited=len(forward) + len(backward))
+
+
+def get_graph(start_title: str, goal_title: str, base_url: str):
+    index = validation.link_index
+    if index is not None and start_title in index and goal_title in index:
+        return IndexLinkGraph(index)
+    return WikipediaLinkGraph(base_url)
+
+
+def get_shortest_path(start: str, goal: str, graph=None, time_budget: float = SEARCH_TIME_BUDGET):
+    # start/goalのURLから最短経路を求める。経路はURLのリストで返す
+    generation = title_table.generation
+    start_id, goal_id = resolve_title(start), resolve_title(goal)
+    if start_id is None or goal_id is None:
+        return _result(NOT_FOUND)
+    key = (start_id, goal_id)
+    cached = path_cache.get(key)
+    if cached is None:
+        start_title, goal_title = title_table.title(start_id), title_table.title(goal_id)
+        base_url = title_table.base_url(start_id)
+        result = bidirectional_search(graph or get_graph(start_title, goal_title, base_url),
+                                      start_title, goal_title, time_budget)
+        path = result['path']
+        if path is not None:
+            path = array('I', (title_table.intern(f'{base_url}/wiki/{quote(title)}') for title in path))
+        cached = dict(result, path=path)
+        title_table.check_generation(generation)
+        if result['status'] in (FOUND, NOT_FOUND):
+            path_cache.set(key, cached)
+    path = cached['path']
+    return dict(cached, path=[title_table.url(title_id) for title_id in path] if path is not None else None)
@@ -0,0 +1,84 @@
+import sys
+import json
+import subprocess
+from typing import Dict, Iterable, List
+
+# 起動時間の内訳 (python -X importtime の結果を集計する)
+# 計測は新しいプロセスで行う (このプロセスで読み込み済みのモジュールは数えられないので)
+# python manage.py startup-report [--module main] [--init]
+REPORT_TOP = 15
+
+# 子プロセスで実行するスクリプト。{module}を読み込む時間と、クライアントを最初に使うまでの時間を測る
+_PROBE = '''
+import sys, json, time
+started = time.perf_counter()
+import {module}
+result = {{'import_seconds': time.perf_counter() - started, 'init_seconds': {{}}, 'init_errors': {{}}}}
+if {init}:
+    import conf, validation
+    for name, init in (('firebase', conf.init_firebase), ('firestore', conf.get_firestore),
+                       ('wikipedia_session', validation.get_session)):
+        started = time.perf_counter()
+        try:
+            init()
+        except Exception as e:
+            result['init_errors'][name] = repr(e)
+        result['init_seconds'][name] = time.perf_counter() - started
+print(json.dumps(result))
+'''
+
+
+def parse_importtime(lines: Iterable[str]) -> List[dict]:
+    # "import time: self [us] | cumulative | imported package" の行を読み込んだ順に返す
+    # depthはインデントの深さ (0がトップレベル)
+    entries = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        if not self_us.strip().isdigit():
+            continue
+        stripped = name.rstrip().lstrip(' ')
+        depth = (len(name.rstrip()) - len(stripped) - 1) // 2
+        entries.append({'module': stripped, 'depth': depth,
+                        'self_us': int(self_us), 'cumulative_us': int(cumulative_us)})
+    return entries
+
+
+def summarize(entries: List[dict], module: str, top: int = REPORT_TOP) -> Dict:
+    # moduleが直接読み込んだモジュールの累計時間と、パッケージごとの時間を、長い順にtop件返す
+    direct, children = [], []
+    for entry in entries:
+        if entry['depth'] == 1:
+            children.append(entry)
+        elif entry['depth'] == 0:
+            if entry['module'] == module:
+                direct = children
+            children = []
+    packages = {}
+    for entry in entries:
+        package = entry['module'].split('.', 1)[0]
+        packages[package] = packages.get(package, 0) + entry['self_us']
+    total = sum(packages.values())
+    return {
+        'import_ms': round(total / 1000, 2),
+        'direct_imports_ms': {entry['module']: round(entry['cumulative_us'] / 1000, 2)
+                              for entry in sorted(direct, key=lambda e: -e['cumulative_us'])[:top]},
+        'packages_ms': {package: round(us / 1000, 2)
+                        for package, us in sorted(packages.items(), key=lambda item: -item[1])[:top]},
+        'modules': len(entries),
+    }
+
+
+def run(module: str = 'main', init: bool = False, top: int = REPORT_TOP) -> Dict:
+    probe = _PROBE.format(module=module, init=init)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'startup probe failed')
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    report = {'module': module, 'wall_import_ms': round(result['import_seconds'] * 1000, 2)}
+    report.update(summarize(parse_importtime(proc.stderr.splitlines()), module, top))
+    if init:
+        report['first_use_ms'] = {name: round(seconds * 1000, 2) for name, seconds in result['init_seconds'].items()}
+        report['first_use_errors'] = result['init_errors']
+    return report
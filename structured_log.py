@@ -0,0 +1,149 @@
+import sys
+import json
+import time
+import atexit
+import threading
+from queue import Queue, Empty, Full
+from datetime import datetime, timezone
+
+from metrics import REGISTRY, Counter
+
+# リクエストの処理中にCloud Loggingへ同期的に書き込まないよう、ログはキューに積んで
+# バックグラウンドのスレッドからまとめて書き込む
+LOG_QUEUE_SIZE = 1000
+LOG_BATCH_SIZE = 50
+LOG_FLUSH_INTERVAL = 2.0  # 秒
+
+log_entries_total = REGISTRY.register(Counter(
+    'log_entries_total', 'Structured log entries by outcome.', ('outcome',)))
+
+
+class StreamSink:
+    # 1行1エントリのJSONで書き出す。Cloud Runでは標準出力のJSONもCloud Loggingに取り込まれる
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def write(self, entries):
+        for entry in entries:
+            line = dict(entry['info'], severity=entry['severity'], timestamp=entry['timestamp'].isoformat())
+            self.stream.write(json.dumps(line, ensure_ascii=False, default=str) + '\n')
+        self.stream.flush()
+
+
+class FileSink(StreamSink):
+    def __init__(self, path: str):
+        super().__init__(open(path, 'a', encoding='utf-8'))
+
+
+class CloudLoggingSink:
+    # クライアントは最初に書き込むときにバックグラウンドのスレッドで作る
+    def __init__(self, name: str):
+        self.name = name
+        self._logger = None
+
+    def write(self, entries):
+        from google.cloud import logging_v2
+        if self._logger is None:
+            self._logger = logging_v2.Client().logger(self.name)
+        batch = self._logger.batch()
+        for entry in entries:
+            resource = entry['resource']
+            # conf.resourceのようなdictはここで変換する (呼び出し側でgoogle.cloudを読み込まなくてよいように)
+            if isinstance(resource, dict):
+                resource = logging_v2.resource.Resource(**resource)
+            batch.log_struct(entry['info'], severity=entry['severity'], resource=resource,
+                             timestamp=entry['timestamp'])
+        batch.commit()
+
+
+class BatchedLogger:
+    def __init__(self, sink, max_queue_size: int = LOG_QUEUE_SIZE, batch_size: int = LOG_BATCH_SIZE,
+                 flush_interval: float = LOG_FLUSH_INTERVAL):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.failed = 0
+        self._queue = Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def log_struct(self, info: dict, severity: str = None, resource=None):
+        self._ensure_started()
+        entry = {'info': info, 'severity': severity or 'DEFAULT', 'resource': resource,
+                 'timestamp': datetime.now(timezone.utc)}
+        try:
+            self._queue.put_nowait(entry)
+        except Full:
+            # キューが溢れたらリクエストを待たせずに捨てる
+            self.dropped += 1
+            log_entries_total.inc('dropped')
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='batched-logger', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _take_batch(self, timeout: float):
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        # 最初のエントリからflush_interval秒経つか、batch_size件たまったら書き出す
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        with self._write_lock:
+            try:
+                self.sink.write(batch)
+                log_entries_total.inc('written', amount=len(batch))
+            except Exception as e:
+                self.failed += len(batch)
+                log_entries_total.inc('failed', amount=len(batch))
+                sys.stderr.write(f'failed to write {len(batch)} log entries: {e}\n')
+
+    def flush(self):
+        # 残っているエントリを呼び出し元のスレッドで書き出す
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+
+def create_sink(sink_name: str, name: str):
+    if sink_name == 'cloud':
+        return CloudLoggingSink(name)
+    if sink_name == 'stdout':
+        return StreamSink()
+    return FileSink(sink_name)
+
+
+def get_logger(name: str, sink_name: str = 'cloud'):
+    return BatchedLogger(create_sink(sink_name, name))
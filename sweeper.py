@@ -0,0 +1,76 @@
+import time
+
+import shards
+from rooms import ROOM_ACTIVITY_PATH, ENDED_ROOMS_PATH, SERVER_TIMESTAMP, delete_rooms
+from firestore import delete_progress_of_rooms
+from metrics import REGISTRY, Counter
+from conf import ROOM_TTL, ENDED_ROOM_TTL, GC_BATCH_SIZE
+
+# 期限切れ・終了済みのroomを、最終更新時刻のインデックスから探して削除する
+# インデックスはシャードごとにあるので、シャードを1つずつ処理する
+# progressを先に消してからroomとインデックスを消すので、途中で失敗しても次の実行で続きから消せる
+gc_runs_total = REGISTRY.register(Counter('gc_runs_total', 'Room garbage collection runs by mode.', ('mode',)))
+gc_rooms_total = REGISTRY.register(Counter(
+    'gc_rooms_total', 'Rooms found (dry run) or deleted by the garbage collector.', ('reason', 'mode')))
+gc_progress_documents_deleted_total = REGISTRY.register(Counter(
+    'gc_progress_documents_deleted_total', 'Progress documents deleted by the garbage collector.'))
+
+
+def find_rooms(shard, index_path: str, cutoff_ms: int, limit: int):
+    query = shard.reference(index_path).order_by_value().end_at(cutoff_ms)
+    if limit is not None:
+        query = query.limit_to_first(limit)
+    with shard.call('sweeper.find_rooms'):
+        entries = query.get()
+    # インデックスにはroom id以外のキーは入らないが、念のため数字のキーだけを対象にする
+    return [room_id for room_id in (entries or {}) if str(room_id).isdigit()]
+
+
+def sweep(room_ttl: int = ROOM_TTL, ended_room_ttl: int = ENDED_ROOM_TTL, batch_size: int = GC_BATCH_SIZE,
+          max_rooms: int = None, dry_run: bool = False, now: float = None):
+    mode = 'dry_run' if dry_run else 'delete'
+    now_ms = int((now if now is not None else time.time()) * 1000)
+    stats = {'dry_run': dry_run, 'ended': 0, 'expired': 0, 'progress_documents': 0, 'room_ids': []}
+    seen = set()
+    targets = [(shard, reason, index_path, ttl) for shard in shards.router.shards
+               for reason, index_path, ttl in (('ended', ENDED_ROOMS_PATH, ended_room_ttl),
+                                               ('expired', ROOM_ACTIVITY_PATH, room_ttl))]
+    for shard, reason, index_path, ttl in targets:
+        while max_rooms is None or len(seen) < max_rooms:
+            limit = batch_size if max_rooms is None else min(batch_size, max_rooms - len(seen))
+            if dry_run:
+                # 削除しないと同じ範囲が返ってくるので、dry runでは上限までを1回で取得する
+                limit = max_rooms - len(seen) if max_rooms is not None else None
+            room_ids = [room_id for room_id in find_rooms(shard, index_path, now_ms - ttl * 1000, limit)
+                        if room_id not in seen]
+            if not room_ids:
+                break
+            seen.update(room_ids)
+            if not dry_run:
+                stats['progress_documents'] += delete_progress_of_rooms(room_ids, 'sweeper.sweep')
+                delete_rooms(room_ids, 'sweeper.sweep')
+            stats[reason] += len(room_ids)
+            stats['room_ids'].extend(room_ids)
+            gc_rooms_total.inc(reason, mode, amount=len(room_ids))
+            if dry_run or len(room_ids) < limit:
+                break
+    gc_progress_documents_deleted_total.inc(amount=stats['progress_documents'])
+    gc_runs_total.inc(mode)
+    return stats
+
+
+def backfill_activity_index(batch_size: int = GC_BATCH_SIZE):
+    # インデックスを作る前からあるroomを、今の時刻で登録する
+    stats = {'rooms': 0, 'indexed': 0}
+    for shard in shards.router.shards:
+        with shard.call('sweeper.backfill_activity_index'):
+            room_ids = [key for key in (shard.reference('/').get(shallow=True) or {}) if str(key).isdigit()]
+            indexed = shard.reference(ROOM_ACTIVITY_PATH).get(shallow=True) or {}
+        missing = [room_id for room_id in room_ids if room_id not in indexed]
+        for idx in range(0, len(missing), batch_size):
+            update = {f'{ROOM_ACTIVITY_PATH}/{room_id}': SERVER_TIMESTAMP for room_id in missing[idx:idx + batch_size]}
+            with shard.call('sweeper.backfill_activity_index'):
+                shard.reference('/').update(update)
+        stats['rooms'] += len(room_ids)
+        stats['indexed'] += len(missing)
+    return stats
@@ -0,0 +1,92 @@
+import pytest
+
+from admission import (RateLimiter, ConcurrencyLimiter, Admission, create_admission, client_ip,
+                       admission_rejections_total)
+from exceptions import TooManyRequestsException
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter():
+    clock = Clock()
+    limiter = RateLimiter(rate=2, burst=3, clock=clock)
+    # burstの分は続けて通り、その後はrateの間隔で通る
+    assert [limiter.acquire('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire('a') == pytest.approx(0.5)
+    assert limiter.acquire('b') == 0
+    clock.now += 0.5
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') > 0
+    clock.now += 10
+    assert [limiter.acquire('a') for _ in range(3)] == [0, 0, 0]
+
+
+def test_rate_limiter_memory_is_bounded():
+    clock = Clock()
+    limiter = RateLimiter(rate=1, burst=2, max_keys=100, clock=clock)
+    for idx in range(10000):
+        limiter.acquire(f'key{idx}')
+        assert len(limiter) <= 100
+    # 直近のキーの状態は残っている
+    limiter.acquire('hot')
+    limiter.acquire('hot')
+    assert limiter.acquire('hot') > 0
+    # 期限切れの状態は時間がたてば捨てられる
+    clock.now += 10
+    limiter.acquire('x')
+    clock.now += 10
+    limiter.acquire('y')
+    assert len(limiter) == 2
+
+
+def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(2)
+    assert limiter.try_acquire() and limiter.try_acquire()
+    assert not limiter.try_acquire()
+    limiter.release()
+    assert limiter.try_acquire()
+    unlimited = ConcurrencyLimiter(0)
+    assert all(unlimited.try_acquire() for _ in range(100))
+
+
+def test_admission():
+    clock = Clock()
+    admission = Admission(RateLimiter(1, 2, clock=clock), RateLimiter(1, 3, clock=clock), ConcurrencyLimiter(1))
+    before = admission_rejections_total.value('uuid')
+    admission.admit('user', '10.0.0.1', hold_slot=False)
+    admission.admit('user', '10.0.0.1', hold_slot=False)
+    with pytest.raises(TooManyRequestsException) as e:
+        admission.admit('user', '10.0.0.1', hold_slot=False)
+    assert e.value.status_code == 429 and e.value.retry_after == 1
+    assert admission_rejections_total.value('uuid') == before + 1
+
+    # 同じIPからの別のユーザーはIPの制限にかかる
+    admission.admit('other', '10.0.0.1', hold_slot=False)
+    with pytest.raises(TooManyRequestsException):
+        admission.admit('another', '10.0.0.1', hold_slot=False)
+
+    admission.admit(None, '10.0.0.2')
+    with pytest.raises(TooManyRequestsException):
+        admission.admit(None, '10.0.0.3')
+    admission.release()
+    admission.admit(None, '10.0.0.3')
+
+
+def test_create_admission_without_rate_limits():
+    admission = create_admission(0, 1, 0, 1, 100, 0)
+    for _ in range(100):
+        admission.admit('user', '10.0.0.1')
+
+
+def test_client_ip():
+    assert client_ip(['203.0.113.1'], '10.0.0.1', 1) == '203.0.113.1'
+    # クライアントが付けたX-Forwarded-Forは使わない
+    assert client_ip(['198.51.100.7', '203.0.113.1'], '10.0.0.1', 1) == '203.0.113.1'
+    assert client_ip(['198.51.100.7', '203.0.113.1', '10.0.0.2'], '10.0.0.1', 2) == '203.0.113.1'
+    assert client_ip(['203.0.113.1'], '10.0.0.1', 0) == '10.0.0.1'
@@ -0,0 +1,56 @@
+from aggregates import Aggregates, summarize_game, pair_id, article_id, with_rates, PATH_LENGTH_MAX
+
+BASE = 'https://ja.wikipedia.org/wiki/'
+
+
+def _game(results, start=BASE + 'A', goal=BASE + 'Z'):
+    return {'start': start, 'goal': goal, 'results': results, 'shortestDistance': 2}
+
+
+def test_summarize_game():
+    # urlsはstartとgoalの間に開いた記事
+    summary = summarize_game(_game([
+        {'uuid': 'u1', 'urls': [BASE + 'B', BASE + 'B'], 'isSurrendered': False},
+        {'uuid': 'u2', 'urls': [BASE + 'B'], 'isSurrendered': False},
+        {'uuid': 'u3', 'urls': [], 'isSurrendered': True},
+        {'uuid': 'u4', 'urls': [BASE + 'C'], 'isSurrendered': False,
+         'validation': {'isValid': False, 'message': 'invalid'}},
+        # startから直接goalに行った経路
+        {'uuid': 'u5', 'urls': [], 'isSurrendered': False, 'validation': {'isValid': True, 'message': ''}},
+    ]))
+    assert (summary['players'], summary['finishedPlayers'], summary['surrenderedPlayers']) == (5, 3, 1)
+    assert summary['clicks'] == 6 and summary['bestClicks'] == 1
+    assert summary['pathLengths'] == {'3': 1, '2': 1, '1': 1}
+    assert summary['surrenderRates'] == {'20': 1}
+    # 1つの経路で何回通っても1回と数え、検証で弾かれた経路は数えない
+    assert summary['articles'] == {BASE + 'B': 2}
+
+
+def test_summarize_game_buckets():
+    long_path = [BASE + str(idx) for idx in range(PATH_LENGTH_MAX + 5)]
+    summary = summarize_game(_game([{'uuid': 'u1', 'urls': long_path, 'isSurrendered': False}]))
+    assert summary['pathLengths'] == {str(PATH_LENGTH_MAX): 1}
+    assert summarize_game(_game([]))['surrenderRates'] == {}
+
+
+def test_keys_are_normalized():
+    assert pair_id(BASE + 'A', BASE + 'Z') == pair_id('https://ja.m.wikipedia.org/wiki/A', BASE + 'Z')
+    assert pair_id(BASE + 'A', BASE + 'Z') != pair_id(BASE + 'Z', BASE + 'A')
+    assert article_id(BASE + 'Python_(programming_language)') == article_id(BASE + 'Python (programming language)')
+
+
+def test_aggregates():
+    aggregates = Aggregates()
+    aggregates.add(summarize_game(_game([{'uuid': 'u1', 'urls': [BASE + 'B']}])))
+    aggregates.add(summarize_game(_game([{'uuid': 'u1', 'urls': [BASE + 'C', BASE + 'B']},
+                                         {'uuid': 'u2', 'urls': [], 'isSurrendered': True}])))
+    aggregates.add(summarize_game(_game([], start=BASE + 'B')))
+    documents = {(collection, doc_id): data for collection, doc_id, data in aggregates.documents()}
+    assert documents[('stats', 'global')]['games'] == 3
+    pair = documents[('stats-pairs', pair_id(BASE + 'A', BASE + 'Z'))]
+    assert pair['games'] == 2 and pair['bestClicks'] == 2 and pair['shortestDistance'] == 2
+    assert pair['pathLengths'] == {'2': 1, '3': 1}
+    assert pair['surrenderRates'] == {'0': 1, '50': 1}
+    assert with_rates(pair)['averageClicks'] == 2.5
+    assert documents[('stats-articles', article_id(BASE + 'B'))] == {'url': BASE + 'B', 'visits': 2}
+    assert with_rates({})['averageClicks'] is None
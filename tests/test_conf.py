@@ -0,0 +1,33 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import firebase_admin
+from firebase_admin import firestore
+
+import conf
+
+
+def test_clients_are_initialized_once_on_first_use(monkeypatch):
+    calls = []
+
+    def initialize_app(*args, **kwargs):
+        time.sleep(0.01)
+        calls.append('app')
+
+    def client(*args, **kwargs):
+        time.sleep(0.01)
+        calls.append('firestore')
+        return object()
+
+    monkeypatch.setattr(firebase_admin, 'initialize_app', initialize_app)
+    monkeypatch.setattr(firestore, 'client', client)
+    monkeypatch.setattr(conf, '_firebase_initialized', False)
+    monkeypatch.setattr(conf, '_fs', None)
+    assert calls == []
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: conf.get_firestore(), range(32)))
+    assert calls == ['app', 'firestore']
+    assert len(set(map(id, clients))) == 1
+    conf.init_firebase()
+    assert calls == ['app', 'firestore']
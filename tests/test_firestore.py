@@ -4,12 +4,14 @@ from firebase_admin import db
 
 from rooms import setting_article, _destroy_room
 from firestore import (delete_all_document_in_collection, record_player_progress, get_all_player_progresses,
-                       record_game_result, cancel_player_progress)
-from conf import fs
+                       record_game_result, cancel_player_progress, get_game_result, migrate_game_results,
+                       get_pair_stats, get_stats, rebuild_aggregates)
+from path_codec import decode_progress, is_compact
+from conf import get_firestore
 
 
 def test_delete_all_document_in_collection():
-    collection_ref = fs.collection('test_collection')
+    collection_ref = get_firestore().collection('test_collection')
     doc_names = ['doc1', 'doc2']
     for doc_name in doc_names:
         doc_ref = collection_ref.document(doc_name)
@@ -21,6 +23,17 @@ def test_delete_all_document_in_collection():
     assert docs == []
 
 
+def test_delete_all_document_in_collection_batched():
+    collection_ref = get_firestore().collection('test_collection_batched')
+    for idx in range(5):
+        collection_ref.document(f'doc{idx}').set({'key': 'value'})
+
+    result = delete_all_document_in_collection(collection_ref, page_size=2)
+
+    assert result == {'deleted': 5, 'round_trips': 6}
+    assert collection_ref.get() == []
+
+
 def test_record_player_progress():
     room_id = 98765
     uuid = 'test-user-uuid'
@@ -29,9 +42,10 @@ def test_record_player_progress():
     is_surrendered = False
     record_player_progress(room_id, uuid, name, urls, is_surrendered)
 
-    target_ref = fs.collection('progress').document(str(room_id)).collection('users').document(uuid)
+    target_ref = get_firestore().collection('progress').document(str(room_id)).collection('users').document(uuid)
     doc = target_ref.get()
-    assert doc.to_dict() == {
+    assert is_compact(doc.to_dict())
+    assert decode_progress(doc.to_dict()) == {
         'name': name,
         'urls': urls,
         'isSurrendered': is_surrendered
@@ -48,7 +62,7 @@ def test_cancel_player_progress():
     record_player_progress(room_id, uuid, name, urls, is_surrendered)
 
     cancel_player_progress(room_id, uuid)
-    target_ref = fs.collection('progress').document(str(room_id)).collection('users').document(uuid)
+    target_ref = get_firestore().collection('progress').document(str(room_id)).collection('users').document(uuid)
     assert target_ref.get().exists is False
 
 
@@ -73,8 +87,8 @@ def test_get_all_player_progresses():
         {'uuid': uuid, 'name': name, 'urls': urls, 'isSurrendered': False},
         {'uuid': uuid2, 'name': name2, 'urls': urls2, 'isSurrendered': True},
     ]
-    fs.collection('progress').document(str(room_id)).collection('users').document(uuid).delete()
-    fs.collection('progress').document(str(room_id)).collection('users').document(uuid2).delete()
+    get_firestore().collection('progress').document(str(room_id)).collection('users').document(uuid).delete()
+    get_firestore().collection('progress').document(str(room_id)).collection('users').document(uuid2).delete()
 
 
 def test_record_game_result():
@@ -111,7 +125,8 @@ def test_record_game_result():
     record_player_progress(room_id, uuid2, name2, urls2, True)
 
     record_game_result(room_id)
-    result = fs.collection('game-results').document(str(room_id)).get().to_dict()
+    assert is_compact(get_firestore().collection('game-results').document(str(room_id)).get().to_dict())
+    result = get_game_result(room_id)
     assert result.get('start') == 'start_url'
     assert result.get('goal') == 'goal_url'
     assert result.get('results') == [
@@ -129,6 +144,139 @@ def test_record_game_result():
         }
     ]
 
-    fs.collection('game-results').document(str(room_id)).delete()
-    delete_all_document_in_collection(fs.collection('progress').document(str(room_id)).collection('users'))
+    get_firestore().collection('game-results').document(str(room_id)).delete()
+    delete_all_document_in_collection(get_firestore().collection('progress').document(str(room_id)).collection('users'))
     _destroy_room(room_id, force_destroy=True)
+
+
+def test_migrate_game_results():
+    room_id = 99998
+    legacy = {'start': 'start_url', 'goal': 'goal_url',
+              'results': [{'uuid': 'uuid', 'name': 'name', 'urls': ['url1', 'url2'], 'isSurrendered': False}]}
+    doc_ref = get_firestore().collection('game-results').document(str(room_id))
+    doc_ref.set(legacy)
+    assert get_game_result(room_id) == legacy
+
+    stats = migrate_game_results()
+    assert stats['migrated'] >= 1
+    assert is_compact(doc_ref.get().to_dict())
+    assert get_game_result(room_id) == legacy
+    doc_ref.delete()
+
+
+def test_record_game_result_updates_aggregates():
+    room_id = 99997
+    start, goal = 'https://ja.wikipedia.org/wiki/Stats_start', 'https://ja.wikipedia.org/wiki/Stats_goal'
+    middle = 'https://ja.wikipedia.org/wiki/Stats_middle'
+    db.reference(f'{room_id}/').set({
+        'isReady': False,
+        'startedAt': 1,
+        'users': {'uuid1': {'name': 'name1', 'isDone': True}, 'uuid2': {'name': 'name2', 'isDone': True}}
+    })
+    setting_article(room_id, start, True)
+    setting_article(room_id, goal, False)
+    record_player_progress(room_id, 'uuid1', 'name1', [middle], False)
+    record_player_progress(room_id, 'uuid2', 'name2', [], True)
+    games_before = get_stats().get('games', 0)
+
+    record_game_result(room_id)
+    # 再実行しても集計には加えない
+    record_game_result(room_id)
+    pair = get_pair_stats(start, goal)
+    assert {key: pair[key] for key in ('games', 'players', 'finishedPlayers', 'surrenderedPlayers', 'bestClicks')} == {
+        'games': 1, 'players': 2, 'finishedPlayers': 1, 'surrenderedPlayers': 1, 'bestClicks': 2}
+    assert pair['pathLengths'] == {'2': 1}
+    assert pair['surrenderRates'] == {'50': 1}
+    assert pair['averageClicks'] == 2 and pair['surrenderRate'] == 0.5
+    stats = get_stats(top_articles=100)
+    assert stats['games'] == games_before + 1
+    assert middle in [article['url'] for article in stats['topArticles']]
+
+    # 作り直しても同じ値になる
+    assert rebuild_aggregates()['games'] >= 1
+    assert get_pair_stats(start, goal) == pair
+
+    get_firestore().collection('game-results').document(str(room_id)).delete()
+    delete_all_document_in_collection(get_firestore().collection('progress').document(str(room_id)).collection('users'))
+    _destroy_room(room_id, force_destroy=True)
+
+
+def test_finalize_game_waits_for_path_verdicts():
+    # 全員がゴールして集計が確保された後に、検証が終わる
+    import game
+    from firestore import record_path_verdict
+    from rooms import claim_game_finalization
+    room_id = 99996
+    start, goal = 'https://ja.wikipedia.org/wiki/Wait_start', 'https://ja.wikipedia.org/wiki/Wait_goal'
+    db.reference(f'{room_id}/').set({
+        'isReady': False, 'status': 'ONGOING', 'startedAt': 1, 'start': start, 'goal': goal,
+        'users': {'uuid1': {'name': 'name1', 'isDone': True}, 'uuid2': {'name': 'name2', 'isDone': True}}
+    })
+    record_player_progress(room_id, 'uuid1', 'name1', [], False)
+    record_player_progress(room_id, 'uuid2', 'name2', [], True)
+    verdict = {'isValid': True, 'message': None}
+
+    # 確保されていなければ、検証結果が揃っていても集計しない
+    assert game.finalize_game_if_verified(room_id, force=True) is False
+    assert claim_game_finalization(room_id) is not None
+    assert game.pending_path_verdicts(room_id, db.reference(f'{room_id}/users').get()) == ['uuid1']
+    assert game.finalize_game_if_verified(room_id) is False
+    assert record_path_verdict(room_id, 'uuid1', verdict)
+    assert game.finalize_game_if_verified(room_id) is True
+    assert game.job_queue.join(timeout=5)
+
+    results = {result['uuid']: result for result in get_game_result(room_id)['results']}
+    assert results['uuid1']['validation'] == verdict
+    assert get_all_player_progresses(room_id) == []
+    # 集計が終わった後に届いた呼び出し (VALIDATION_WAIT後のタイマーなど) は何もしない
+    assert game.finalize_game_if_verified(room_id, force=True) is False
+
+    # 検証結果が届かなくても、forceなら集計する
+    db.reference(f'{room_id}/status').set('ONGOING')
+    record_player_progress(room_id, 'uuid1', 'name1', [], False)
+    assert game.finalize_game_if_verified(room_id) is False
+    assert game.finalize_game_if_verified(room_id, force=True) is True
+    assert game.job_queue.join(timeout=5)
+    assert db.reference(f'{room_id}/status').get() == 'ENDED'
+
+    _destroy_room(room_id)
+    get_firestore().collection('game-results').document(str(room_id)).delete()
+    delete_all_document_in_collection(get_firestore().collection('progress').document(str(room_id)).collection('users'))
+
+
+def test_record_game_result_resumes_split_batches(monkeypatch):
+    # 集計が複数のbatchに分かれ、途中で失敗しても、再実行で同じ集計を2回加えない
+    import firestore
+    room_id = 99995
+    start, goal = 'https://ja.wikipedia.org/wiki/Split_start', 'https://ja.wikipedia.org/wiki/Split_goal'
+    middles = [f'https://ja.wikipedia.org/wiki/Split_{idx}' for idx in range(6)]
+    db.reference(f'{room_id}/').set({
+        'isReady': False, 'startedAt': 1, 'start': start, 'goal': goal,
+        'users': {'uuid1': {'name': 'name1', 'isDone': True}}
+    })
+    record_player_progress(room_id, 'uuid1', 'name1', middles, False)
+    monkeypatch.setattr(firestore, 'FIRESTORE_BATCH_LIMIT', 4)
+    commit_batch = firestore._commit_batch
+    commits = []
+
+    def _commit_batch(batch, caller):
+        commits.append(caller)
+        if len(commits) == 3:
+            raise ConnectionError('commit failed')
+        return commit_batch(batch, caller)
+
+    monkeypatch.setattr(firestore, '_commit_batch', _commit_batch)
+    with pytest.raises(ConnectionError):
+        record_game_result(room_id)
+    # 結果は最後のbatchで書くので、失敗したゲームの結果は無い
+    assert get_game_result(room_id) is None
+    record_game_result(room_id)
+    assert get_pair_stats(start, goal)['games'] == 1
+    visits = {article['url']: article['visits'] for article in get_stats(top_articles=100)['topArticles']}
+    assert all(visits[url] == 1 for url in middles)
+    assert get_game_result(room_id)['start'] == start
+    assert not get_firestore().collection('game-result-batches').document(str(room_id)).get().exists
+
+    _destroy_room(room_id)
+    get_firestore().collection('game-results').document(str(room_id)).delete()
+    delete_all_document_in_collection(get_firestore().collection('progress').document(str(room_id)).collection('users'))
@@ -0,0 +1,41 @@
+from inmemory import InMemoryRTDB, InMemoryFirestore
+
+
+def test_inmemory_rtdb():
+    rtdb = InMemoryRTDB()
+    rtdb.reference('12345/').set({'status': 'PREPARATION', 'users': {'u1': {'isDone': False}}})
+    rtdb.reference('12345/').update({'users/u2': {'isDone': True}, 'users/u1/isDone': True})
+    assert rtdb.reference('12345/users').get() == {'u1': {'isDone': True}, 'u2': {'isDone': True}}
+    rtdb.reference('12345/users/u1').delete()
+    rtdb.reference('12345/users/u2').delete()
+    assert rtdb.reference('12345').get() == {'status': 'PREPARATION'}
+    assert rtdb.reference('_meta/seq').transaction(lambda current: (current or 0) + 20) == 20
+    assert rtdb.stats.calls == 8
+
+
+def test_inmemory_firestore_pagination():
+    fs = InMemoryFirestore()
+    users = fs.collection('progress').document('12345').collection('users')
+    for idx in range(5):
+        users.document(f'u{idx}').set({'idx': idx})
+    page = users.order_by('__name__').limit(2).start_after(users.document('u1').get()).get()
+    assert [doc.id for doc in page] == ['u2', 'u3']
+    batch = fs.batch()
+    for doc in users.get():
+        batch.delete(doc.reference)
+    batch.commit()
+    assert users.get() == []
+
+
+def test_inmemory_firestore_transforms_and_order():
+    from firebase_admin import firestore
+    fs = InMemoryFirestore()
+    stats = fs.collection('stats')
+    for _ in range(2):
+        stats.document('a').set({'visits': firestore.Increment(2), 'lengths': {'3': firestore.Increment(1)},
+                                 'best': firestore.Minimum(4)}, merge=True)
+    stats.document('b').set({'visits': 3, 'lengths': {'2': 1}})
+    stats.document('a').set({'lengths': {'2': firestore.Increment(1)}, 'best': firestore.Minimum(5)}, merge=True)
+    assert stats.document('a').get().to_dict() == {'visits': 4, 'lengths': {'3': 2, '2': 1}, 'best': 4}
+    top = stats.order_by('visits', direction=firestore.Query.DESCENDING).limit(1).get()
+    assert [doc.id for doc in top] == ['a']
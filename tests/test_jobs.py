@@ -0,0 +1,55 @@
+import threading
+
+from jobs import JobQueue
+
+
+def test_job_queue_deduplicates_by_key():
+    release = threading.Event()
+    calls = []
+
+    def job(value):
+        release.wait(timeout=2)
+        calls.append(value)
+
+    queue = JobQueue(workers=2)
+    assert queue.submit('room-1', job, 1) is True
+    assert queue.submit('room-1', job, 2) is False
+    assert queue.submit('room-2', job, 3) is True
+    release.set()
+    assert queue.join(timeout=2)
+    assert sorted(calls) == [1, 3]
+    # 終わったジョブと同じkeyは再び追加できる
+    assert queue.submit('room-1', job, 4) is True
+    assert queue.join(timeout=2)
+
+
+def test_job_queue_retries_failed_job():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError('temporary failure')
+
+    failed = []
+    queue = JobQueue(workers=1, max_attempts=5, retry_delay=0.01)
+    queue.submit('flaky', flaky, on_failed=lambda: failed.append(1))
+    assert queue.join(timeout=2)
+    assert len(attempts) == 3
+    assert failed == []
+
+
+def test_job_queue_gives_up_after_max_attempts():
+    attempts = []
+
+    def failing():
+        attempts.append(1)
+        raise RuntimeError('permanent failure')
+
+    failed = []
+    queue = JobQueue(workers=1, max_attempts=2, retry_delay=0.01)
+    queue.submit('failing', failing, on_failed=lambda: failed.append(1))
+    assert queue.join(timeout=2)
+    assert len(attempts) == 2
+    # 最後まで失敗したときに1回だけ呼ぶ
+    assert failed == [1]
@@ -0,0 +1,50 @@
+from link_extractor import iter_article_links, extract_article_links, contains_article_link, extract_article_page
+
+HTML = '''
+<div id="p-navigation"><a href="/wiki/Main_Page">Main Page</a></div>
+<div id="mw-content-text"><div class="mw-parser-output">
+<p><a href="/wiki/A">A</a> <a href="/wiki/B?x=1&amp;y=2">B</a> <a href="#cite">cite</a></p>
+<div><a href="/wiki/C" title="C">C</a></div>
+<a href="//en.wikipedia.org/wiki/D">D</a>
+</div></div>
+<div id="footer"><a href="/wiki/Privacy">Privacy</a></div>
+'''
+
+
+def chunked(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def test_extract_article_links():
+    assert extract_article_links([HTML]) == {'/wiki/A', '/wiki/B?x=1&y=2', '/wiki/C'}
+
+
+def test_extract_article_links_chunked():
+    for size in (1, 7, 64):
+        assert list(iter_article_links(chunked(HTML, size))) == ['/wiki/A', '/wiki/B?x=1&y=2', '/wiki/C']
+
+
+def test_extract_article_links_whole_page():
+    assert extract_article_links([HTML], content_id=None) == {
+        '/wiki/Main_Page', '/wiki/A', '/wiki/B?x=1&y=2', '/wiki/C', '/wiki/Privacy'}
+
+
+def test_contains_article_link_stops_early():
+    read = []
+
+    def chunks():
+        for chunk in chunked(HTML, 16):
+            read.append(chunk)
+            yield chunk
+
+    assert contains_article_link(chunks(), '/wiki/A') is True
+    assert len(read) < len(list(chunked(HTML, 16))) // 2
+    assert contains_article_link([HTML], '/wiki/Privacy') is False
+
+
+def test_extract_article_page_reads_canonical():
+    html = '<html><head><link rel="canonical" href="https://ja.wikipedia.org/wiki/Target"></head><body>' + HTML
+    for size in (5, 1024):
+        assert extract_article_page(chunked(html, size)) == (
+            'https://ja.wikipedia.org/wiki/Target', ['/wiki/A', '/wiki/B?x=1&y=2', '/wiki/C'])
+    assert extract_article_page([HTML]) == (None, ['/wiki/A', '/wiki/B?x=1&y=2', '/wiki/C'])
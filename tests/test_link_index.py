@@ -0,0 +1,94 @@
+import pytest
+
+import validation
+from link_index import LinkIndex, title_from_url, write_index, main
+from validation import validate_url, validate_urls, use_link_index
+from exceptions import URLValidationException
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    tsv = tmp_path / 'links.tsv'
+    tsv.write_text('World_Wide_Web\t検索\tNLS\n検索\tアルゴリズム\nNLS\n検索\tWorld_Wide_Web\n', encoding='utf-8')
+    path = tmp_path / 'links.idx'
+    main(['--tsv', str(tsv), str(path)])
+    return str(path)
+
+
+def test_link_index(index_path):
+    index = LinkIndex.open(index_path)
+    assert index.n_titles == 4
+    assert index.n_links == 4
+    assert index.has_link('World_Wide_Web', '検索')
+    assert index.has_link('検索', 'World_Wide_Web')
+    assert not index.has_link('NLS', '検索')
+    assert not index.has_link('World_Wide_Web', 'Unknown')
+    assert [index.title(t) for t in index.links(index.title_id('World_Wide_Web'))] == ['NLS', '検索']
+    assert [index.title(t) for t in index.backlinks(index.title_id('検索'))] == ['World_Wide_Web']
+    index.close()
+
+
+def test_link_index_normalizes_titles(index_path):
+    index = LinkIndex.open(index_path)
+    assert index.title_id('world Wide Web') == index.title_id('World_Wide_Web')
+    # 大文字・小文字を区別しないのは先頭の文字だけ
+    assert index.has_link('world Wide Web', 'nLS')
+    assert index.has_link('World wide web', '検索') is False
+    index.close()
+
+
+def test_link_index_resolves_redirects(tmp_path):
+    path = str(tmp_path / 'links.idx')
+    graph = {'A': {'R', 'B'}, 'R': {'C'}, 'B': {'RR'}, 'RR': {'R'}, 'C': set()}
+    assert write_index(path, graph, redirects={'R': 'C', 'RR': 'R'}) == (5, 3)
+    index = LinkIndex.open(path)
+    # リダイレクトへのリンクはリダイレクト先へのリンクになり、リダイレクトのページ自体はリンクを持たない
+    assert index.title_id('R') == index.title_id('RR') == index.title_id('C')
+    assert index.has_link('A', 'C') and index.has_link('A', 'R') and index.has_link('B', 'r')
+    assert index.has_link('R', 'C') is False
+    assert [index.title(t) for t in index.backlinks(index.title_id('C'))] == ['A', 'B']
+    index.close()
+
+
+def test_build_from_sql_dump(tmp_path):
+    page = tmp_path / 'page.sql'
+    page.write_text("INSERT INTO `page` VALUES (1,0,'A',0),(2,0,'B\\'s',0),(3,14,'Cat',0),(4,0,'Old_A',1);\n",
+                    encoding='utf-8')
+    pagelinks = tmp_path / 'pagelinks.sql'
+    pagelinks.write_text("INSERT INTO `pagelinks` VALUES (1,0,'B\\'s',0),(1,14,'Cat',0),(2,0,'Old_A',0),"
+                         "(2,0,'A',0),(4,0,'A',0),(1,0,'Missing',0);\n", encoding='utf-8')
+    redirect = tmp_path / 'redirect.sql'
+    redirect.write_text("INSERT INTO `redirect` VALUES (4,0,'A','','');\n", encoding='utf-8')
+    path = str(tmp_path / 'links.idx')
+    # run-sizeを小さくして、複数のrunのマージと重複の除去を通す
+    main(['--page', str(page), '--pagelinks', str(pagelinks), '--redirect', str(redirect), '--run-size', '1', path])
+    index = LinkIndex.open(path)
+    assert index.n_titles == 3
+    assert index.n_links == 2
+    assert index.has_link('A', "B's") and index.has_link("B's", 'Old A')
+    assert [index.title(t) for t in index.backlinks(index.title_id('Old_A'))] == ["B's"]
+    assert 'Missing' not in index and 'Cat' not in index
+    index.close()
+
+
+def test_title_from_url():
+    assert title_from_url('https://ja.wikipedia.org/wiki/%E6%A4%9C%E7%B4%A2#history') == '検索'
+    assert title_from_url('https://ja.wikipedia.org/w/index.php') is None
+    assert title_from_url('https://en.wikipedia.org/wiki/world%20wide_web') == 'World_wide_web'
+
+
+def test_validate_urls_with_link_index(index_path, monkeypatch):
+    def _iter_wikipedia_page(url):
+        pytest.fail(f'unexpected fetch: {url}')
+
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', _iter_wikipedia_page)
+    use_link_index(LinkIndex.open(index_path))
+    try:
+        start = 'https://ja.wikipedia.org/wiki/World_Wide_Web'
+        goal = 'https://ja.wikipedia.org/wiki/%E3%82%A2%E3%83%AB%E3%82%B4%E3%83%AA%E3%82%BA%E3%83%A0'
+        assert validate_url(start, 'https://ja.wikipedia.org/wiki/NLS') is True
+        assert validate_urls(start, ['https://ja.wikipedia.org/wiki/%E6%A4%9C%E7%B4%A2'], goal) is True
+        with pytest.raises(URLValidationException):
+            validate_urls(start, ['https://ja.wikipedia.org/wiki/NLS'], goal)
+    finally:
+        use_link_index(None)
@@ -0,0 +1,43 @@
+import pytest
+
+from metrics import Registry, Counter, Histogram, backend_call, backend_calls_total, backend_call_duration_seconds
+
+
+def test_counter_render():
+    registry = Registry()
+    counter = registry.register(Counter('requests_total', 'Requests.', ('route', 'status')))
+    counter.inc('/room', '201')
+    counter.inc('/room', '201')
+    counter.inc('/room/"join"', '400')
+    assert registry.render() == (
+        '# HELP requests_total Requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{route="/room",status="201"} 2\n'
+        'requests_total{route="/room/\\"join\\"",status="400"} 1\n'
+    )
+
+
+def test_histogram_render():
+    registry = Registry()
+    histogram = registry.register(Histogram('latency_seconds', 'Latency.', ('route',), buckets=(0.1, 1.0)))
+    histogram.observe(0.05, '/room')
+    histogram.observe(0.5, '/room')
+    histogram.observe(2.0, '/room')
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{route="/room",le="0.1"} 1',
+        'latency_seconds_bucket{route="/room",le="1.0"} 2',
+        'latency_seconds_bucket{route="/room",le="+Inf"} 3',
+        'latency_seconds_sum{route="/room"} 2.55',
+        'latency_seconds_count{route="/room"} 3',
+    ]
+
+
+def test_backend_call():
+    with backend_call('rtdb', 'tests.ok'):
+        pass
+    with pytest.raises(ValueError):
+        with backend_call('rtdb', 'tests.error'):
+            raise ValueError
+    assert backend_calls_total.value('rtdb', 'tests.ok', 'ok') == 1
+    assert backend_calls_total.value('rtdb', 'tests.error', 'error') == 1
+    assert backend_call_duration_seconds.count('rtdb', 'tests.ok') == 1
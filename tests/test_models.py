@@ -0,0 +1,63 @@
+from datetime import datetime
+
+from models import Player, Room, Progress, GameResult
+from path_codec import is_compact
+
+START = 'https://ja.wikipedia.org/wiki/Start'
+GOAL = 'https://ja.wikipedia.org/wiki/Goal'
+
+
+def test_room_round_trip():
+    data = {
+        'isReady': False,
+        'status': 'ONGOING',
+        'host': 'a',
+        'start': START,
+        'goal': GOAL,
+        'users': {'a': {'name': 'host', 'isDone': True, 'isSurrendered': False},
+                  'b': {'name': 'guest', 'isDone': False, 'isSurrendered': False}},
+        'isFinalizing': {'by': 'lease', 'at': 1700000000000},
+        'shortestPath': {'status': 'FOUND', 'distance': 1, 'path': [START, GOAL]},
+        'startedAt': 1700000000000,
+    }
+    room = Room.from_rtdb(data)
+    assert room.users['a'] == Player('host', True, False)
+    assert room.shortest_path['distance'] == 1
+    assert room.to_rtdb() == data
+    assert Room.from_rtdb(None) is None
+    assert not hasattr(room, '__dict__')
+
+    new = Room.new('PREPARATION', 'a', 'host')
+    assert new.to_rtdb() == {'isReady': False, 'status': 'PREPARATION', 'host': 'a',
+                             'users': {'a': {'name': 'host', 'isDone': False, 'isSurrendered': False}}}
+
+
+def test_progress_round_trip():
+    progress = Progress('uuid', 'name', [START, GOAL], False, None)
+    encoded = progress.to_firestore()
+    assert is_compact(encoded) and 'uuid' not in encoded
+    assert Progress.from_firestore('uuid', encoded) == progress
+    assert progress.to_dict() == {'uuid': 'uuid', 'name': 'name', 'urls': [START, GOAL], 'isSurrendered': False}
+
+    surrendered = Progress('uuid2', 'name2', [START], True, {'isValid': True, 'message': ''})
+    assert Progress.from_firestore('uuid2', surrendered.to_firestore()).urls == []
+    # 圧縮前の形式も読める
+    legacy = {'name': 'name', 'urls': [START], 'isSurrendered': False}
+    assert Progress.from_firestore('uuid', legacy) == Progress('uuid', 'name', [START], False, None)
+
+
+def test_game_result():
+    room = Room.from_rtdb({'start': START, 'goal': GOAL, 'startedAt': 1,
+                           'shortestPath': {'status': 'FOUND', 'distance': 1, 'path': [START, GOAL]},
+                           'users': {'a': {'name': 'a', 'isDone': True}}})
+    progresses = [Progress('a', 'a', [START, GOAL], False, None), Progress('left', 'left', [START], False, None)]
+    created_at = datetime(2024, 1, 1)
+    result = GameResult.from_room(room, progresses, created_at)
+    assert [progress.uuid for progress in result.results] == ['a']
+    assert result.to_dict() == {
+        'start': START, 'goal': GOAL, 'createAt': created_at, 'shortestDistance': 1, 'startedAt': 1,
+        'results': [{'uuid': 'a', 'name': 'a', 'urls': [START, GOAL], 'isSurrendered': False}],
+    }
+    encoded = result.to_firestore()
+    assert is_compact(encoded)
+    assert GameResult.from_firestore(encoded) == result
@@ -0,0 +1,48 @@
+from path_codec import (encode_progress, decode_progress, encode_game_result, decode_game_result, is_compact,
+                        document_size)
+
+BASE = 'https://ja.wikipedia.org/wiki/'
+URLS = [BASE + '%E6%97%A5%E6%9C%AC', BASE + 'Python_(programming_language)', BASE + '%E6%97%A5%E6%9C%AC',
+        'https://en.wikipedia.org/wiki/Japan', 'url1', BASE + '%E6%A4%9C%E7%B4%A2#top', BASE + '%2523']
+
+
+def test_progress_roundtrip():
+    progress = {'name': 'player', 'urls': URLS, 'isSurrendered': False}
+    encoded = encode_progress(progress)
+    assert is_compact(encoded)
+    assert 'urls' not in encoded
+    assert encoded['titles'][:2] == ['日本', 'Python_(programming_language)']
+    assert decode_progress(encoded) == progress
+
+
+def test_progress_without_repeats_omits_path():
+    progress = {'name': 'player', 'urls': URLS[:2], 'isSurrendered': False}
+    encoded = encode_progress(progress)
+    assert 'path' not in encoded
+    assert decode_progress(encoded) == progress
+    empty = {'name': 'player', 'urls': [], 'isSurrendered': True}
+    assert decode_progress(encode_progress(empty)) == empty
+
+
+def test_legacy_documents_are_returned_as_is():
+    legacy = {'name': 'player', 'urls': URLS, 'isSurrendered': False}
+    assert decode_progress(legacy) == legacy
+    result = {'start': 's', 'goal': 'g', 'results': [{'uuid': 'u', 'name': 'n', 'urls': URLS}]}
+    assert decode_game_result(result) == result
+
+
+def test_game_result_roundtrip_shares_dictionary():
+    result = {
+        'start': BASE + 'A', 'goal': BASE + 'B', 'shortestDistance': 2,
+        'results': [
+            {'uuid': 'u1', 'name': 'n1', 'urls': URLS, 'isSurrendered': False,
+             'validation': {'isValid': True, 'message': None}},
+            {'uuid': 'u2', 'name': 'n2', 'urls': URLS[:3], 'isSurrendered': False},
+            {'uuid': 'u3', 'name': 'n3', 'urls': [], 'isSurrendered': True},
+        ]
+    }
+    encoded = encode_game_result(result)
+    assert len(encoded['titles']) == 6
+    assert [r['path'] for r in encoded['results']] == ['0,1,0,2,3,4,5', '0,1,0', '']
+    assert decode_game_result(encoded) == result
+    assert document_size(encoded) < document_size(result)
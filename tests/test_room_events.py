@@ -0,0 +1,150 @@
+import json
+import threading
+from http.client import HTTPConnection
+
+import pytest
+from firebase_admin import db
+
+import room_events
+from room_events import (RoomFeed, diff_room, subscribe, unsubscribe, stream, record_write, USER_JOINED,
+                         USER_LEFT, PLAYER_DONE, ARTICLE_SET, STATUS_CHANGED, ROOM_DELETED, EVENT_HISTORY, KEEPALIVE)
+from inmemory import InMemoryRTDB, InMemoryEvent, reference_router
+
+ROOM = {'status': 'PREPARATION', 'host': 'h', 'users': {'h': {'name': 'host', 'isDone': False, 'isSurrendered': False}}}
+
+
+@pytest.fixture
+def rtdb(monkeypatch):
+    rtdb = InMemoryRTDB()
+    monkeypatch.setattr(db, 'reference', reference_router(rtdb))
+    monkeypatch.setattr(room_events, '_feeds', {})
+    return rtdb
+
+
+def _kinds(messages):
+    return [line.split(': ', 1)[1] for message in messages for line in message.splitlines() if line.startswith('event:')]
+
+
+def test_diff_room():
+    new = {'status': 'ONGOING', 'start': 'a', 'users': {
+        'h': {'name': 'host', 'isDone': True, 'isSurrendered': False}, 'p': {'name': 'player'}}}
+    assert [kind for kind, _ in diff_room(ROOM, new)] == [PLAYER_DONE, USER_JOINED, ARTICLE_SET, STATUS_CHANGED]
+    assert diff_room(new, dict(new, users={})) == [(USER_LEFT, {'uuid': 'h'}), (USER_LEFT, {'uuid': 'p'})]
+    assert diff_room(ROOM, ROOM) == []
+    assert diff_room(ROOM, None) == [(ROOM_DELETED, {})]
+
+
+def test_feed_resume():
+    feed = RoomFeed(1)
+    feed.on_event(InMemoryEvent('put', '/', ROOM))
+    assert feed.version == 0
+    first_id = feed.event_id(0)
+    feed.on_event(InMemoryEvent('put', '/users/p', {'name': 'player'}))
+    feed.on_event(InMemoryEvent('patch', '/', {'status': 'ONGOING', 'start': 'a'}))
+    messages, version, ended = feed.read(feed.parse_event_id(first_id))
+    assert _kinds(messages) == [USER_JOINED, ARTICLE_SET, STATUS_CHANGED]
+    assert (version, ended) == (3, False)
+    assert feed.read(3)[0] == []
+    # 別のフィードのIDや、履歴に残っていない古いIDからはsnapshotを送る
+    assert _kinds(feed.read(feed.parse_event_id('other.1'))[0]) == ['snapshot']
+    for idx in range(EVENT_HISTORY):
+        feed.on_event(InMemoryEvent('put', '/start', f'url{idx}'))
+    assert _kinds(feed.read(0)[0]) == ['snapshot']
+    assert len(feed.read(3 + 1)[0]) == EVENT_HISTORY - 1
+
+
+def test_restarted_feed_waits_for_listener():
+    # 止めていたフィードは、再開して最初の通知が届くまで古いdataを返さない
+    class Listener:
+        def close(self):
+            pass
+
+    feed = RoomFeed(1)
+    feed.on_event(InMemoryEvent('put', '/', ROOM))
+    feed._listener = Listener()
+    feed.stop()
+    assert not feed.wait_loaded(timeout=0)
+    feed.on_event(InMemoryEvent('put', '/', dict(ROOM, status='ONGOING')))
+    assert feed.wait_loaded(timeout=0) and feed.data['status'] == 'ONGOING'
+    messages, version, _ = feed.read(0)
+    assert _kinds(messages) == [STATUS_CHANGED] and version == 1
+    assert _kinds(feed.read(None)[0]) == ['snapshot']
+
+
+def test_one_listener_per_room(rtdb):
+    rtdb.reference('1').set(ROOM)
+    feeds = [subscribe(1) for _ in range(3)]
+    assert feeds[0] is feeds[1] is feeds[2]
+    assert len(rtdb._listeners) == 1 and feeds[0].data == ROOM
+
+    streams = [stream(feed, heartbeat=0.01) for feed in feeds]
+    for generator in streams:
+        assert _kinds([next(generator)]) == ['snapshot']
+    rtdb.reference('1/users/p').set({'name': 'player'})
+    for generator in streams:
+        assert _kinds([next(generator)]) == [USER_JOINED]
+        assert next(generator) == KEEPALIVE
+        generator.close()
+    assert rtdb._listeners == [] and feeds[0].subscribers == 0
+    # リスナーを止めている間のキャッシュは使わない
+    assert not feeds[0].loaded.is_set()
+
+    # 購読者がいない間の変化は、再開したときにイベントとして送られる
+    rtdb.reference('1/status').set('ONGOING')
+    feed = subscribe(1)
+    assert feed is feeds[0]
+    messages, _, _ = feed.read(1)
+    assert _kinds(messages) == [STATUS_CHANGED]
+    unsubscribe(feed)
+
+
+def test_record_write(rtdb):
+    rtdb.reference('1').set(ROOM)
+    feed = subscribe(1)
+    # リスナーからの通知より先に届いても同じ状態になる
+    record_write(1, {'users/p': {'name': 'player'}, 'startedAt': {'.sv': 'timestamp'}})
+    rtdb.reference('1/users/p').set({'name': 'player'})
+    assert feed.version == 1 and 'startedAt' not in feed.data
+    record_write(1, {'': None})
+    assert feed.read(1) == ([room_events.format_event(feed.event_id(2), ROOM_DELETED, {})], 2, True)
+    unsubscribe(feed)
+
+
+def _read_event(res):
+    lines = []
+    while True:
+        line = res.fp.readline().decode()
+        if line == '\n':
+            return lines
+        lines.append(line.rstrip('\n'))
+
+
+def test_stream_does_not_block_other_requests(rtdb, monkeypatch):
+    # 購読者が接続している間も、他のリクエストを処理できる
+    from werkzeug.serving import make_server
+    from admission import ConcurrencyLimiter
+    import main
+    monkeypatch.setattr(main, 'event_streams', ConcurrencyLimiter(1))
+    rtdb.reference('1').set(ROOM)
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    subscriber = HTTPConnection('127.0.0.1', server.port, timeout=5)
+    other = HTTPConnection('127.0.0.1', server.port, timeout=5)
+    try:
+        subscriber.request('GET', '/room/1/events')
+        events = subscriber.getresponse()
+        assert events.status == 200
+        assert 'event: snapshot' in _read_event(events)
+
+        other.request('POST', '/room/join', body=json.dumps({'room_id': 1, 'uuid': 'g', 'name': 'guest'}),
+                      headers={'Content-Type': 'application/json'})
+        assert other.getresponse().status == 201
+        assert 'event: user_joined' in _read_event(events)
+
+        # 接続の上限を超えた購読は待たせずに断る
+        other.request('GET', '/room/1/events')
+        assert other.getresponse().status == 503
+    finally:
+        subscriber.close()
+        other.close()
+        server.shutdown()
@@ -1,10 +1,15 @@
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from firebase_admin import db
 
-from rooms import (RoomValidator, init_room, _destroy_room, _join_room, setting_article, change_player_progress,
-                   change_room_status, is_all_room_users_done, get_room_users)
-from exceptions import RoomNotExistException, NotHostException, RoomAlreadyClosedException
-from conf import RoomStatuses
+import rooms
+import handlers
+from rooms import (RoomValidator, create_new_room, init_room, claim_game_finalization, release_game_finalization,
+                   _destroy_room, _join_room, setting_article, change_player_progress, change_room_status,
+                   is_all_room_users_done, get_room_users, get_room_data, room_context)
+from exceptions import (RoomIdDuplicateException, RoomNotExistException, NotHostException, RoomAlreadyClosedException,
+                        NotInRoomUserException)
+from conf import RoomStatuses, MIN_ROOM_ID, MAX_ROOM_ID
 
 
 #  init_room -> destroy_roomの順番でテストを実行すること
@@ -41,6 +46,48 @@ def test_destroy_room():
     assert not bool(ref.get())
 
 
+def test_create_new_room():
+    room_id = create_new_room('test_user_uuid', 'test_user_name')
+    assert MIN_ROOM_ID <= room_id <= MAX_ROOM_ID
+    assert get_room_data(room_id)['host'] == 'test_user_uuid'
+    _destroy_room(room_id, force_destroy=True)
+
+
+def test_create_new_room_skips_existing_room(monkeypatch):
+    # 既にあるroomは上書きせず、ブロックの空いているidだけを払い出す (ブロック117は12340~12359)
+    existing = [room_id for room_id in range(12340, 12360) if room_id != 12346]
+    for room_id in existing:
+        init_room(room_id, 'other_user_uuid', 'other_user_name')
+    monkeypatch.setattr(rooms, 'room_id_allocator', rooms.RoomIdAllocator())
+    monkeypatch.setattr(rooms, '_random_room_id_block', lambda: 117)
+    assert create_new_room('test_user_uuid', 'test_user_name') == 12346
+    assert get_room_data(12345)['host'] == 'other_user_uuid'
+    assert get_room_data(12346)['host'] == 'test_user_uuid'
+
+    # 他のインスタンスが確保しているブロックは使わない
+    blocks = iter([117, 117, 117, 117, 117, 118])
+    other = rooms.RoomIdAllocator()
+    monkeypatch.setattr(rooms, '_random_room_id_block', lambda: next(blocks))
+    with pytest.raises(RoomIdDuplicateException):
+        other.allocate()
+    assert 12360 <= other.allocate() < 12380
+    for room_id in existing + [12346]:
+        _destroy_room(room_id, force_destroy=True)
+
+
+def test_create_new_room_reserves_a_block(monkeypatch):
+    # ブロックを確保した後は、roomとインデックスを書く1回の呼び出しで作る
+    calls = []
+    monkeypatch.setattr(rooms, 'room_id_allocator', rooms.RoomIdAllocator())
+    room_ids = [create_new_room('test_user_uuid', 'test_user_name')]
+    monkeypatch.setattr(rooms, '_claim_room_id_block', lambda *args: calls.append(args))
+    room_ids.append(create_new_room('test_user_uuid', 'test_user_name'))
+    assert calls == []
+    assert room_ids[0] // 20 == room_ids[1] // 20 and room_ids[0] != room_ids[1]
+    for room_id in room_ids:
+        _destroy_room(room_id, force_destroy=True)
+
+
 def test_destroy_room_not_exists():
     with pytest.raises(RoomNotExistException):
         room_id = 22345
@@ -116,6 +163,20 @@ def test_join_room():
     assert result == expected_data
 
 
+@room_decorator(20020)
+def test_join_room_concurrently():
+    room_id = 20020
+    user_uuids = [f'join_user_uuid{idx}' for idx in range(100)]
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        futures = [executor.submit(_join_room, room_id, user_uuid, user_uuid) for user_uuid in user_uuids]
+        for future in futures:
+            future.result()
+
+    rtdb_users = get_room_users(room_id)
+    assert len(rtdb_users) == len(user_uuids) + 1
+    assert all(rtdb_users[user_uuid]['name'] == user_uuid for user_uuid in user_uuids)
+
+
 def test_join_room_failed():
     with pytest.raises(RoomNotExistException):
         room_id = 20001
@@ -252,6 +313,25 @@ def test_change_player_progress():
     }
 
 
+@room_decorator(50001)
+def test_change_player_progress_not_in_room_user():
+    room_id = 50001
+    with pytest.raises(NotInRoomUserException):
+        change_player_progress(room_id, 'not_in_room_user_uuid', True, False)
+    assert db.reference(f'{room_id}/users/not_in_room_user_uuid/').get() is None
+    change_player_progress(room_id, 'test_user_uuid', True, False)
+    assert is_all_room_users_done(get_room_users(room_id)) is True
+
+
+@room_decorator(50002)
+def test_player_progress_handler_not_in_room_user():
+    room_id = 50002
+    body, status = handlers.player_progress({'room_id': room_id, 'uuid': 'not_in_room_user_uuid', 'name': 'name',
+                                             'urls': [], 'is_done': True, 'is_surrendered': False})
+    assert status == NotInRoomUserException.status_code
+    assert body == {'message': NotInRoomUserException.message}
+
+
 def test_is_all_room_users_done():
     rtdb_users = {
         'user-uuid1': {
@@ -305,3 +385,88 @@ def test_get_room_users():
     }
     rtdb_users = get_room_users(room_id)
     assert rtdb_users == expected_data
+
+
+@room_decorator(70000)
+def test_room_context_shares_snapshot():
+    room_id = 70000
+    user_uuid = 'test_user_uuid'
+    with room_context() as ctx:
+        change_player_progress(room_id, user_uuid, True, False)
+        rtdb_users = get_room_users(room_id)
+        get_room_data(room_id)
+        change_room_status(room_id, user_uuid, start=False, force_change=True)
+        # change_player_progressの確認で1回、書き込み後のget_room_usersで1回
+        assert ctx.reads == 2
+    assert rtdb_users[user_uuid]['isDone'] is True
+
+
+@room_decorator(70001)
+def test_change_player_progress_with_stale_snapshot():
+    room_id = 70001
+    user_uuid = 'test_user_uuid'
+    with room_context():
+        get_room_data(room_id)
+        # スナップショットを読んだ後に、他のリクエストが書き込んだ
+        db.reference(f'{room_id}/users/{user_uuid}/isDone').set(True)
+        change_player_progress(room_id, user_uuid, False, False)
+    assert db.reference(f'{room_id}/users/{user_uuid}/isDone').get() is False
+
+
+def test_rooms_are_routed_to_shards(monkeypatch):
+    # 2つのインメモリのRTDBをシャードにして、roomの読み書きがroom idのシャードだけに届くことを確認する
+    import shards
+    from inmemory import InMemoryRTDB, reference_router
+    shard_urls = ['https://shard-0.example.com', 'https://shard-1.example.com']
+    rtdbs = {url: InMemoryRTDB() for url in shard_urls}
+    monkeypatch.setattr(db, 'reference', reference_router(InMemoryRTDB(), rtdbs))
+    monkeypatch.setattr(shards, 'router', shards.ShardRouter(shard_urls))
+
+    room_ids = list(range(30000, 30010))
+    for room_id in room_ids:
+        init_room(room_id, 'host', 'host')
+        _join_room(room_id, 'player', 'player')
+        change_room_status(room_id, 'host', start=False)
+    for room_id in room_ids:
+        own = rtdbs[shards.room_shard(room_id).url]
+        other = rtdbs[shard_urls[1 - shard_urls.index(shards.room_shard(room_id).url)]]
+        assert own.peek(f'{room_id}/users/player/name') == 'player'
+        assert own.peek(f'_meta/endedRooms/{room_id}') is not None
+        assert other.peek(f'{room_id}') is None
+        assert RoomValidator(room_id).room_data['status'] == RoomStatuses.ENDED
+    assert all(rtdb.peek('/') for rtdb in rtdbs.values())
+
+    _destroy_room(room_ids[0])
+    for room_id in room_ids[1:]:
+        _destroy_room(room_id)
+    assert all(rtdb.peek('/') is None for rtdb in rtdbs.values())
+
+
+def test_claim_game_finalization(monkeypatch):
+    room_id = 70002
+    init_room(room_id, 'test_user_uuid', 'test_user_name')
+    lease_id = claim_game_finalization(room_id)
+    assert lease_id is not None
+    assert claim_game_finalization(room_id) is None
+    # 他の呼び出しの確保は外さない
+    release_game_finalization(room_id, 'other')
+    assert claim_game_finalization(room_id) is None
+    release_game_finalization(room_id, lease_id)
+    assert get_room_data(room_id).get('isFinalizing') is None
+
+    # 期限が切れた確保は取り直せる
+    lease_id = claim_game_finalization(room_id)
+    monkeypatch.setattr(rooms, 'FINALIZATION_LEASE_MS', -1)
+    assert claim_game_finalization(room_id) not in (None, lease_id)
+    monkeypatch.undo()
+
+    # 次のゲームを始めると確保は消える
+    change_room_status(room_id, 'test_user_uuid', start=True)
+    assert get_room_data(room_id).get('isFinalizing') is None
+    assert claim_game_finalization(room_id) is not None
+    _destroy_room(room_id, force_destroy=True)
+
+    # 削除されたroomは確保せず、isFinalizingだけのノードも作らない
+    assert claim_game_finalization(room_id) is None
+    release_game_finalization(room_id, lease_id)
+    assert db.reference(f'{room_id}/').get() is None
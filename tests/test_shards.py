@@ -0,0 +1,68 @@
+import pytest
+from firebase_admin import db
+
+from shards import ShardRouter, jump_hash, rebalance, shard_room_counts, rtdb_shard_calls_total
+from inmemory import InMemoryRTDB, reference_router
+
+URLS = ['https://shard-0.example.com', 'https://shard-1.example.com', 'https://shard-2.example.com/']
+INDEX_PATH = '_meta/roomActivity'
+
+
+@pytest.fixture
+def rtdbs(monkeypatch):
+    rtdbs = {url.rstrip('/'): InMemoryRTDB() for url in URLS}
+    monkeypatch.setattr(db, 'reference', reference_router(InMemoryRTDB(), rtdbs))
+    return rtdbs
+
+
+def test_jump_hash():
+    room_ids = range(10000, 20000)
+    two = [jump_hash(room_id, 2) for room_id in room_ids]
+    three = [jump_hash(room_id, 3) for room_id in room_ids]
+    assert two == [jump_hash(room_id, 2) for room_id in room_ids]
+    # 偏りが小さく、シャードを増やしても新しいシャードに入るroomしか動かない
+    assert 0.45 < two.count(0) / len(two) < 0.55
+    moved = [(a, b) for a, b in zip(two, three) if a != b]
+    assert all(b == 2 for _, b in moved)
+    assert 0.28 < len(moved) / len(two) < 0.38
+
+
+def test_router(rtdbs):
+    router = ShardRouter(URLS)
+    assert router.shards[2].url == 'https://shard-2.example.com'
+    groups = router.group(range(10000, 10100))
+    assert sorted(shard.index for shard in groups) == [0, 1, 2]
+    assert sum(len(room_ids) for room_ids in groups.values()) == 100
+
+    shard = router.shard_of(12345)
+    before = rtdb_shard_calls_total.value(str(shard.index), 'ok')
+    with shard.call('test'):
+        shard.reference('12345/status').set('PREPARATION')
+    assert rtdbs[shard.url].peek('12345/status') == 'PREPARATION'
+    assert rtdb_shard_calls_total.value(str(shard.index), 'ok') == before + 1
+    assert ShardRouter([]).shards[0].url is None
+
+
+def test_rebalance(rtdbs):
+    source, target = ShardRouter(URLS[:2]), ShardRouter(URLS)
+    room_ids = [str(room_id) for room_id in range(20000, 20060)]
+    for room_id in room_ids:
+        shard = source.shard_of(room_id)
+        shard.reference('/').update({room_id: {'status': 'ONGOING'}, f'{INDEX_PATH}/{room_id}': int(room_id)})
+    counts = shard_room_counts(source)
+    assert sum(counts.values()) == 60 and min(counts.values()) > 0
+
+    stats = rebalance(source, target, (INDEX_PATH,), dry_run=True)
+    assert stats['moved'] == 0 and stats['scanned'] == 60
+    assert set(stats['moves']) <= {'0->2', '1->2'}
+    assert rtdbs[URLS[2].rstrip('/')].peek('/') is None
+
+    stats = rebalance(source, target, (INDEX_PATH,), batch_size=7)
+    assert stats['moved'] == sum(stats['moves'].values()) > 0
+    for room_id in room_ids:
+        own = rtdbs[target.shard_of(room_id).url]
+        assert own.peek(room_id) == {'status': 'ONGOING'}
+        assert own.peek(f'{INDEX_PATH}/{room_id}') == int(room_id)
+    assert sum(shard_room_counts(target).values()) == 60
+    # 2回目は何も移さない
+    assert rebalance(target, target, (INDEX_PATH,))['moved'] == 0
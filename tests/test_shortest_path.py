@@ -0,0 +1,121 @@
+from shortest_path import (IndexLinkGraph, WikipediaLinkGraph, bidirectional_search, get_shortest_path,
+                           FOUND, NOT_FOUND, TOO_LARGE, TIMEOUT, OVER_BUDGET)
+from inmemory import FakeWikipedia
+from link_index import LinkIndex, write_index
+import shortest_path
+import validation
+
+GRAPH = {
+    'A': {'B', 'X'},
+    'B': {'C'},
+    'C': {'D'},
+    'X': {'Y'},
+    'Y': {'Z'},
+    'Z': {'D'},
+    'D': {'A'},
+    'Island': set(),
+}
+
+
+class DictGraph:
+    def __init__(self, graph):
+        self.graph = graph
+        self.reverse = {}
+        for source, links in graph.items():
+            for link in links:
+                self.reverse.setdefault(link, set()).add(source)
+
+    def node(self, title):
+        return title if title in self.graph or title in self.reverse else None
+
+    def title(self, node):
+        return node
+
+    def expand(self, nodes, forward):
+        for node in nodes:
+            yield node, sorted((self.graph if forward else self.reverse).get(node, ()))
+
+
+def test_bidirectional_search_finds_shortest_path():
+    result = bidirectional_search(DictGraph(GRAPH), 'A', 'D')
+    assert result['status'] == FOUND
+    assert result['distance'] == 3
+    assert result['path'] == ['A', 'B', 'C', 'D']
+
+
+def test_bidirectional_search_same_and_unreachable():
+    graph = DictGraph(GRAPH)
+    assert bidirectional_search(graph, 'A', 'A')['distance'] == 0
+    assert bidirectional_search(graph, 'A', 'Island')['status'] == NOT_FOUND
+    assert bidirectional_search(graph, 'A', 'Missing')['status'] == NOT_FOUND
+
+
+def test_bidirectional_search_budgets():
+    chain = {str(i): {str(i + 1)} for i in range(100)}
+    assert bidirectional_search(DictGraph(chain), '0', '100', max_visited=10)['status'] == TOO_LARGE
+    assert bidirectional_search(DictGraph(chain), '0', '100', time_budget=-1)['status'] == TIMEOUT
+    assert bidirectional_search(DictGraph(chain), '0', '100')['distance'] == 100
+
+
+def test_index_graph_matches_dict_graph(tmp_path):
+    path = str(tmp_path / 'links.idx')
+    write_index(path, GRAPH)
+    index = LinkIndex.open(path)
+    try:
+        result = bidirectional_search(IndexLinkGraph(index), 'X', 'B')
+        assert result['path'] == ['X', 'Y', 'Z', 'D', 'A', 'B']
+    finally:
+        index.close()
+
+
+def test_get_shortest_path_caches_per_pair(monkeypatch):
+    wikipedia = FakeWikipedia({title: sorted(links) for title, links in GRAPH.items()})
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', wikipedia.iter_page)
+    monkeypatch.setattr(validation, 'fetch_redirects', wikipedia.resolve_redirects)
+    monkeypatch.setattr(validation, 'link_cache', validation.LinkCache())
+    monkeypatch.setattr(shortest_path, 'fetch_backlinks', wikipedia.backlinks)
+    monkeypatch.setattr(shortest_path, 'path_cache', validation.LRUCache(16, 60))
+    graph = WikipediaLinkGraph('https://ja.wikipedia.org')
+    result = get_shortest_path('https://ja.wikipedia.org/wiki/A', 'https://ja.m.wikipedia.org/wiki/D#top', graph)
+    assert result['distance'] == 3
+    assert result['path'] == ['https://ja.wikipedia.org/wiki/A', 'https://ja.wikipedia.org/wiki/B',
+                              'https://ja.wikipedia.org/wiki/C', 'https://ja.wikipedia.org/wiki/D']
+    calls = wikipedia.stats.calls
+    assert get_shortest_path('https://ja.wikipedia.org/wiki/A', 'https://ja.wikipedia.org/wiki/D', graph) == result
+    assert wikipedia.stats.calls == calls
+
+
+def test_wikipedia_graph_uses_its_own_budget(monkeypatch):
+    # 探索で読んだページは検証のlink_cacheに入れず、リクエスト数も別のプールで数える
+    wikipedia = FakeWikipedia({title: sorted(links) for title, links in GRAPH.items()})
+    pools = []
+
+    def _iter_wikipedia_page(url):
+        pools.append(validation._fetch_pool.get()[0])
+        return wikipedia.iter_page(url)
+
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', _iter_wikipedia_page)
+    monkeypatch.setattr(validation, 'link_cache', validation.LinkCache())
+    monkeypatch.setattr(shortest_path, 'search_link_cache', validation.LinkCache(16, 60))
+    graph = WikipediaLinkGraph('https://ja.wikipedia.org')
+    assert [len(links) for _, links in graph.expand([graph.node('A')], True)] == [2]
+    assert pools == ['search']
+    assert len(validation.link_cache) == 0 and len(shortest_path.search_link_cache) == 1
+
+
+def test_wikipedia_graph_stops_at_fetch_budget(monkeypatch):
+    # 読めるページ数を使い切ったら、経路が無い(NOT_FOUND)とは区別して返す
+    wikipedia = FakeWikipedia({title: sorted(links) for title, links in GRAPH.items()})
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', wikipedia.iter_page)
+    monkeypatch.setattr(validation, 'link_cache', validation.LinkCache())
+    monkeypatch.setattr(shortest_path, 'fetch_backlinks', wikipedia.backlinks)
+    monkeypatch.setattr(shortest_path, 'search_link_cache', validation.LinkCache(16, 60))
+    monkeypatch.setattr(shortest_path, 'backlink_cache', validation.LRUCache(16, 60))
+    graph = WikipediaLinkGraph('https://ja.wikipedia.org', max_fetches=2)
+    result = bidirectional_search(graph, 'A', 'D')
+    assert result['status'] == OVER_BUDGET and result['path'] is None
+    assert graph.fetches == 2 and wikipedia.stats.calls == 2
+    # 読んだページはキャッシュから引くので、次の探索の分は減らない
+    graph = WikipediaLinkGraph('https://ja.wikipedia.org', max_fetches=4)
+    assert bidirectional_search(graph, 'A', 'D')['distance'] == 3
+    assert graph.fetches <= 4
@@ -0,0 +1,25 @@
+from startup_report import parse_importtime, summarize
+
+IMPORTTIME = '''import time: self [us] | cumulative | imported package
+import time:       100 |        100 | site
+import time:       300 |        300 |     werkzeug.local
+import time:       200 |        500 |   flask
+import time:        50 |         50 |     shards
+import time:        80 |        130 |   rooms
+import time:        20 |        650 | main
+'''
+
+
+def test_parse_importtime():
+    entries = parse_importtime(IMPORTTIME.splitlines())
+    assert [(entry['module'], entry['depth']) for entry in entries] == [
+        ('site', 0), ('werkzeug.local', 2), ('flask', 1), ('shards', 2), ('rooms', 1), ('main', 0)]
+    assert entries[2]['self_us'] == 200 and entries[2]['cumulative_us'] == 500
+
+
+def test_summarize():
+    report = summarize(parse_importtime(IMPORTTIME.splitlines()), 'main', top=2)
+    assert report['import_ms'] == 0.75
+    assert report['direct_imports_ms'] == {'flask': 0.5, 'rooms': 0.13}
+    assert report['packages_ms'] == {'werkzeug': 0.3, 'flask': 0.2}
+    assert report['modules'] == 6
@@ -0,0 +1,49 @@
+import io
+import json
+import time
+import threading
+
+from structured_log import BatchedLogger, StreamSink
+
+
+def test_batched_logger_writes_in_background():
+    stream = io.StringIO()
+    written = threading.Event()
+
+    class Sink(StreamSink):
+        def write(self, entries):
+            super().write(entries)
+            written.set()
+
+    logger = BatchedLogger(Sink(stream), batch_size=2, flush_interval=0.05)
+    logger.log_struct({'error': 'e1'}, severity='ERROR')
+    logger.log_struct({'error': 'e2'}, severity='ERROR')
+    assert written.wait(timeout=2)
+    logger.flush()
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(line['error'], line['severity']) for line in lines] == [('e1', 'ERROR'), ('e2', 'ERROR')]
+
+
+def test_batched_logger_drops_when_queue_is_full():
+    started, release = threading.Event(), threading.Event()
+    written = []
+
+    class BlockingSink:
+        def write(self, entries):
+            started.set()
+            release.wait(timeout=2)
+            written.extend(entries)
+
+    logger = BatchedLogger(BlockingSink(), max_queue_size=2, batch_size=1, flush_interval=0.05)
+    logger.log_struct({'error': 'e0'})
+    assert started.wait(timeout=2)
+    for idx in range(1, 5):
+        logger.log_struct({'error': f'e{idx}'})
+    assert logger.dropped == 2
+    release.set()
+    for _ in range(100):
+        logger.flush()
+        if len(written) == 3:
+            break
+        time.sleep(0.01)
+    assert sorted(entry['info']['error'] for entry in written) == ['e0', 'e1', 'e2']
@@ -0,0 +1,73 @@
+from firebase_admin import db
+
+from rooms import (init_room, change_room_status, setting_article, record_shortest_path, _destroy_room, ROOM_ACTIVITY_PATH,
+                   ENDED_ROOMS_PATH)
+from firestore import record_player_progress
+from sweeper import sweep, find_rooms
+from shards import room_shard
+from conf import get_firestore
+
+
+def _set_index(path: str, room_id: int, value: int):
+    db.reference(f'{path}/{room_id}').set(value)
+
+
+def test_init_room_updates_activity_index():
+    room_id = 12346
+    init_room(room_id, 'test_user_uuid', 'test_user_name')
+    assert isinstance(db.reference(f'{ROOM_ACTIVITY_PATH}/{room_id}').get(), int)
+    assert db.reference(f'{ENDED_ROOMS_PATH}/{room_id}').get() is None
+
+    change_room_status(room_id, 'test_user_uuid', start=False)
+    assert isinstance(db.reference(f'{ENDED_ROOMS_PATH}/{room_id}').get(), int)
+
+    sweep(room_ttl=0, ended_room_ttl=0, now=1)
+    assert db.reference(f'{room_id}').get() is not None
+    _set_index(ROOM_ACTIVITY_PATH, room_id, 1)
+    _set_index(ENDED_ROOMS_PATH, room_id, 1)
+    sweep(room_ttl=0, ended_room_ttl=0, now=1)
+    assert db.reference(f'{room_id}').get() is None
+
+
+def test_record_shortest_path_updates_activity_index():
+    room_id = 12347
+    start, goal = 'https://ja.wikipedia.org/wiki/A', 'https://ja.wikipedia.org/wiki/B'
+    init_room(room_id, 'test_user_uuid', 'test_user_name')
+    setting_article(room_id, start, True)
+    setting_article(room_id, goal, False)
+    _set_index(ROOM_ACTIVITY_PATH, room_id, 1)
+    assert record_shortest_path(room_id, start, goal, {'status': 'found', 'distance': 1, 'path': [start, goal]})
+    assert db.reference(f'{ROOM_ACTIVITY_PATH}/{room_id}').get() > 1
+    _destroy_room(room_id)
+
+
+def test_sweep():
+    expired_room_id, ended_room_id, active_room_id = 12347, 12348, 12349
+    for room_id in (expired_room_id, ended_room_id, active_room_id):
+        init_room(room_id, 'test_user_uuid', 'test_user_name')
+        record_player_progress(room_id, 'test_user_uuid', 'test_user_name', ['url1'], False)
+    change_room_status(ended_room_id, 'test_user_uuid', start=False)
+    # now=1(秒)で、インデックスの値が1000ミリ秒以下のroomだけを対象にする
+    _set_index(ROOM_ACTIVITY_PATH, expired_room_id, 1)
+    _set_index(ENDED_ROOMS_PATH, ended_room_id, 1)
+    assert set(find_rooms(room_shard(expired_room_id), ROOM_ACTIVITY_PATH, 1000, None)) == {str(expired_room_id)}
+
+    stats = sweep(room_ttl=0, ended_room_ttl=0, dry_run=True, now=1)
+    assert stats['ended'] == 1 and stats['expired'] == 1
+    assert db.reference(f'{expired_room_id}').get() is not None
+
+    stats = sweep(room_ttl=0, ended_room_ttl=0, batch_size=1, now=1)
+    assert sorted(stats['room_ids']) == [str(expired_room_id), str(ended_room_id)]
+    assert stats['progress_documents'] == 2
+    for room_id in (expired_room_id, ended_room_id):
+        assert db.reference(f'{room_id}').get() is None
+        assert db.reference(f'{ROOM_ACTIVITY_PATH}/{room_id}').get() is None
+        assert db.reference(f'{ENDED_ROOMS_PATH}/{room_id}').get() is None
+        assert get_firestore().collection('progress').document(str(room_id)).collection('users').get() == []
+
+    assert db.reference(f'{active_room_id}').get() is not None
+    assert get_firestore().collection('progress').document(str(active_room_id)).collection('users').get() != []
+    sweep(room_ttl=0, ended_room_ttl=0, now=1)
+    _set_index(ROOM_ACTIVITY_PATH, active_room_id, 1)
+    sweep(room_ttl=0, ended_room_ttl=0, now=1)
+    assert db.reference(f'{active_room_id}').get() is None
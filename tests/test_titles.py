@@ -0,0 +1,49 @@
+import pytest
+
+from titles import TitleTable, canonical_url, link_set, has_link
+
+
+def test_canonical_url_variants():
+    expected = 'https://ja.wikipedia.org/wiki/%E6%A4%9C%E7%B4%A2'
+    for url in ('https://ja.wikipedia.org/wiki/%e6%a4%9c%e7%b4%a2',
+                'https://JA.wikipedia.org/wiki/検索#history',
+                'https://ja.m.wikipedia.org/wiki/検索',
+                'https://ja.wikipedia.org/w/index.php?title=検索&oldid=1'):
+        assert canonical_url(url) == expected
+    assert canonical_url('https://en.wikipedia.org/wiki/world wide web') == \
+        'https://en.wikipedia.org/wiki/World_wide_web'
+    assert canonical_url('/wiki/B?x=1', 'https://ja.wikipedia.org/wiki/A') == 'https://ja.wikipedia.org/wiki/B'
+    assert canonical_url('https://example.com/') is None
+    assert canonical_url('https://ja.wikipedia.org/wiki/') is None
+
+
+def test_title_table_interns_variants_to_one_id():
+    table = TitleTable()
+    title_id = table.intern('https://ja.wikipedia.org/wiki/World_Wide_Web')
+    assert table.intern('https://ja.m.wikipedia.org/wiki/World%20Wide%20Web#top') == title_id
+    assert table.intern('https://en.wikipedia.org/wiki/World_Wide_Web') != title_id
+    assert table.title(title_id) == 'World_Wide_Web'
+    assert table.base_url(title_id) == 'https://ja.wikipedia.org'
+    assert len(table) == 2
+
+
+def test_title_table_is_rebuilt_when_full():
+    table = TitleTable(max_size=2)
+    cleared = []
+    table.on_reset(lambda: cleared.append(table.generation))
+    a, b = table.intern('https://ja.wikipedia.org/wiki/A'), table.intern('https://ja.wikipedia.org/wiki/B')
+    c = table.intern('https://ja.wikipedia.org/wiki/C')
+    assert cleared == [1] and len(table) == 1
+    # IDは世代をまたいで使い回さない
+    assert c not in (a, b) and table.title(c) == 'C'
+    with pytest.raises(KeyError):
+        table.url(a)
+    assert table.intern('https://ja.wikipedia.org/wiki/A') not in (a, b, c)
+    with pytest.raises(RuntimeError):
+        table.check_generation(0)
+
+
+def test_link_set():
+    links = link_set([5, 1, 5, 3])
+    assert list(links) == [1, 3, 5]
+    assert has_link(links, 3) and not has_link(links, 4) and not has_link(links, 6)
@@ -1,7 +1,10 @@
 import pytest
 
-from validation import validate_url, validate_urls
+import validation
+from validation import validate_url, validate_urls, LinkCache
 from exceptions import URLValidationException
+from link_index import LinkIndex, write_index
+from inmemory import FakeWikipedia
 
 
 # def test_validate_url():
@@ -55,3 +58,166 @@ from exceptions import URLValidationException
 #     except URLValidationException as e:
 #         expect_message = 'https://ja.wikipedia.org/wiki/%E8%B2%AA%E6%AC%B2%E6%B3%95はhttps://ja.wikipedia.org/wiki/%E6%A4%9C%E7%B4%A2からたどれません'
 #         assert e.message == expect_message
+
+
+PAGE_HTML = '''
+<html><body>
+<div id="mw-navigation"><a href="/wiki/Main_Page">Main Page</a></div>
+<div id="mw-content-text"><div class="mw-parser-output">
+<p><a href="/wiki/%E6%A4%9C%E7%B4%A2">検索</a></p>
+<div><a href="/wiki/NLS">NLS</a></div>
+<a href="https://example.com/">external</a>
+</div></div>
+<div id="footer"><a href="/wiki/Privacy">Privacy</a></div>
+</body></html>
+'''
+
+
+@pytest.fixture(autouse=True)
+def no_redirects(monkeypatch):
+    monkeypatch.setattr(validation, 'fetch_redirects', lambda url: (url, []))
+    monkeypatch.setattr(validation, 'redirect_cache', validation.LRUCache(64, 60))
+    monkeypatch.setattr(validation, 'alias_cache', validation.LRUCache(64, 60))
+
+
+@pytest.fixture
+def fake_wikipedia(monkeypatch):
+    fetched = []
+
+    def _iter_wikipedia_page(url):
+        fetched.append(url)
+        yield PAGE_HTML
+
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', _iter_wikipedia_page)
+    monkeypatch.setattr(validation, 'link_cache', LinkCache())
+    return fetched
+
+
+def test_validate_url_uses_link_cache(fake_wikipedia):
+    url = 'https://ja.wikipedia.org/wiki/World_Wide_Web'
+    assert validate_url(url, 'https://ja.wikipedia.org/wiki/%E6%A4%9C%E7%B4%A2') is True
+    assert validate_url(url + '#history', 'https://ja.wikipedia.org/wiki/NLS') is True
+    assert validate_url(url, 'https://ja.wikipedia.org/wiki/Not_Linked') is False
+    assert validate_url(url, 'https://ja.wikipedia.org/wiki/Main_Page') is False
+    assert fake_wikipedia == [url]
+    assert validation.link_cache.stats == {'size': 1, 'hits': 3, 'misses': 1}
+
+
+def test_link_cache_lru_eviction():
+    cache = LinkCache(max_size=2)
+    cache.set(1, [11, 10])
+    cache.set(2, [20])
+    cache.get(1)
+    cache.set(3, [30])
+    assert cache.get(2) is None
+    assert list(cache.get(1)) == [10, 11]
+
+
+def test_link_cache_ttl():
+    cache = LinkCache(ttl=-1)
+    cache.set(1, [10])
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+PATH_PAGES = {
+    'https://ja.wikipedia.org/wiki/A': '<div id="mw-content-text"><a href="/wiki/B">B</a></div>',
+    'https://ja.wikipedia.org/wiki/B': '<div id="mw-content-text"><a href="/wiki/C">C</a></div>',
+    'https://ja.wikipedia.org/wiki/C': '<div id="mw-content-text"><a href="/wiki/A">A</a></div>',
+    'https://ja.wikipedia.org/wiki/D': '<div id="mw-content-text"><a href="/wiki/A">A</a></div>',
+}
+
+
+@pytest.fixture
+def fake_path_pages(monkeypatch):
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', lambda url: (page for page in [PATH_PAGES[url]]))
+    monkeypatch.setattr(validation, 'link_cache', LinkCache())
+
+
+def test_validate_urls_concurrently(fake_path_pages):
+    start = 'https://ja.wikipedia.org/wiki/A'
+    goal = 'https://ja.wikipedia.org/wiki/A'
+    urls = ['https://ja.wikipedia.org/wiki/B', 'https://ja.wikipedia.org/wiki/C']
+    assert validate_urls(start, urls, goal, max_workers=4) is True
+
+
+def test_validate_urls_concurrently_failed_message(fake_path_pages):
+    start = 'https://ja.wikipedia.org/wiki/A'
+    goal = 'https://ja.wikipedia.org/wiki/D'
+    urls = ['https://ja.wikipedia.org/wiki/B', 'https://ja.wikipedia.org/wiki/D', 'https://ja.wikipedia.org/wiki/A']
+    with pytest.raises(URLValidationException) as sequential:
+        validate_urls(start, urls, goal)
+    with pytest.raises(URLValidationException) as concurrent:
+        validate_urls(start, urls, goal, max_workers=4)
+    assert concurrent.value.message == sequential.value.message
+    assert concurrent.value.message == 'https://ja.wikipedia.org/wiki/Dはhttps://ja.wikipedia.org/wiki/Bからたどれません'
+
+
+def test_token_bucket_waits_after_burst():
+    bucket = validation.TokenBucket(rate=10, capacity=2)
+    assert bucket._reserve() == 0
+    assert bucket._reserve() == 0
+    assert bucket._reserve() == pytest.approx(0.1, abs=0.01)
+
+
+def test_get_path_verdict_is_cached(fake_path_pages, monkeypatch):
+    monkeypatch.setattr(validation, 'verdict_cache', validation.LRUCache(16, 60))
+    calls = []
+    original = validation.validate_urls
+
+    def _validate_urls(*args, **kwargs):
+        calls.append(args)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(validation, 'validate_urls', _validate_urls)
+    start = 'https://ja.wikipedia.org/wiki/A'
+    assert validation.get_path_verdict(start, ['https://ja.wikipedia.org/wiki/B'], 'https://ja.wikipedia.org/wiki/C') \
+        == {'isValid': True, 'message': None}
+    assert validation.get_path_verdict(start + '#top', ['https://ja.wikipedia.org/wiki/B'],
+                                       'https://ja.wikipedia.org/wiki/C') == {'isValid': True, 'message': None}
+    verdict = validation.get_path_verdict(start, [], 'https://ja.wikipedia.org/wiki/D')
+    assert verdict == {'isValid': False, 'message': 'https://ja.wikipedia.org/wiki/Dはhttps://ja.wikipedia.org/wiki/Aからたどれません'}
+    assert len(calls) == 2
+
+
+def test_track_link_cache_counts_worker_threads(fake_path_pages):
+    start = 'https://ja.wikipedia.org/wiki/A'
+    urls = ['https://ja.wikipedia.org/wiki/B', 'https://ja.wikipedia.org/wiki/C']
+    validation.get_outgoing_links(start)
+    with validation.track_link_cache() as tracker:
+        validate_urls(start, urls, start, max_workers=4)
+    assert (tracker.hits, tracker.misses) == (1, 2)
+
+
+def test_validate_url_follows_redirects(monkeypatch):
+    wikipedia = FakeWikipedia({'A': ['WWW'], 'World_Wide_Web': ['A']}, redirects={'WWW': 'World_Wide_Web'})
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', wikipedia.iter_page)
+    monkeypatch.setattr(validation, 'fetch_redirects', wikipedia.resolve_redirects)
+    monkeypatch.setattr(validation, 'link_cache', LinkCache())
+    # Aのページには WWW(リダイレクト) へのリンクしかない
+    assert validate_url(wikipedia.url('A'), wikipedia.url('World_Wide_Web')) is True
+    assert validate_url(wikipedia.url('A'), 'https://ja.m.wikipedia.org/wiki/WWW') is True
+    # リダイレクト表が埋まったので、リダイレクト元のURLで開いても同じページとして扱う
+    calls = wikipedia.stats.calls
+    assert validate_url(wikipedia.url('WWW'), wikipedia.url('A')) is True
+    assert validate_url(wikipedia.url('World_Wide_Web'), wikipedia.url('A')) is True
+    assert wikipedia.stats.calls == calls + 1
+
+
+def test_redirect_links_use_link_index(monkeypatch, tmp_path):
+    # インデックスにある記事へのリダイレクトは、インデックスのリダイレクト表で判定する (APIを呼ばない)
+    path = str(tmp_path / 'links.idx')
+    write_index(path, {'World_Wide_Web': {'B'}, 'B': set(), 'WWW': set()}, redirects={'WWW': 'World_Wide_Web'})
+    index = LinkIndex.open(path)
+    wikipedia = FakeWikipedia({'A': ['WWW']})
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', wikipedia.iter_page)
+    monkeypatch.setattr(validation, 'fetch_redirects', wikipedia.resolve_redirects)
+    monkeypatch.setattr(validation, 'link_cache', LinkCache())
+    monkeypatch.setattr(validation, 'link_index', index)
+    try:
+        # Aはインデックスに無いのでページを読む
+        assert validate_url(wikipedia.url('A'), wikipedia.url('World_Wide_Web')) is True
+        assert validate_url(wikipedia.url('A'), wikipedia.url('B')) is False
+        assert wikipedia.stats.calls == 1
+    finally:
+        index.close()
@@ -0,0 +1,67 @@
+import pytest
+
+import validation
+import warmup
+from validation import LinkCache
+
+PAGES = {
+    'https://ja.wikipedia.org/wiki/Start':
+        '<div id="mw-content-text"><a href="/wiki/B">B</a><a href="/wiki/A">A</a><a href="/wiki/C">C</a></div>',
+    'https://ja.wikipedia.org/wiki/A': '<div id="mw-content-text"><a href="/wiki/Goal">Goal</a></div>',
+    'https://ja.wikipedia.org/wiki/B': '<div id="mw-content-text"></div>',
+    'https://ja.wikipedia.org/wiki/Goal': '<div id="mw-content-text"><a href="/wiki/Start">Start</a></div>',
+}
+
+
+@pytest.fixture
+def fake_pages(monkeypatch):
+    fetched = []
+
+    def _iter_wikipedia_page(url):
+        fetched.append(url)
+        if url not in PAGES:
+            raise ConnectionError(url)
+        yield PAGES[url]
+
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', _iter_wikipedia_page)
+    monkeypatch.setattr(validation, 'link_cache', LinkCache())
+    monkeypatch.setattr(warmup, '_warmups', validation.LRUCache(16, 60))
+    return fetched
+
+
+def test_warm_start_prefetches_first_ring_in_page_order(fake_pages):
+    warmup.warm_article(1, 'https://ja.wikipedia.org/wiki/Start', True, link_limit=2)
+    assert set(fake_pages) == {'https://ja.wikipedia.org/wiki/Start', 'https://ja.wikipedia.org/wiki/B',
+                               'https://ja.wikipedia.org/wiki/A'}
+    status = warmup.get_warmup_status(1)['targets']['start']
+    assert (status['state'], status['fetched'], status['cached'], status['failed']) == ('done', 3, 0, 0)
+    # 先読みしたページは検証でキャッシュから引ける
+    with validation.track_link_cache() as tracker:
+        assert validation.validate_urls('https://ja.wikipedia.org/wiki/Start', ['https://ja.wikipedia.org/wiki/A'],
+                                        'https://ja.wikipedia.org/wiki/Goal')
+    assert (tracker.hits, tracker.misses) == (2, 0)
+
+
+def test_warm_article_records_failures_and_hit_rate(fake_pages):
+    warmup.warm_article(2, 'https://ja.wikipedia.org/wiki/Start', True, link_limit=10)
+    warmup.warm_article(2, 'https://ja.wikipedia.org/wiki/Goal', False, link_limit=10)
+    warmup.get_room_warmup(2).record_validation(hits=3, misses=1)
+    status = warmup.get_warmup_status(2)
+    assert status['targets']['start']['failed'] == 1
+    assert status['targets']['goal']['fetched'] == 1
+    assert status['validation'] == {'hits': 3, 'misses': 1, 'hitRate': 0.75}
+    assert warmup.get_warmup_status(3) is None
+
+
+def test_warm_article_uses_its_own_budget(fake_pages, monkeypatch):
+    # 先読みのリクエストは検証とは別のプールで数え、検証のバケットを減らさない
+    pools = []
+    iter_page = validation.iter_wikipedia_page
+
+    def _iter_wikipedia_page(url):
+        pools.append(validation._fetch_pool.get()[0])
+        return iter_page(url)
+
+    monkeypatch.setattr(validation, 'iter_wikipedia_page', _iter_wikipedia_page)
+    warmup.warm_article(4, 'https://ja.wikipedia.org/wiki/Start', True, link_limit=2)
+    assert pools == ['warmup'] * 3
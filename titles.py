@@ -0,0 +1,118 @@
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Optional
+from urllib.parse import urlsplit, urljoin, quote, unquote, parse_qs
+
+from conf import TITLE_TABLE_MAX_SIZE
+
+# WikipediaのURLを正規化し、プロセス内で一意な整数のタイトルIDに変換する
+# (IDはプロセスごとに振るので、永続化するデータには使わない)
+ARTICLE_PATH = '/wiki/'
+INDEX_PHP_PATH = '/w/index.php'
+MOBILE_HOST_PART = '.m.'
+TITLE_SAFE = "/:()!$&'*+,;=@~-._"
+
+
+def normalize_title(title: str):
+    # URLのパスに含まれる(エンコードされた)タイトルを正規化する
+    return normalize_plain_title(unquote(title))
+
+
+def normalize_plain_title(title: str):
+    # MediaWikiはスペースとアンダースコアを区別せず、先頭の文字を大文字として扱う
+    title = title.replace(' ', '_').strip('_')
+    return title[:1].upper() + title[1:]
+
+
+def canonical_url(url: str, base_url: str = None) -> Optional[str]:
+    # 記事のURLを https://{言語}.wikipedia.org/wiki/{タイトル} の形にそろえる。記事でなければNone
+    if base_url:
+        url = urljoin(base_url, url)
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().replace(MOBILE_HOST_PART, '.', 1)
+    if parts.path.startswith(ARTICLE_PATH):
+        title = parts.path[len(ARTICLE_PATH):]
+    elif parts.path == INDEX_PHP_PATH:
+        title = parse_qs(parts.query).get('title', [''])[0]
+    else:
+        return None
+    title = normalize_title(title)
+    if not host or not title:
+        return None
+    return f'https://{host}{ARTICLE_PATH}{quote(title, safe=TITLE_SAFE)}'
+
+
+class TitleTable:
+    # 正規化したURL <-> タイトルID
+    # max_size個を超えたら表を空にして作り直す (世代を進める)。0なら作り直さない
+    # IDは世代をまたいで使い回さないので、前の世代のIDを引くとKeyErrorになる
+    # IDを持つキャッシュは、作り直したときに一緒に消すようon_resetで登録しておく
+    def __init__(self, max_size: int = 0):
+        self.max_size = max_size
+        self.generation = 0
+        # (この世代の最初のID, URLのリスト)。世代を進めるときに1回の代入で入れ替える
+        self._table = (0, [])
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._reset_listeners = []
+
+    def __len__(self):
+        return len(self._table[1])
+
+    def on_reset(self, listener):
+        self._reset_listeners.append(listener)
+        return listener
+
+    def intern(self, url: str, base_url: str = None) -> Optional[int]:
+        key = canonical_url(url, base_url)
+        if key is None:
+            return None
+        title_id = self._ids.get(key)
+        if title_id is None:
+            reset = False
+            with self._lock:
+                title_id = self._ids.get(key)
+                if title_id is None:
+                    first_id, urls = self._table
+                    if self.max_size and len(urls) >= self.max_size:
+                        self._ids = {}
+                        self._table = first_id, urls = first_id + len(urls), []
+                        self.generation += 1
+                        reset = True
+                    title_id = self._ids[key] = first_id + len(urls)
+                    urls.append(key)
+            if reset:
+                for listener in self._reset_listeners:
+                    listener()
+        return title_id
+
+    def check_generation(self, generation: int):
+        # generationの世代から表が作り直されていたら、その間に得たIDを比べた結果は使えない
+        if self.generation != generation:
+            raise RuntimeError('title table was rebuilt during the operation')
+
+    def url(self, title_id: int):
+        first_id, urls = self._table
+        if title_id < first_id:
+            raise KeyError(title_id)
+        return urls[title_id - first_id]
+
+    def title(self, title_id: int):
+        return unquote(self.url(title_id).split(ARTICLE_PATH, 1)[1])
+
+    def base_url(self, title_id: int):
+        return self.url(title_id).split(ARTICLE_PATH, 1)[0]
+
+
+title_table = TitleTable(TITLE_TABLE_MAX_SIZE)
+
+
+def link_set(title_ids: Iterable[int]):
+    # ページのリンク先はソート済みのuint32配列で持つ (setより1リンクあたりのメモリが小さい)
+    return array('I', sorted(set(title_ids)))
+
+
+def has_link(links, title_id: int):
+    idx = bisect_left(links, title_id)
+    return idx < len(links) and links[idx] == title_id
@@ -1,27 +1,398 @@
 import time
-import requests
-from typing import List
-
-from bs4 import BeautifulSoup
+import codecs
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
+from urllib.parse import urlsplit, quote
 
 from exceptions import URLValidationException
+from link_index import LinkIndex, title_from_url
+from link_extractor import iter_article_links, extract_article_page
+from titles import title_table, link_set, has_link, canonical_url
+from metrics import REGISTRY, Counter, wikipedia_seconds
+
+LINK_CACHE_MAX_SIZE = 2048
+LINK_CACHE_TTL = 60 * 60  # 秒
+VERDICT_CACHE_MAX_SIZE = 4096
+VERDICT_CACHE_TTL = 60 * 60  # 秒
+REDIRECT_CACHE_MAX_SIZE = 16384
+REDIRECT_CACHE_TTL = 24 * 60 * 60  # 秒
+FETCH_MAX_WORKERS = 8
+FETCH_TIMEOUT = 10  # 秒
+FETCH_CHUNK_SIZE = 16 * 1024
+# ホストごとのリクエスト数制限(1秒あたりのリクエスト数, バースト)
+HOST_RATE_LIMIT = 5
+HOST_RATE_BURST = 5
+
+redirect_lookups_total = REGISTRY.register(Counter(
+    'redirect_lookups_total', 'Redirect lookups for links not found directly, by source.', ('source',)))
+
+
+class LRUCache:
+    # LRUで追い出し、ttl秒を過ぎたエントリは無効とする
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expire_at, value = entry
+            if expire_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class CacheTracker:
+    # 呼び出し元の処理の中で起きたキャッシュのヒット・ミスを数える
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+_cache_tracker: ContextVar = ContextVar('cache_tracker', default=None)
+
+
+@contextmanager
+def track_link_cache():
+    token = _cache_tracker.set(CacheTracker())
+    try:
+        yield _cache_tracker.get()
+    finally:
+        _cache_tracker.reset(token)
+
+
+class LinkCache(LRUCache):
+    # ページのタイトルID -> そのページから出ているリンク先のタイトルID (titles.link_set)
+    def __init__(self, max_size: int = LINK_CACHE_MAX_SIZE, ttl: float = LINK_CACHE_TTL):
+        super().__init__(max_size, ttl)
+
+    def get(self, title_id: int):
+        links = super().get(title_id)
+        tracker = _cache_tracker.get()
+        if tracker is not None:
+            tracker.record(links is not None)
+        return links
+
+    def set(self, title_id: int, links):
+        super().set(title_id, link_set(links))
+
+
+link_cache = LinkCache()
+# (start, path, goal)のタイトルID -> 判定結果
+verdict_cache = LRUCache(VERDICT_CACHE_MAX_SIZE, VERDICT_CACHE_TTL)
+# タイトルID -> リダイレクト先のタイトルID
+redirect_cache = LRUCache(REDIRECT_CACHE_MAX_SIZE, REDIRECT_CACHE_TTL)
+# タイトルID -> そのタイトルへのリダイレクト元のタイトルID
+alias_cache = LRUCache(REDIRECT_CACHE_MAX_SIZE, REDIRECT_CACHE_TTL)
+
+
+@title_table.on_reset
+def _clear_title_caches():
+    # タイトルIDの表が作り直されたら、IDを持つキャッシュも消す
+    for cache in (link_cache, verdict_cache, redirect_cache, alias_cache):
+        cache.clear()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # トークンを1つ予約し、使えるようになるまでの待ち時間を返す
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+# (プール, ホスト) -> TokenBucket
+# 最短経路の探索と先読みはfetch_pool()でそれぞれ別のプールを使い、検証の分を使い切らないようにする
+_host_buckets = {}
+_host_buckets_lock = threading.Lock()
+_fetch_pool: ContextVar = ContextVar('fetch_pool', default=('default', HOST_RATE_LIMIT, HOST_RATE_BURST))
+
+
+@contextmanager
+def fetch_pool(name: str, rate: float, burst: float):
+    # この中でのWikipediaへのリクエストは、nameのプールの制限(rate, burst)で数える
+    # スレッドプールで実行する場合はcopy_context()で引き継ぐこと
+    token = _fetch_pool.set((name, rate, burst))
+    try:
+        yield
+    finally:
+        _fetch_pool.reset(token)
+
+
+def get_host_bucket(url: str):
+    pool, rate, burst = _fetch_pool.get()
+    key = (pool, urlsplit(url).netloc.lower())
+    with _host_buckets_lock:
+        bucket = _host_buckets.get(key)
+        if bucket is None:
+            bucket = _host_buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+
+# keep-aliveのコネクションをスレッド間で使い回す。requestsは読み込みが重いので最初に通信するときに作る
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                session = requests.Session()
+                session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=FETCH_MAX_WORKERS))
+                _session = session
+    return _session
+
+
+def iter_wikipedia_page(url: str):
+    # レスポンスを読みながら少しずつデコードして返す。途中でcloseされたら接続を解放する
+    get_host_bucket(url).acquire()
+    with get_session().get(url, timeout=FETCH_TIMEOUT, stream=True) as res:
+        decoder = codecs.getincrementaldecoder(res.encoding or 'utf-8')(errors='replace')
+        for chunk in res.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
 
 
 def get_wikipedia_page(url: str):
-    res = requests.get(url).text
-    time.sleep(1)
-    return res
+    return ''.join(iter_wikipedia_page(url))
+
+
+def read_wikipedia_page(url: str, read):
+    # ページを読みながらread(chunks)に渡す。通信待ちの時間をfetch、それ以外をparseとして計測する
+    started = time.perf_counter()
+    fetch_seconds = 0.0
+    chunks = iter_wikipedia_page(url)
+
+    def timed_chunks():
+        nonlocal fetch_seconds
+        while True:
+            fetch_started = time.perf_counter()
+            chunk = next(chunks, None)
+            fetch_seconds += time.perf_counter() - fetch_started
+            if chunk is None:
+                return
+            yield chunk
+
+    try:
+        return read(timed_chunks())
+    finally:
+        chunks.close()
+        wikipedia_seconds.observe(fetch_seconds, 'fetch')
+        wikipedia_seconds.observe(time.perf_counter() - started - fetch_seconds, 'parse')
+
+
+def record_redirect(source_id: int, target_id: int):
+    if source_id != target_id:
+        redirect_cache.set(source_id, target_id)
+
+
+def resolve_title_id(title_id: Optional[int]):
+    # 分かっているリダイレクトを辿ってリダイレクト先のIDにする
+    if title_id is None:
+        return None
+    target_id = redirect_cache.get(title_id)
+    return title_id if target_id is None else target_id
+
+
+def resolve_title(url: str, base_url: str = None):
+    return resolve_title_id(title_table.intern(url, base_url))
+
+
+def fetch_redirects(url: str):
+    # MediaWiki APIで (リダイレクトを解決したURL, そのページへのリダイレクト元のURL) を取得する
+    parts = urlsplit(url)
+    api_url = f'{parts.scheme}://{parts.netloc}/w/api.php'
+    params = {'action': 'query', 'titles': title_table.title(title_table.intern(url)), 'redirects': 1,
+              'prop': 'redirects', 'rdnamespace': 0, 'rdlimit': 'max', 'format': 'json'}
+    get_host_bucket(api_url).acquire()
+    res = get_session().get(api_url, params=params, timeout=FETCH_TIMEOUT)
+    res.raise_for_status()
+    query = res.json().get('query', {})
+    base_url = f'{parts.scheme}://{parts.netloc}'
+    target, aliases = url, []
+    for page in query.get('pages', {}).values():
+        target = f"{base_url}/wiki/{quote(page['title'].replace(' ', '_'))}"
+        aliases = [f"{base_url}/wiki/{quote(r['title'].replace(' ', '_'))}" for r in page.get('redirects', [])]
+    return target, aliases
+
+
+def get_redirect_aliases(title_id: int):
+    # title_idへのリダイレクト元を取得し、リダイレクト表にも登録する
+    aliases = alias_cache.get(title_id)
+    if aliases is not None:
+        redirect_lookups_total.inc('alias_cache')
+    else:
+        redirect_lookups_total.inc('api')
+        target, alias_urls = fetch_redirects(title_table.url(title_id))
+        target_id = title_table.intern(target)
+        record_redirect(title_id, target_id)
+        aliases = link_set(title_table.intern(alias) for alias in alias_urls)
+        for alias_id in aliases:
+            record_redirect(alias_id, target_id)
+        alias_cache.set(title_id, aliases)
+    return aliases
+
+
+def _read_link_ids(url: str, chunks):
+    canonical, hrefs = extract_article_page(chunks)
+    link_ids = [resolve_title(href, url) for href in hrefs]
+    return canonical, list(dict.fromkeys(link_id for link_id in link_ids if link_id is not None))
+
+
+def fetch_outgoing_links(title_id: int, cache: LinkCache = None):
+    # ページを読んでリンク先をキャッシュし、出現順のリンク先のIDを返す
+    # cacheを指定しなければlink_cacheに入れる
+    cache = link_cache if cache is None else cache
+    url = title_table.url(title_id)
+    canonical, link_ids = read_wikipedia_page(url, lambda chunks: _read_link_ids(url, chunks))
+    cache.set(title_id, link_ids)
+    if canonical:
+        # リダイレクト経由で開いたページは、リダイレクト先のIDでもキャッシュする
+        canonical_id = title_table.intern(canonical)
+        if canonical_id is not None and canonical_id != title_id:
+            record_redirect(title_id, canonical_id)
+            cache.set(canonical_id, link_ids)
+    return link_ids
+
+
+def get_outgoing_links(url: str, cache: LinkCache = None):
+    # cacheを指定した場合も、link_cacheにあればそれを使う (link_cacheには書き込まない)
+    title_id = resolve_title(url)
+    if title_id is None:
+        return link_set(())
+    links = link_cache.get(title_id)
+    if links is None and cache is not None:
+        links = cache.get(title_id)
+    if links is None:
+        links = link_set(fetch_outgoing_links(title_id, cache))
+    return links
+
+
+def _scan_for_link(url: str, chunks, target_id: int, seen: set):
+    for href in iter_article_links(chunks):
+        link_id = resolve_title(href, url)
+        if link_id == target_id:
+            return True
+        seen.add(link_id)
+    return False
+
+
+def has_outgoing_link(url: str, target_id: int):
+    if link_cache.max_size <= 0:
+        # キャッシュを使わない場合は目的のリンクが見つかった時点で読むのをやめる
+        url = title_table.url(resolve_title(url))
+        links = set()
+        if read_wikipedia_page(url, lambda chunks: _scan_for_link(url, chunks, target_id, links)):
+            return True
+        links = link_set(link_id for link_id in links if link_id is not None)
+    else:
+        links = get_outgoing_links(url)
+        if has_link(links, target_id):
+            return True
+    return _has_redirect_link(links, target_id)
+
+
+def _has_redirect_link(links, target_id: int):
+    # リダイレクトのタイトルでリンクされている場合。手元のリダイレクト表で分からないときだけAPIで引く
+    # リンク先を読んだ後に分かったリダイレクト
+    if any(resolve_title_id(link_id) == target_id for link_id in links):
+        redirect_lookups_total.inc('redirect_cache')
+        return True
+    # オフラインのインデックスにあるページは、そのリダイレクト表で判定する
+    if link_index is not None:
+        canonical_id = link_index.title_id(title_table.title(target_id))
+        if canonical_id is not None:
+            redirect_lookups_total.inc('link_index')
+            return any(link_index.title_id(title_table.title(link_id)) == canonical_id for link_id in links)
+    return any(has_link(links, alias_id) for alias_id in get_redirect_aliases(target_id))
+
+
+# オフラインのリンクグラフ。設定されていればネットワークにアクセスせずに判定する
+link_index: Optional[LinkIndex] = None
+
+
+def use_link_index(index: Optional[LinkIndex]):
+    global link_index
+    link_index = index
 
 
 def validate_url(url: str, next_url: str):
-    target = next_url.split('wikipedia.org')
-    res = get_wikipedia_page(url)
-    soup = BeautifulSoup(res, 'html.parser')
-    return bool(soup.find_all(href=target))
+    if link_index is not None:
+        title, next_title = title_from_url(url), title_from_url(next_url)
+        # インデックスに無いページはWikipediaから取得して判定する
+        if title is not None and next_title is not None and title in link_index:
+            return link_index.has_link(title, next_title)
+    target_id = resolve_title(next_url)
+    if target_id is None or title_table.intern(url) is None:
+        return False
+    return has_outgoing_link(url, target_id)
 
 
-def validate_urls(start: str, urls: List[str], goal: str):
+def validate_urls(start: str, urls: List[str], goal: str, max_workers: int = 1):
     _urls = [start] + urls + [goal]
+    if max_workers > 1:
+        return _validate_urls_concurrently(_urls, max_workers)
     for idx, url in enumerate(_urls):
         if idx == len(_urls) - 1:
             break
@@ -31,3 +402,45 @@ def validate_urls(start: str, urls: List[str], goal: str):
             raise URLValidationException(url, next_url)
     return True
 
+
+def _validate_urls_concurrently(_urls: List[str], max_workers: int):
+    hops = list(zip(_urls, _urls[1:]))
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, FETCH_MAX_WORKERS))
+    try:
+        # キャッシュの計測などのcontextvarをワーカースレッドに引き継ぐ
+        futures = {executor.submit(copy_context().run, validate_url, url, next_url): idx
+                   for idx, (url, next_url) in enumerate(hops)}
+        results = {}
+        # 逐次実行と同じ例外を返すため、先頭から順に結果が揃った分だけ判定する
+        next_idx = 0
+        for future in as_completed(futures):
+            results[futures[future]] = future
+            while next_idx in results:
+                if not results[next_idx].result():
+                    raise URLValidationException(*hops[next_idx])
+                next_idx += 1
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return True
+
+
+def _verdict_key(url: str):
+    # 記事のURLでなければ(判定はfalseになるので)メッセージが変わらないよう元のURLで区別する
+    title_id = resolve_title(url)
+    return title_id if title_id is not None else canonical_url(url) or url
+
+
+def get_path_verdict(start: str, urls: List[str], goal: str, max_workers: int = FETCH_MAX_WORKERS):
+    # 同じ経路の判定は一度だけ行う。通信エラーなどの例外はキャッシュせずにそのまま投げる
+    generation = title_table.generation
+    key = (_verdict_key(start), tuple(_verdict_key(url) for url in urls), _verdict_key(goal))
+    verdict = verdict_cache.get(key)
+    if verdict is None:
+        try:
+            validate_urls(start, urls, goal, max_workers=max_workers)
+            verdict = {'isValid': True, 'message': None}
+        except URLValidationException as e:
+            verdict = {'isValid': False, 'message': e.message}
+        title_table.check_generation(generation)
+        verdict_cache.set(key, verdict)
+    return verdict
@@ -0,0 +1,126 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import validation
+from validation import LRUCache, fetch_pool, FETCH_MAX_WORKERS
+from titles import title_table
+from metrics import REGISTRY, Counter
+from conf import WARMUP_RATE_LIMIT, WARMUP_RATE_BURST
+
+# 記事が設定されたら、検証で読むことになるページを先にリンクのキャッシュへ読み込んでおく
+# 状態はインスタンスごとに保持する (別のインスタンスで処理された検証は数えられない)
+WARMUP_STATUS_MAX_SIZE = 4096
+WARMUP_STATUS_TTL = 3 * 60 * 60  # 秒
+# Wikipediaへのリクエストは検証とは別のプール(WARMUP_RATE_LIMIT)で数え、先読みで検証の分を使い切らないようにする
+WARMUP_FETCH_POOL = 'warmup'
+
+warmup_pages_total = REGISTRY.register(Counter(
+    'warmup_pages_total', 'Pages prefetched into the link cache by outcome.', ('outcome',)))
+
+
+class RoomWarmup:
+    def __init__(self):
+        self.targets = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def start(self, target: str, url: str):
+        with self._lock:
+            self.targets[target] = {'url': url, 'state': 'running', 'fetched': 0, 'cached': 0, 'failed': 0,
+                                    'startedAt': time.time(), 'finishedAt': None}
+
+    def record_page(self, target: str, url: str, outcome: str):
+        warmup_pages_total.inc(outcome)
+        with self._lock:
+            status = self.targets.get(target)
+            # 途中で記事が変わっていたら古い方の結果は数えない
+            if status is not None and status['url'] == url:
+                status[outcome] += 1
+
+    def finish(self, target: str, url: str, state: str):
+        with self._lock:
+            status = self.targets.get(target)
+            if status is not None and status['url'] == url:
+                status['state'] = state
+                status['finishedAt'] = time.time()
+
+    def record_validation(self, hits: int, misses: int):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def to_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'targets': {target: dict(status) for target, status in self.targets.items()},
+                'validation': {'hits': self.hits, 'misses': self.misses,
+                               'hitRate': self.hits / lookups if lookups else None}
+            }
+
+
+# room id -> RoomWarmup
+_warmups = LRUCache(WARMUP_STATUS_MAX_SIZE, WARMUP_STATUS_TTL)
+_warmups_lock = threading.Lock()
+
+
+def get_room_warmup(room_id: int, create: bool = False):
+    key = str(room_id)
+    with _warmups_lock:
+        warmup = _warmups.get(key)
+        if warmup is None and create:
+            warmup = RoomWarmup()
+            _warmups.set(key, warmup)
+        return warmup
+
+
+def get_warmup_status(room_id: int):
+    warmup = get_room_warmup(room_id)
+    return warmup.to_dict() if warmup is not None else None
+
+
+def warm_page(title_id: int):
+    # 本文で先に出てくるリンクほどクリックされやすいので、取得したときは出現順のリンク先を返す
+    links = validation.link_cache.get(title_id)
+    if links is not None:
+        return 'cached', list(links)
+    with fetch_pool(WARMUP_FETCH_POOL, WARMUP_RATE_LIMIT, WARMUP_RATE_BURST):
+        return 'fetched', validation.fetch_outgoing_links(title_id)
+
+
+def warm_article(room_id: int, url: str, is_start: bool, link_limit: int, max_workers: int = FETCH_MAX_WORKERS):
+    # startはページとその先のリンク先(link_limit件まで)、goalはページだけを読み込む
+    target = 'start' if is_start else 'goal'
+    warmup = get_room_warmup(room_id, create=True)
+    warmup.start(target, url)
+    try:
+        title_id = validation.resolve_title(url)
+        if title_id is None:
+            raise ValueError(f'{url} is not a wikipedia article.')
+        outcome, links = warm_page(title_id)
+    except Exception:
+        warmup.record_page(target, url, 'failed')
+        warmup.finish(target, url, 'failed')
+        raise
+    warmup.record_page(target, url, outcome)
+
+    if is_start and link_limit > 0:
+        ring = []
+        for link_id in links:
+            # オフラインのインデックスで判定できるページは読まなくてよい
+            if validation.link_index is not None and title_table.title(link_id) in validation.link_index:
+                continue
+            ring.append(link_id)
+            if len(ring) >= link_limit:
+                break
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(warm_page, link_id) for link_id in ring]
+            for future in futures:
+                try:
+                    outcome, _ = future.result()
+                except Exception:
+                    outcome = 'failed'
+                warmup.record_page(target, url, outcome)
+    warmup.finish(target, url, 'done')